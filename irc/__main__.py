@@ -0,0 +1,23 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""``python -m irc``, see irc.run."""
+
+from irc.run import main
+
+import sys
+
+main(sys.argv[1:])
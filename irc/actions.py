@@ -15,26 +15,59 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from irc.ircstart import load_class
+from irc.message import as_message
+from irc.ratelimit import RateLimiter, CHANNEL, SENDER
+from irc.sendqueue import PRIORITY_LOW
+from irc.stats import ActionStats
+
+import copy
+import logging
 import random
+import threading
+import time
+
+log = logging.getLogger('irc')
 
 class IrcAction(object):
     """Base class for IRC interaction.
 
     This class is used to trigger an action. When a line of text is
-    received, it is then parsed by the ``check()`` method. If
-    ``check()`` returns ``True``, ``do`` method is invoked with the
-    same line of text as the parameter.
+    received, the bot parses it once into an ``IrcMessage`` and passes it to
+    the ``check()`` method. If ``check()`` returns ``True``, ``do`` method is
+    invoked with the same message as the parameter.
 
     Attributes:
         * bot: the IRC bot this class is atteched to
         * AUTHOR: a string identifying the author of the action
         * DESCRIPTION: a short text that is displayed when help is invoked
         * IN_HELP: a boolean flag indicationg should it be displayed in help
+        * COMMANDS: IRC commands (like 'PRIVMSG') this action reacts to, used
+          by the bot to skip actions that can not be triggered by a line. If
+          it is None, the action is checked against every line.
+        * FAST_LANE: a boolean flag for actions that keep the connection
+          alive. They are done by the reader as soon as a line arrives, before
+          any other action, and must be quick. They need COMMANDS.
+        * TIMEOUT: seconds the action may run on a worker thread before it is
+          dropped, or None for the bot's default.
+        * TRIGGERS: a list of irc.triggers.Trigger for actions that react to
+          the text of a PRIVMSG. The bot finds the actions whose triggers
+          match with one combined matcher and checks only those.
+        * RATE_LIMITS: how often the action may be done, a dict with a
+          (count, seconds) pair for some of the scopes in irc.ratelimit. The
+          bot drops the requests over a limit before ``do()``.
+        * stats: the ActionStats the bot keeps for this action
+        * limiter: the RateLimiter for RATE_LIMITS, or None
     """
 
     AUTHOR = None
     DESCRIPTION = 'I have no clue what this command does!'
     IN_HELP = False
+    COMMANDS = None
+    FAST_LANE = False
+    TIMEOUT = None
+    TRIGGERS = None
+    RATE_LIMITS = None
     def __init__(self, bot):
         """Initializer that attaches the bot to the action.
 
@@ -42,48 +75,70 @@ class IrcAction(object):
             * bot: the bot that has this particular action attached.
         """
         self.bot = bot
+        self.stats = ActionStats()
+        self.limiter = None
+        if self.RATE_LIMITS:
+            self.limiter = RateLimiter(self.RATE_LIMITS)
 
-    def check(self, line):
+    def check(self, message):
         """Checks if this action was triggered by the last line of text.
 
         Args:
-            * line: The line of text received from IRC.
+            * message: The IrcMessage received from IRC.
 
         Returns:
             If this line is relevant for this action, it returns `True`.
-            Otherwise, it returns `False`.
+            Otherwise, it returns `False`. By default, that is if any of the
+            TRIGGERS matches.
         """
+        if self.TRIGGERS and message.command == 'PRIVMSG':
+            for trigger in self.TRIGGERS:
+                if trigger.matches(message.trailing, self.bot.nick):
+                    return True
         return False
 
-    def do(self, line):
-        """Performs the action required by the bot.
+    def do(self, message):
+        """Performs the action required by the bot. It can also be written
+        as a generator that yields the number of seconds it wants to wait,
+        see ``irc.engine``.
 
         Args:
-            * line: The line of text received from IRC.
+            * message: The IrcMessage received from IRC.
+        """
+        pass
+
+    def start(self):
+        """Called when the bot starts, for actions that need something
+        running in the background.
+        """
+        pass
+
+    def stop(self):
+        """Called when the bot stops, to finish what the action left
+        behind, like writes that wait in a buffer.
         """
         pass
 
+    # The helpers below accept either an IrcMessage or a raw line of text.
+
     def _is_privmsg(self, line):
         """Checks if the message received is a PRIVMSG."""
-        parts = line.strip().split(' ')
-        return parts[1] == 'PRIVMSG'
+        return as_message(line).command == 'PRIVMSG'
 
     def _get_message(self, line):
         """Returns the message part of the PRIVMSG."""
-        parts = line.strip().split(':')[2:]
-        return ':'.join(parts)
+        return as_message(line).trailing
 
     def _get_channel(self, line):
         """Returns the channel where PRIVMSG was received."""
-        parts = line.strip().split(' ')
-        if parts[2] == self.bot.nick:
-            return self._get_sender(line)
-        return parts[2]
+        message = as_message(line)
+        if message.target == self.bot.nick:
+            return message.sender
+        return message.target
 
     def _get_sender(self, line):
         """Returns the sender of the message."""
-        sender = line[line.find(':')+1:line.find('!')]
-        return sender
+        return as_message(line).sender
 
     def get_help(self):
         """Returns the help text for this action."""
@@ -95,60 +150,149 @@ class PingAction(IrcAction):
     # TODO (brahle) answer to user ping requests
     AUTHOR = 'brahle'
     DESCRIPTION = 'Keepalive with the IRC server.'
-    def check(self, line):
+    COMMANDS = ('PING',)
+    FAST_LANE = True
+    def check(self, message):
         """Checks if the ping request is received.
         """
-        parts = line.strip().split(' ')
-        return parts[0] == 'PING'
+        return message.command == 'PING'
+
+    def do(self, message):
+        """Responds with pong, ahead of everything waiting to be sent.
+        """
+        params = message.params
+        token = params[-1] if params else ''
+        self.bot._send_now('PONG :' + token + '\n')
+        if message.received is not None:
+            self.bot.ping_latency.add(time.time() - message.received)
+
+
+class NickInUseAction(IrcAction):
+    """Picks another nick when the server says ours is taken (433)."""
+    AUTHOR = 'brahle'
+    DESCRIPTION = 'Finds a free nick.'
+    COMMANDS = ('433',)
+    FAST_LANE = True
+    def check(self, message):
+        return True
+
+    def do(self, message):
+        """Appends an underscore to the nick and tries again."""
+        self.bot.nick = self.bot.nick + '_'
+        self.bot._send_now('NICK {0}\n'.format(self.bot.nick))
+
+
+class WelcomeAction(IrcAction):
+    """Finishes the registration when the server welcomes the bot (001)."""
+    AUTHOR = 'brahle'
+    DESCRIPTION = 'Joins the channels once the server lets the bot in.'
+    COMMANDS = ('001',)
+    FAST_LANE = True
+    def check(self, message):
+        return True
+
+    def do(self, message):
+        self.bot.welcomed(message)
+
+
+class StateAction(IrcAction):
+    """Keeps track of who is in the channels of the bot, see irc.state."""
+    AUTHOR = 'brahle'
+    DESCRIPTION = 'Knows who is on the channels.'
+    COMMANDS = ('JOIN', 'PART', 'KICK', 'QUIT', 'NICK', 'MODE', '353', '366')
+    FAST_LANE = True
+    def check(self, message):
+        return True
+
+    def do(self, message):
+        self.bot.state.update(message)
+
+
+class IsupportAction(IrcAction):
+    """Remembers the features the server announces in RPL_ISUPPORT (005),
+    and tells the send queue how many targets a message can have.
+    """
+    AUTHOR = 'brahle'
+    DESCRIPTION = 'Learns what the IRC server supports.'
+    COMMANDS = ('005',)
+    def check(self, message):
+        return True
+
+    def do(self, message):
+        """Saves the tokens in bot.isupport, like {'TARGMAX': '...'}."""
+        for token in message.params[1:-1]:
+            key, _, value = token.partition('=')
+            self.bot.isupport[key] = value or True
+        if 'TARGMAX' in self.bot.isupport or 'MAXTARGETS' in self.bot.isupport:
+            self.bot.targmax = self.get_targmax()
+            self.bot.send_queue.set_targmax(self.bot.targmax)
 
-    def do(self, line):
-        """Responds with pong.
+    def get_targmax(self):
+        """Returns a dict of command to the maximal number of targets, or
+        None if it is unlimited.
         """
-        parts = line.strip().split(' ')
-        self.bot._send('PONG ' + parts[1] + '\n')
+        targmax = {}
+        maxtargets = self.bot.isupport.get('MAXTARGETS')
+        if maxtargets not in (None, True):
+            targmax['PRIVMSG'] = targmax['NOTICE'] = int(maxtargets)
+        value = self.bot.isupport.get('TARGMAX')
+        if value not in (None, True):
+            for item in value.split(','):
+                command, _, limit = item.partition(':')
+                if limit:
+                    targmax[command.upper()] = int(limit)
+                else:
+                    targmax[command.upper()] = None
+        return targmax
 
 
 class EchoAction(IrcAction):
     """Action that repeats what you just said."""
     AUTHOR = 'brahle'
     DESCRIPTION = 'Echoes your last words.'
-    def check(self, line):
+    COMMANDS = ('PRIVMSG',)
+    def check(self, message):
         """Checks if the current line is a privmsg."""
-        return self._is_privmsg(line)
+        return message.is_privmsg()
 
-    def do(self, line):
+    def do(self, message):
         """Echo the last message received using the same channel."""
-        channel = self._get_channel(line)
-        message_received = self._get_message(line)
-        self.bot.send_message(channel, message_received)
+        channel = self._get_channel(message)
+        self.bot.send_message(channel, message.trailing)
 
 
 class KeywordAction(IrcAction):
     """Extend this class if you want to add a command to the bot. It is just a
     utility class as, it only implements a method to check if the received
     message starts with self.KEYWORD. The deafult do method will save you some
-    work by automatically saving the sender, message and channel data.
+    work by automatically saving the sender, its prefix, message and channel
+    data.
+
+    The bot indexes these actions by their KEYWORD, so ``check()`` is only
+    called for messages that start with it. The data is saved on a copy of
+    the action, so the same action can run for several channels at once.
     """
     KEYWORD = None      # put a keyword string, like '!start' when you extend it
     IN_HELP = True
-    def check(self, line):
+    COMMANDS = ('PRIVMSG',)
+    def check(self, message):
         """Checks if the message starts with self.KEYWORD
         """
-        if not self._is_privmsg(line):
-            return False
-        message = self._get_message(line).split()
-        return message[0] == self.KEYWORD
+        return message.is_privmsg() and message.keyword == self.KEYWORD
 
-    def do(self, line):
+    def do(self, message):
         """Saves message, sender, and channel data and calls _do() method.
         """
-        self.message = self._get_message(line)[len(self.KEYWORD)+1:].strip()
-        self.sender = self._get_sender(line)
-        self.channel = self._get_channel(line)
-        self._do()
+        invocation = copy.copy(self)
+        invocation.message = message.trailing[len(self.KEYWORD)+1:].strip()
+        invocation.sender = message.sender
+        invocation.prefix = message.prefix
+        invocation.channel = self._get_channel(message)
+        return invocation._do()
 
     def _do(self):
-        """Called at the end of the ``do()`` method."""
+        """Called at the end of the ``do()`` method. Like ``do()``, it can
+        be a generator."""
         pass
 
     def get_help(self):
@@ -163,6 +307,7 @@ class HelpAction(KeywordAction):
     KEYWORD = '?help'
     DESCRIPTION = 'Prints this help message.'
     IN_HELP = False
+    RATE_LIMITS = {SENDER: (2, 60), CHANNEL: (2, 60)}
     def _do(self):
         info = self.bot.get_help()
         self.bot.send_message(self.channel, info)
@@ -171,7 +316,7 @@ class HelpAction(KeywordAction):
         for action in self.bot._actions:
             text = '\t' + action.get_help().format(name=self.bot.nick)
             if action.IN_HELP:
-                self.bot.send_message(self.channel, text)
+                self.bot.send_message(self.channel, text, PRIORITY_LOW)
                 printed = True
         if not printed:
             messages = [
@@ -181,3 +326,127 @@ class HelpAction(KeywordAction):
                 "I'm a pretty useless bot, I don't do a thing."
             ]
             self.bot.send_message(self.channel, random.choice(messages))
+
+
+class LazyAction(KeywordAction):
+    """Stands for a keyword action whose class is imported the first time
+    its keyword is used (or help is asked for), so the bot starts without
+    importing the modules of its actions and everything they import.
+    """
+    def __init__(self, bot, keyword, path):
+        """Args:
+            * bot: the bot the action is for
+            * keyword: the KEYWORD of the action
+            * path: the dotted path of the action class
+        """
+        super(LazyAction, self).__init__(bot)
+        self.KEYWORD = keyword
+        self.path = path
+        self._action = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns the real action, importing it if it is not yet."""
+        with self._lock:
+            if self._action is None:
+                start = time.time()
+                action = load_class(self.path)(self.bot)
+                log.info('Imported %s in %.1f ms.', self.path,
+                         (time.time() - start) * 1e3)
+                if self.bot.alive:
+                    action.start()
+                self.TIMEOUT = action.TIMEOUT
+                self.limiter = action.limiter
+                self._action = action
+            return self._action
+
+    def do(self, message):
+        return self.load().do(message)
+
+    def stop(self):
+        if self._action is not None:
+            self._action.stop()
+
+    def get_help(self):
+        return self.load().get_help()
+
+
+class StatsAction(KeywordAction):
+    """Tells the owner what the bot is busy with."""
+    AUTHOR = 'brahle'
+    KEYWORD = '?stats'
+    DESCRIPTION = 'Shows the counters of the bot to its owner.'
+    IN_HELP = False
+    def _do(self):
+        if not self.bot.is_owner(self.prefix):
+            return
+        stats = self.bot.stats()
+        summary = 'in {0:.1f}/s out {1:.1f}/s, ping {2}, queue {3}, ' \
+                  'workers {4}, shed {5}, ignoring {6}'.format(
+                      stats['lines_in']['rate'], stats['lines_out']['rate'],
+                      _ms(stats['ping_latency']['mean']),
+                      stats['send_queue']['depth'],
+                      stats['executor'].get('queued', 0), stats['shed'],
+                      stats['ignoring'])
+        self.bot.send_message(self.sender, summary)
+        for name, action in sorted(stats['actions'].items()):
+            if not action['invocations'] and not action['shed']:
+                continue
+            text = '{0}: {1} calls, {2} errors, {3} shed, do p50 {4} ' \
+                   'p99 {5}, db {6}'.format(name, action['invocations'],
+                                            action['errors'], action['shed'],
+                                            _ms(action['do']['p50']),
+                                            _ms(action['do']['p99']),
+                                            _ms(action['db']['mean']))
+            self.bot.send_message(self.sender, text, PRIORITY_LOW)
+
+
+class IgnoreAction(KeywordAction):
+    """Lets the owner ignore users for a while, or list who is ignored."""
+    AUTHOR = 'brahle'
+    KEYWORD = '?ignore'
+    DESCRIPTION = 'Ignores a nick for some minutes, or lists the ignored ' \
+                  'nicks. Usage: ?ignore [nick [minutes]]'
+    IN_HELP = False
+    def _do(self):
+        if not self.bot.is_owner(self.prefix):
+            return
+        args = self.message.split()
+        if not args:
+            ignored = ['{0} ({1:.0f} min)'.format(nick, left / 60)
+                       for nick, left in self.bot.ignores.items(time.time())]
+            self.bot.send_message(self.sender,
+                                  ', '.join(ignored) or 'Nobody is ignored.')
+            return
+        try:
+            minutes = float(args[1]) if len(args) > 1 else 10
+        except ValueError:
+            self.bot.send_message(self.sender, 'Minutes must be a number.')
+            return
+        self.bot.ignore(args[0], minutes * 60)
+        self.bot.send_message(self.sender, 'Ignoring {0} for {1:g} '
+                              'minutes.'.format(args[0], minutes))
+
+
+class UnignoreAction(KeywordAction):
+    """Lets the owner stop ignoring a user."""
+    AUTHOR = 'brahle'
+    KEYWORD = '?unignore'
+    DESCRIPTION = 'Stops ignoring a nick. Usage: ?unignore nick'
+    IN_HELP = False
+    def _do(self):
+        if not self.bot.is_owner(self.prefix):
+            return
+        if self.bot.ignores.remove(self.message):
+            self.bot.send_message(self.sender, 'Listening to {0} again.'
+                                  .format(self.message))
+        else:
+            self.bot.send_message(self.sender, '{0} is not ignored.'
+                                  .format(self.message))
+
+
+def _ms(seconds):
+    """Formats a time in seconds as milliseconds."""
+    if seconds is None:
+        return '-'
+    return '{0:.1f} ms'.format(seconds * 1e3)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Microbenchmarks for the hot paths of the bot. Run them with:
+
+    python -m irc.benchmark
+"""
+
+from irc.actions import IrcAction, KeywordAction
+from irc.ircbot import IrcBot
+from irc.message import IrcMessage
+from irc.mysocket import LineBuffer
+from irc.triggers import Contains, Keyword, Prefix, Regex
+
+import time
+
+TRAFFIC = [
+    'PING :irc.example.org',
+    ':nick!~user@host JOIN #zadaci',
+    ':nick!~user@host PRIVMSG #zadaci :just chatting about the task',
+    ':nick!~user@host PRIVMSG #zadaci :!action7 some argument',
+    ':nick!~user@host PRIVMSG #zadaci :!unknown command',
+    ':irc.example.org 353 bot = #zadaci :a b c d e f g h',
+]
+
+
+class _BenchBot(IrcBot):
+    """A bot that never connects and throws away everything it sends."""
+    def __init__(self, **kwargs):
+        kwargs.setdefault('nick', 'bench')
+        kwargs.setdefault('channels', ['#zadaci'])
+        kwargs['autostart'] = False
+        kwargs['workers'] = 0
+        super(_BenchBot, self).__init__(**kwargs)
+
+    def _send(self, cmd, priority=None):
+        pass
+
+    def send_message(self, where, what, priority=None):
+        pass
+
+    def _write(self, cmd, sock=None):
+        pass
+
+
+def _make_bot(count):
+    """Returns a bot with count keyword actions added to it."""
+    bot = _BenchBot()
+    for i in xrange(count):
+        action = type('Action{0}'.format(i), (KeywordAction,),
+                      {'KEYWORD': '!action{0}'.format(i)})
+        bot.add_action(action(bot))
+    return bot
+
+
+def _linear_parse(bot, data):
+    """The dispatch loop as it was before the index: check every action."""
+    for line in data.split('\n'):
+        message = IrcMessage(line)
+        for action in bot._actions:
+            if action.check(message):
+                action.do(message)
+
+
+def _time_per_line(parse, bot, rounds):
+    """Returns the average time in microseconds parse spends on a line."""
+    start = time.time()
+    for _ in xrange(rounds):
+        for line in TRAFFIC:
+            parse(bot, line)
+    return (time.time() - start) * 1e6 / (rounds * len(TRAFFIC))
+
+
+def bench_dispatch(counts=(1, 50, 500), rounds=2000):
+    """Compares the indexed dispatch with the linear scan over all actions.
+
+    Returns:
+        A list of (action count, indexed us/line, linear us/line) tuples.
+    """
+    results = []
+    for count in counts:
+        bot = _make_bot(count)
+        indexed = _time_per_line(IrcBot.parse, bot, rounds)
+        linear = _time_per_line(_linear_parse, bot, rounds)
+        results.append((count, indexed, linear))
+    return results
+
+
+class _TriggerAction(IrcAction):
+    def do(self, message):
+        pass
+
+
+def _make_trigger_bot(count):
+    """Returns a bot with count actions that have one trigger each, of
+    every kind in turn.
+    """
+    kinds = [
+        lambda i: Keyword('!cmd{0}'.format(i)),
+        lambda i: Prefix('?p{0} '.format(i)),
+        lambda i: Contains('word{0}x'.format(i)),
+        lambda i: Regex(r'\bissue {0}\b'.format(i)),
+    ]
+    bot = _BenchBot()
+    for i in xrange(count):
+        action = type('Trigger{0}'.format(i), (_TriggerAction,),
+                      {'TRIGGERS': [kinds[i % len(kinds)](i)]})
+        bot.add_action(action(bot))
+    return bot
+
+
+def bench_triggers(counts=(10, 100, 500), rounds=500):
+    """Compares the combined trigger matcher with checking the triggers
+    of every action on its own.
+
+    Returns:
+        A list of (action count, combined us/line, per action us/line)
+        tuples.
+    """
+    results = []
+    for count in counts:
+        bot = _make_trigger_bot(count)
+        combined = _time_per_line(IrcBot.parse, bot, rounds)
+        linear = _time_per_line(_linear_parse, bot, rounds)
+        results.append((count, combined, linear))
+    return results
+
+
+class _OldReader(object):
+    """MySocket.readline as it was before LineBuffer, reading from a list
+    of chunks instead of a socket.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+
+    def readline(self):
+        line = ''
+        while True:
+            while (self._pos == len(self._buffer)):
+                self._buffer = self._chunks.next()
+                self._pos = 0
+            end = self._buffer.find('\n', self._pos)
+            line = line + self._buffer[self._pos:end]
+            if end == -1:
+                self._pos = len(self._buffer)
+            else:
+                self._pos = end + 1
+                return line
+
+
+def _chunked(data, size):
+    """Splits data into chunks of the given size, as recv would."""
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+
+def _read_old(chunks, count):
+    reader = _OldReader(chunks)
+    for _ in xrange(count):
+        reader.readline()
+
+
+def _read_new(chunks, count):
+    lines = LineBuffer()
+    for chunk in chunks:
+        lines.feed(chunk)
+
+
+def bench_readline(rounds=20):
+    """Compares LineBuffer with the old readline on a NAMES burst read in
+    big chunks and on a long line that arrives in small fragments.
+
+    Returns:
+        A list of (case, old ms, new ms) tuples.
+    """
+    names = ':irc.example.org 353 bot = #zadaci :' + ' '.join(
+        'user{0}'.format(i) for i in xrange(40))
+    burst = '\r\n'.join([names] * 5000) + '\r\n'
+    fragmented = ('x' * 8000 + '\r\n') * 20
+    cases = [
+        ('NAMES burst', _chunked(burst, 16384), 5000),
+        ('fragmented', _chunked(fragmented, 64), 20),
+    ]
+    results = []
+    for name, chunks, count in cases:
+        timings = []
+        for read in (_read_old, _read_new):
+            start = time.time()
+            for _ in xrange(rounds):
+                read(chunks, count)
+            timings.append((time.time() - start) * 1e3 / rounds)
+        results.append((name, timings[0], timings[1]))
+    return results
+
+
+class _SlowAction(KeywordAction):
+    """Stands for an action that waits on the database."""
+    KEYWORD = '!slow'
+    def _do(self):
+        time.sleep(0.002)
+
+
+def bench_keepalive(loads=(0, 10, 50), rounds=5):
+    """Measures the PING to PONG time when the PING arrives in the same
+    batch as a number of slow commands.
+
+    Returns:
+        A list of (slow commands, mean latency in ms) tuples.
+    """
+    results = []
+    for load in loads:
+        bot = _BenchBot()
+        bot.add_action(_SlowAction(bot))
+        batch = [':nick!~user@host PRIVMSG #zadaci :!slow'] * load
+        batch.append('PING :irc.example.org')
+        for _ in xrange(rounds):
+            bot.parse_lines(batch, time.time())
+        results.append((load, bot.ping_latency.mean() * 1e3))
+    return results
+
+
+def main():
+    print 'Dispatch cost per line (us):'
+    print '{0:>8} {1:>10} {2:>10}'.format('actions', 'indexed', 'linear')
+    for count, indexed, linear in bench_dispatch():
+        print '{0:>8} {1:>10.2f} {2:>10.2f}'.format(count, indexed, linear)
+    print
+    print 'Trigger matching per line (us):'
+    print '{0:>8} {1:>10} {2:>10}'.format('actions', 'combined', 'separate')
+    for count, combined, linear in bench_triggers():
+        print '{0:>8} {1:>10.2f} {2:>10.2f}'.format(count, combined, linear)
+    print
+    print 'Reading lines (ms per round):'
+    print '{0:>12} {1:>10} {2:>10}'.format('case', 'readline', 'LineBuffer')
+    for name, old, new in bench_readline():
+        print '{0:>12} {1:>10.2f} {2:>10.2f}'.format(name, old, new)
+    print
+    print 'PING to PONG latency (ms):'
+    print '{0:>12} {1:>10}'.format('slow lines', 'latency')
+    for load, latency in bench_keepalive():
+        print '{0:>12} {1:>10.3f}'.format(load, latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Event loop that runs many bots in a single thread.
+
+Instead of a ReadingThread and a blocking MySocket for every bot, each bot
+gets a non-blocking IrcConnection and one EventLoop serves all of them:
+
+    loop = EventLoop()
+    loop.add_bot(SpoilerBot(host=..., autostart=False))
+    loop.add_bot(IrcBot(host=..., autostart=False))
+    loop.run()
+
+Actions may be coroutines: if ``do()`` (or ``_do()`` of a KeywordAction)
+is a generator, every number it yields is a delay in seconds after which it
+is resumed. On the loop the other bots keep running in the meantime, while
+the threaded bot simply sleeps, so the same action works in both.
+
+Only the loop thread touches the connections. Other threads (like the
+workers of a PoolExecutor) go through ``call_later()``, which is safe to
+call from anywhere and wakes the loop up.
+"""
+
+from irc.mysocket import LineBuffer
+
+import asynchat
+import asyncore
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+import types
+
+log = logging.getLogger('irc')
+
+
+def is_coroutine(result):
+    """Checks if the result of an action is a coroutine to be driven."""
+    return isinstance(result, types.GeneratorType)
+
+
+def run_sync(result):
+    """Drives a coroutine to its end in the current thread, sleeping when it
+    asks to wait. Anything else is a plain synchronous result and is ignored.
+    """
+    if not is_coroutine(result):
+        return
+    for delay in result:
+        if delay:
+            time.sleep(delay)
+
+
+class IrcConnection(asynchat.async_chat):
+    """Non-blocking connection of a single bot to its server. Output is
+    buffered by asynchat, input is split into lines by a LineBuffer.
+    """
+    BUFFER_SIZE = 16384     # size of the buffer to read
+
+    def __init__(self, bot, loop):
+        """Starts connecting the bot to its server.
+
+        Args:
+            * bot: the IrcBot that owns the connection.
+            * loop: the EventLoop that serves the connection.
+        """
+        asynchat.async_chat.__init__(self, map=loop.socket_map)
+        self.bot = bot
+        self.loop = loop
+        self._lines = LineBuffer()
+        self._flush_scheduled = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((bot.host, bot.port))
+
+    def sendall(self, data):
+        """Queues the data to be sent as soon as the socket is writable."""
+        self.push(data)
+
+    def queue_changed(self):
+        """Called by the send queue whenever a line is added to it."""
+        if self.loop.in_loop_thread():
+            self.flush_queue()
+        else:
+            self.loop.call_later(0, self.flush_queue)
+
+    def flush_queue(self):
+        """Moves the lines that flood control allows from the bot's send
+        queue to the socket, and comes back when the next one can go.
+        """
+        if self._flush_scheduled or not self.connected:
+            return
+        while True:
+            line, wait = self.bot.send_queue.pop_ready()
+            if line is None:
+                break
+            self.bot._write(line)
+        if wait is not None:
+            self._flush_scheduled = True
+            self.loop.call_later(wait, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_scheduled = False
+        self.flush_queue()
+
+    def handle_connect(self):
+        # asyncore marks the connection as connected only after this returns,
+        # and the queue is not flushed before that
+        self.connected = True
+        self.bot.register()
+
+    def handle_read(self):
+        try:
+            data = self.recv(self.BUFFER_SIZE)
+        except socket.error:
+            self.handle_error()
+            return
+        lines = self._lines.feed(data)
+        if lines:
+            self.bot.parse_lines(lines, time.time())
+
+    def handle_close(self):
+        log.warning('Connection of %s to %s closed.', self.bot.nick,
+                    self.bot.host)
+        self.bot.disconnected(self)
+        self.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Wakes the loop up from select when another thread needs it."""
+
+    def __init__(self, loop):
+        read, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read, map=loop.socket_map)
+
+    def wake(self):
+        os.write(self._write_fd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+
+class EventLoop(object):
+    """Serves the connections of many bots and runs their coroutines.
+
+    Attributes:
+        * socket_map: the asyncore map with all the connections of the loop
+    """
+    MAX_TIMEOUT = 1.0       # longest wait in select when there are no timers
+
+    def __init__(self):
+        self.socket_map = {}
+        self._timers = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self._waker = _Waker(self)
+
+    def add_bot(self, bot):
+        """Connects the bot and lets the loop serve it. The bot should be
+        created with autostart=False.
+        """
+        bot.loop = self
+        bot.start()
+
+    def in_loop_thread(self):
+        """Checks if the caller runs in the thread of the loop."""
+        return self._thread is threading.currentThread()
+
+    def call_later(self, delay, callback, *args):
+        """Calls callback(*args) in the loop after delay seconds. It can be
+        called from any thread.
+        """
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._timers,
+                           (time.time() + delay, self._sequence, callback, args))
+        if self._thread is not None and not self.in_loop_thread():
+            self._waker.wake()
+
+    def spawn(self, coroutine):
+        """Starts running the coroutine on the loop."""
+        if is_coroutine(coroutine):
+            self.call_later(0, self._step, coroutine)
+
+    def _step(self, coroutine):
+        """Resumes the coroutine and schedules its next step."""
+        try:
+            delay = coroutine.next()
+        except StopIteration:
+            return
+        except Exception:
+            log.exception('Coroutine %r failed.', coroutine)
+            return
+        self.call_later(delay or 0, self._step, coroutine)
+
+    def _run_timers(self):
+        """Calls all the callbacks that are due. A callback that fails is
+        logged, so it doesn't stop the other connections of the loop.
+        """
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return
+                _, _, callback, args = heapq.heappop(self._timers)
+            try:
+                callback(*args)
+            except Exception:
+                log.exception('Timer %r failed.', callback)
+
+    def stop(self):
+        """Makes run() return, from any thread."""
+        self._stopped = True
+        self.call_later(0, lambda: None)
+
+    def run(self):
+        """Runs the loop while there are connections or pending timers, or
+        until stop() is called.
+        """
+        self._thread = threading.currentThread()
+        # the waker is always in the map, so look for anything else
+        while not self._stopped and (len(self.socket_map) > 1 or self._timers):
+            timeout = self.MAX_TIMEOUT
+            with self._lock:
+                if self._timers:
+                    timeout = max(0, min(timeout,
+                                         self._timers[0][0] - time.time()))
+            asyncore.loop(timeout, map=self.socket_map, count=1)
+            self._run_timers()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Executors decide where the bot runs its actions.
+
+Every task is submitted with a key (the channel, or the sender of a private
+message). Tasks with the same key are done one after another in the order
+they were submitted, while tasks with different keys can run at the same
+time.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+log = logging.getLogger('irc')
+
+
+class InlineExecutor(object):
+    """Runs every task right away in the thread that submitted it."""
+
+    def submit(self, key, task, timeout=None, name=None):
+        task()
+
+    def shutdown(self, wait=False):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class _Worker(threading.Thread):
+    """Runs the tasks of one lane of a PoolExecutor."""
+
+    def __init__(self, executor, lane):
+        super(_Worker, self).__init__()
+        self.setDaemon(True)
+        self.executor = executor
+        self.lane = lane
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.task_name = None
+        self.abandoned = False
+
+    def run(self):
+        queue = self.executor._queues[self.lane]
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            task, timeout, name = item
+            with self.lock:
+                if timeout is not None:
+                    self.deadline = time.time() + timeout
+                self.task_name = name
+            try:
+                task()
+            except Exception:
+                self.executor.errors += 1
+                log.exception('Action %s failed.', name)
+            with self.lock:
+                self.deadline = None
+                if self.abandoned:
+                    return
+            self.executor.completed += 1
+            # shutdown() could not queue the stop for a full lane
+            if self.executor._stopped.isSet() and queue.empty():
+                return
+
+
+class PoolExecutor(object):
+    """Runs the tasks on a pool of worker threads.
+
+    Each worker has its own bounded queue (a lane) and a key always goes to
+    the same lane, which keeps the order per key. When a lane is full,
+    ``submit()`` waits, so a flood of commands slows down reading from the
+    server instead of eating memory. A watchdog drops tasks that run longer
+    than their timeout: the stuck thread is left to finish on its own and a
+    new worker takes over its lane.
+
+    Attributes:
+        * completed: number of finished tasks
+        * errors: number of tasks that raised an exception
+        * timeouts: number of tasks dropped by the watchdog
+        * backpressure: how many times submit() had to wait for a full lane
+    """
+    WATCHDOG_INTERVAL = 1.0     # seconds between checks for stuck tasks
+
+    def __init__(self, workers=4, queue_size=100, timeout=30.0):
+        """Starts the workers.
+
+        Args:
+            * workers: number of worker threads
+            * queue_size: number of tasks that can wait in each lane
+            * timeout: default number of seconds a task can run, None
+              for no limit
+        """
+        self.timeout = timeout
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.backpressure = 0
+        self._queues = [Queue.Queue(queue_size) for _ in xrange(workers)]
+        self._workers = [self._start_worker(i) for i in xrange(workers)]
+        self._stopped = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch)
+        self._watchdog.setDaemon(True)
+        self._watchdog.start()
+
+    def _start_worker(self, lane):
+        worker = _Worker(self, lane)
+        worker.start()
+        return worker
+
+    def submit(self, key, task, timeout=None, name=None):
+        """Queues task() to run after the earlier tasks with the same key.
+
+        Args:
+            * key: tasks with equal keys are done in order
+            * task: a callable without arguments
+            * timeout: seconds the task may run, None for the default
+            * name: used in the log when the task fails or is dropped
+        """
+        if timeout is None:
+            timeout = self.timeout
+        queue = self._queues[hash(key) % len(self._queues)]
+        item = (task, timeout, name)
+        try:
+            queue.put_nowait(item)
+        except Queue.Full:
+            self.backpressure += 1
+            queue.put(item)
+
+    def _watch(self):
+        """Replaces the workers that are stuck in a task for too long."""
+        while not self._stopped.isSet():
+            self._stopped.wait(self.WATCHDOG_INTERVAL)
+            now = time.time()
+            for lane, worker in enumerate(self._workers):
+                with worker.lock:
+                    if worker.deadline is None or worker.deadline > now:
+                        continue
+                    worker.abandoned = True
+                self.timeouts += 1
+                log.warning('Action %s timed out, dropping it.',
+                            worker.task_name)
+                self._workers[lane] = self._start_worker(lane)
+
+    def shutdown(self, wait=False):
+        """Stops the workers once they finish the tasks already queued.
+        It never waits for room in a full lane; the worker of such a lane
+        stops when it finds the lane empty.
+
+        Args:
+            * wait: if True, returns only after the workers are done.
+        """
+        self._stopped.set()
+        for queue in self._queues:
+            try:
+                queue.put_nowait(None)
+            except Queue.Full:
+                pass
+        if wait:
+            self._watchdog.join()
+            for worker in list(self._workers):
+                worker.join()
+
+    def stats(self):
+        """Returns the executor counters in a dict."""
+        return {
+            'queued': sum(queue.qsize() for queue in self._queues),
+            'completed': self.completed,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'backpressure': self.backpressure,
+        }
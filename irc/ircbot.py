@@ -15,12 +15,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from irc.actions import IrcAction, PingAction, HelpAction
+from irc.actions import IrcAction, KeywordAction, PingAction, HelpAction
+from irc.actions import IsupportAction, NickInUseAction, StateAction
+from irc.actions import StatsAction
+from irc.actions import IgnoreAction, LazyAction, UnignoreAction
+from irc.actions import WelcomeAction
+from irc.engine import IrcConnection, run_sync
+from irc.executor import InlineExecutor, PoolExecutor
+from irc.ircstart import load_class
+from irc.message import IrcMessage
 from irc.mysocket import MySocket
+from irc.ratelimit import IgnoreList, SlidingWindow, ACTION, CHANNEL, SENDER
+from irc.sendqueue import SendQueue, PRIORITY_NORMAL, MAX_LINE_LENGTH
+from irc.state import ChannelState
+from irc.stats import LatencyStat, RateStat, take_db_time
+from irc.trafficlog import LEVELS, LEVEL_ALL, LEVEL_OFF, RECEIVED, SENT
+from irc.trafficlog import TrafficLog
+from irc.triggers import TriggerMatcher
 
+import functools
+import logging
 import random
-import time
+import re
+import socket
+import sys
 import threading
+import time
+
+log = logging.getLogger('irc')
 
 class IrcBotException(Exception):
     """Base Exception class for IrcBot.
@@ -31,8 +53,7 @@ class IrcBotException(Exception):
         return repr(self.message)
 
 class ReadingThread(threading.Thread):
-    """Used to read the data from the socket and print it to the screen.
-    TODO: make it killable.
+    """Reads the lines from the socket and hands them to the bot.
     """
     def __init__(self, bot):
         """Initializes the thread.
@@ -42,12 +63,71 @@ class ReadingThread(threading.Thread):
         self.bot = bot
 
     def run(self):
-        """Runs the thread.
+        """Runs the thread until the server closes the connection. Lines
+        are read in batches of everything that is available.
+        """
+        try:
+            for lines in self.socket:
+                self.bot.parse_lines(lines, time.time())
+        except socket.error:
+            pass
+        finally:
+            self.bot.disconnected(self.socket)
+
+class WritingThread(threading.Thread):
+    """Writes the lines from the bot's send queue to the socket, as fast as
+    the flood control allows.
+    """
+    def __init__(self, bot):
+        """Initializes the thread.
+        """
+        super(WritingThread, self).__init__()
+        self.bot = bot
+        self.socket = bot.socket
+        self.queue = bot.send_queue
+
+    def run(self):
+        """Runs the thread until the send queue is closed or the connection
+        breaks.
         """
         while True:
-            data = self.socket.readline()
-            print data
-            self.bot.parse(data)
+            line = self.queue.get()
+            if line is None:
+                return
+            try:
+                self.bot._write(line, self.socket)
+            except socket.error:
+                self.bot.disconnected(self.socket)
+                return
+
+def _close_socket(sock):
+    """Shuts the socket down, which wakes up the threads that use it, and
+    closes it.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    sock.close()
+
+class Backoff(object):
+    """Exponential backoff with full jitter: the n-th retry waits a random
+    time between 0 and min(maximum, base * 2**n) seconds.
+    """
+    def __init__(self, base=1.0, maximum=300.0):
+        self.base = base
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next(self):
+        """Returns how long to wait before the next attempt."""
+        ceiling = min(self.maximum, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        """Called after a successful attempt."""
+        self.attempts = 0
 
 class IrcBot(object):
     """This class represents an IrcBot. If you want to create your own, you have
@@ -59,6 +139,18 @@ class IrcBot(object):
     """
     DEFAULT_ACTIONS = []
     HELP_ACTION = HelpAction
+    SEND_RATE = 1.0         # lines per second, once the burst is used up
+    SEND_BURST = 5          # lines that can be sent at once
+    WORKERS = 4             # threads that run the actions, 0 to run inline
+    ACTION_QUEUE_SIZE = 100 # actions waiting per worker before reading waits
+    ACTION_TIMEOUT = 30.0   # seconds before a stuck action is dropped
+    JOIN_BATCH = 10         # channels per JOIN if the server has no TARGMAX
+    CHECK_SAMPLE = 64       # one in this many calls of check() is timed
+    TRAFFIC_LEVEL = LEVEL_ALL   # what goes to the traffic log, if there is one
+    IGNORE_AFTER = None     # dropped requests in IGNORE_WINDOW before a user
+                            # is ignored, None to never ignore anyone
+    IGNORE_WINDOW = 60.0
+    IGNORE_TIME = 600.0     # seconds a user who keeps flooding is ignored
 
     def __init__(self, *args, **kwargs):
         """Initializes the IrcBot. The following arguments are required:
@@ -68,6 +160,30 @@ class IrcBot(object):
             * identity - the identity of the bot
             * real_name - the 'real name' of the bot
             * owner - name of the owner (usually your name)
+            * owner_mask - the ``nick!user@host`` of the owner, with * and ?
+              as wildcards. Only messages from it get the rights of the
+              owner, since anyone can take the owner's nick. Without it,
+              nobody has them.
+        Flood control can be tuned with send_rate (lines per second, None for
+        no limit) and send_burst. Actions run on a pool of worker threads
+        (workers, 0 to run them in the reading thread), with at most
+        action_queue_size actions waiting per worker and action_timeout
+        seconds before a stuck action is dropped.
+        A bot that is one of several shards gets their irc.ircstart.
+        ShardGroup as shard_group and its place in it as shard_index.
+        If the connection breaks, the bot connects again after a random
+        backoff, unless reconnect=False is given.
+        The raw lines are written to traffic_log (an irc.trafficlog.
+        TrafficLog) if it is given, as much as traffic_level says.
+        Requests over the RATE_LIMITS of the actions are dropped, unless
+        rate_limits=False is given. Users whose requests are dropped
+        ignore_after times in a minute are ignored for ignore_time seconds.
+        More actions can be given in actions, as dotted paths of their
+        classes, or as (keyword, path) pairs for keyword actions that are
+        only imported when they are first used (see LazyAction).
+        The bot connects as soon as it is created, unless autostart=False is
+        given. In that case, call ``start()`` when you want it to connect, or
+        add it to an ``irc.engine.EventLoop``.
         """
         self.host = kwargs.get('host')
         self.port = kwargs.get('port', 6667)
@@ -76,56 +192,455 @@ class IrcBot(object):
         self.identity = kwargs.get('identity')
         self.real_name = kwargs.get('real_name')
         self.owner = kwargs.get('owner')
+        self.owner_mask = kwargs.get('owner_mask')
+        self.shard_group = kwargs.get('shard_group')
+        if self.shard_group is not None:
+            self.shard_group.add(kwargs.get('shard_index', 0), self)
+        self._owner_re = None
+        if self.owner_mask:
+            self._owner_re = re.compile(
+                re.escape(self.owner_mask).replace('\\*', '.*')
+                .replace('\\?', '.') + '$', re.IGNORECASE)
+        self.reconnect = kwargs.get('reconnect', True)
+        self.isupport = {}
+        self.targmax = {}
+        self.state = ChannelState(self)
+        self.ping_latency = LatencyStat()
+        self.connect_time = LatencyStat()
+        self.lines_in = RateStat()
+        self.lines_out = RateStat()
+        self.traffic_log = kwargs.get('traffic_log')
+        level = kwargs.get('traffic_level', self.TRAFFIC_LEVEL)
+        if level not in LEVELS:
+            raise IrcBotException('Unknown traffic level ' + repr(level))
+        if self.traffic_log is None:
+            level = LEVEL_OFF
+        self._log_received = level == LEVEL_ALL
+        self._log_sent = level != LEVEL_OFF
+        self._checks = 0
+        self._rate_limits = kwargs.get('rate_limits', True)
+        self.ignores = IgnoreList()
+        self.ignore_time = kwargs.get('ignore_time', self.IGNORE_TIME)
+        ignore_after = kwargs.get('ignore_after', self.IGNORE_AFTER)
+        self._strikes = None
+        if ignore_after:
+            self._strikes = SlidingWindow(ignore_after, self.IGNORE_WINDOW)
+        self.shed = 0
+        self.ignored_lines = 0
+        self.registered = threading.Event()
+        self._write_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._send_rate = kwargs.get('send_rate', self.SEND_RATE)
+        self._send_burst = kwargs.get('send_burst', self.SEND_BURST)
+        self.send_queue = SendQueue(self._send_rate, self._send_burst)
+        self._backoff = Backoff()
+        self._connected = False
+        self._stopping = False
+        self._reconnect_timer = None
+        self._connect_started = None
+        workers = kwargs.get('workers', self.WORKERS)
+        if workers:
+            self.executor = PoolExecutor(
+                workers,
+                kwargs.get('action_queue_size', self.ACTION_QUEUE_SIZE),
+                kwargs.get('action_timeout', self.ACTION_TIMEOUT))
+        else:
+            self.executor = InlineExecutor()
 
-        self.socket = MySocket(self.host, self.port)
+        self.socket = None
+        self.loop = None
+        self.alive = False
         self._actions = []
+        self._by_command = {}
+        self._by_keyword = {}
+        self._fallback = []
+        self._fast_lane = {}
+        self._triggers = TriggerMatcher()
         self.add_action(PingAction(self))
+        self.add_action(NickInUseAction(self))
+        self.add_action(WelcomeAction(self))
+        self.add_action(IsupportAction(self))
+        self.add_action(StateAction(self))
         self.add_action(self.HELP_ACTION(self))
+        self.add_action(StatsAction(self))
+        self.add_action(IgnoreAction(self))
+        self.add_action(UnignoreAction(self))
         for action in self.DEFAULT_ACTIONS:
             self.add_action(action(self))
+        for spec in kwargs.get('actions', ()):
+            if isinstance(spec, basestring):
+                self.add_action(load_class(spec)(self))
+            else:
+                self.add_action(LazyAction(self, *spec))
+        if kwargs.get('autostart', True):
+            self.start()
+
+    def start(self):
+        """Opens the connection, starts reading from it and connects. If the
+        server can't be reached, it tries again later.
+        """
+        self.alive = True
+        self._stopping = False
+        for action in self._actions:
+            action.start()
+        self._reconnect()
+
+    def _open(self):
+        """Opens a new connection, on the event loop if the bot has one, or
+        with a reading and a writing thread otherwise.
+        """
+        self.registered.clear()
+        self.state.clear()
+        self.send_queue = SendQueue(self._send_rate, self._send_burst)
+        self.send_queue.set_targmax(self.targmax)
+        if self.loop is not None:
+            self.socket = IrcConnection(self, self.loop)
+            self.send_queue.listener = self.socket.queue_changed
+            self._connected = True
+            return
+        if self.socket is not None:
+            _close_socket(self.socket)
+        self.socket = MySocket(self.host, self.port)
+        self._connected = True
         self._reading_thread = ReadingThread(self)
         self._reading_thread.start()
+        self._writing_thread = WritingThread(self)
+        self._writing_thread.start()
         self.connect()
 
-    def send_message(self, where, what):
-        """Sends a message what to where.
+    def _reconnect(self):
+        """Opens a new connection, or schedules another try if it fails."""
+        if self._stopping:
+            return
+        try:
+            self._open()
+        except socket.error as e:
+            log.error('%s could not connect to %s: %s', self.nick, self.host, e)
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        """Calls _reconnect() after a jittered exponential backoff."""
+        delay = self._backoff.next()
+        log.warning('%s reconnects to %s in %.1f s.', self.nick, self.host,
+                    delay)
+        if self.loop is not None:
+            self.loop.call_later(delay, self._reconnect)
+            return
+        self._reconnect_timer = threading.Timer(delay, self._reconnect)
+        self._reconnect_timer.setDaemon(True)
+        self._reconnect_timer.start()
+
+    def stop(self):
+        """Closes the connection and stops the threads of the bot.
+        """
+        self.alive = False
+        self._stopping = True
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+        if self.loop is not None:
+            self.loop.call_later(0, self.socket.close)
+        elif self.socket is not None:
+            _close_socket(self.socket)
+        self.send_queue.close()
+        self.executor.shutdown()
+        for action in self._actions:
+            action.stop()
+
+    def disconnected(self, sock=None):
+        """Called when the server closes the connection. The bot connects
+        again if it should.
+
+        Args:
+            * sock: the socket of the connection that was closed; calls from
+              the threads of an older connection are ignored
+        """
+        with self._state_lock:
+            if not self._connected:
+                return
+            if sock is not None and sock is not self.socket:
+                return
+            self._connected = False
+        if self.loop is None and self.socket is not None:
+            # ends the other thread of the connection too
+            _close_socket(self.socket)
+        self.send_queue.close()
+        if self.reconnect and not self._stopping:
+            self._schedule_reconnect()
+        else:
+            self.alive = False
+
+    def send_message(self, where, what, priority=PRIORITY_NORMAL):
+        """Sends a message what to where. Messages with the same text are
+        joined into one line if the server allows several targets.
         """
-        message = 'PRIVMSG {0} :{1}\n'.format(where, what)
-        self._send(message)
+        self.send_queue.put_message('PRIVMSG', where, what, priority)
 
-    def _send(self, cmd):
-        """Sends the command cmd to the server.
+    def announce(self, what, priority=PRIORITY_NORMAL):
+        """Sends a message to all the channels of the bot, and if it is a
+        shard, to the channels of the other shards too, through them.
         """
-        print cmd,
-        self.socket.send(cmd)
+        bots = [self]
+        if self.shard_group is not None:
+            bots = self.shard_group.bots()
+        for bot in bots:
+            for channel in bot.channels:
+                bot.send_message(channel, what, priority)
+
+    def _send(self, cmd, priority=PRIORITY_NORMAL):
+        """Queues the command cmd to be sent to the server.
+        """
+        self.send_queue.put(cmd, priority)
+
+    def _send_now(self, cmd):
+        """Sends the command cmd right away, ahead of the send queue and
+        without waiting for flood control. Only for keeping the connection.
+        """
+        self._write(cmd)
+
+    def _write(self, cmd, sock=None):
+        """Writes the command cmd to the socket right away.
+
+        Args:
+            * sock: the socket to write to, the current one by default
+        """
+        with self._write_lock:
+            (sock or self.socket).sendall(cmd)
+        self.lines_out.add()
+        if self._log_sent:
+            self.traffic_log.add(self.nick, SENT, cmd)
 
     def connect(self):
-        """Connect to the server. It also joins all the channels.
+        """Connect to the server. The channels are joined as soon as the
+        server welcomes the bot, see ``welcomed()``.
+        """
+        self.register()
+
+    def register(self):
+        """Sends the NICK and USER commands to register with the server.
         """
-        print 'Spajam se!'
+        log.info('%s is registering with %s.', self.nick, self.host)
+        self._connect_started = time.time()
         self._send('NICK {0}\n'.format(self.nick))
         self._send('USER {0} {1} bla: {2}\n'.format(self.identity, self.host,
                                                     self.real_name))
-        time.sleep(3)
-        for channel in self.channels:
-            self._send('JOIN {0}\n'.format(channel))
+
+    def welcomed(self, message):
+        """Called when the server accepts the registration (001). Joins the
+        channels and records how long it took to get here.
+        """
+        if message.target:
+            self.nick = message.target
+        if self._connect_started is not None:
+            self.connect_time.add(time.time() - self._connect_started)
+        self._backoff.reset()
+        self.join_channels(self.channels)
+        self.registered.set()
+
+    def join_channels(self, channels):
+        """Joins the channels with as few JOIN commands as the server's
+        TARGMAX and the line length allow.
+        """
+        limit = self.targmax.get('JOIN', self.JOIN_BATCH)
+        batch = []
+        length = len('JOIN ')
+        for channel in channels:
+            if batch and ((limit is not None and len(batch) >= limit) or
+                          length + len(channel) + 1 > MAX_LINE_LENGTH):
+                self._send('JOIN {0}\n'.format(','.join(batch)))
+                batch = []
+                length = len('JOIN ')
+            batch.append(channel)
+            length += len(channel) + 1
+        if batch:
+            self._send('JOIN {0}\n'.format(','.join(batch)))
 
     def parse(self, data):
-        """Does all actions on every line from data it possibly can.
+        """Does all actions on every line from data it possibly can. Every
+        line is parsed only once and the same IrcMessage is given to all the
+        actions.
+        """
+        self.parse_lines(data.split('\n'))
+
+    def parse_lines(self, lines, received=None):
+        """Does all actions on a batch of lines read together. The fast lane
+        actions (like answering PINGs) are done for the whole batch first.
+        Then the lines of ignored users are skipped, and the actions over
+        their RATE_LIMITS are dropped.
+        """
+        now = received or time.time()
+        messages = [IrcMessage(line, received) for line in lines]
+        self.lines_in.add(len(messages))
+        if self._log_received:
+            self.traffic_log.add_lines(self.nick, RECEIVED, lines, received)
+        if self._fast_lane:
+            for message in messages:
+                for action in self._fast_lane.get(message.command, ()):
+                    if action.check(message):
+                        self._do_action(action, message)
+        for message in messages:
+            if self.ignores and message.command == 'PRIVMSG' and \
+                    self.ignores.ignored(message.sender, now) and \
+                    not self.is_owner(message.prefix):
+                self.ignored_lines += 1
+                continue
+            for _, action in self._candidates(message):
+                self._checks += 1
+                if self._checks % self.CHECK_SAMPLE:
+                    matched = action.check(message)
+                else:
+                    start = time.time()
+                    matched = action.check(message)
+                    action.stats.check.add(time.time() - start)
+                if matched and (action.limiter is None or
+                                self._admit(action, message, now)):
+                    self._dispatch(action, message)
+
+    def _admit(self, action, message, now):
+        """Checks the message against the RATE_LIMITS of the action, and
+        ignores the sender for a while if it keeps going over them. The owner
+        has no limits.
+
+        Returns:
+            True if the action can be done.
+        """
+        if not self._rate_limits or self.is_owner(message.prefix):
+            return True
+        sender = message.sender.lower()
+        target = message.target
+        channel = None
+        if target and target[0] in '#&+!':
+            channel = target.lower()
+        scope = action.limiter.admit(
+            {SENDER: sender, CHANNEL: channel, ACTION: ACTION}, now)
+        if scope is None:
+            return True
+        action.stats.shed += 1
+        self.shed += 1
+        log.debug('Dropped %s from %s, over the %s limit.',
+                  action.__class__.__name__, message.sender, scope)
+        if self._strikes is not None and not self._strikes.allow(sender, now):
+            self.ignore(message.sender, self.ignore_time, now)
+            log.warning('Ignoring %s for %d seconds, too many requests.',
+                        message.sender, self.ignore_time)
+        return False
+
+    def is_owner(self, prefix):
+        """Tells if the prefix of a message (``nick!user@host``) matches
+        the owner_mask.
+        """
+        return self._owner_re is not None and \
+            self._owner_re.match(prefix) is not None
+
+    def ignore(self, nick, seconds, now=None):
+        """Skips the PRIVMSGs from the nick for the given number of
+        seconds. Messages from the owner_mask are never skipped, even if
+        someone else used the owner's nick.
+        """
+        self.ignores.add(nick, seconds, now or time.time())
+
+    def _dispatch(self, action, message):
+        """Hands the action over to the executor. Actions triggered from the
+        same channel (or by the same user in private) keep their order.
         """
-        lines = data.split('\n')
-        for line in lines:
-            for action in self._actions:
-                if action.check(line):
-                    action.do(line)
+        target = message.target
+        if target and target[0] in '#&+!':
+            key = target.lower()
+        else:
+            key = message.sender.lower()
+        self.executor.submit(key,
+                             functools.partial(self._do_action, action, message),
+                             action.TIMEOUT, action.__class__.__name__)
+
+    def _do_action(self, action, message):
+        """Does the action, driving it if it is a coroutine, and records what
+        it cost. On the event loop a coroutine is only started here, so only
+        its first step is counted.
+        """
+        stats = action.stats
+        stats.invocations += 1
+        take_db_time()
+        start = time.time()
+        try:
+            self._run(action.do(message))
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.do.add(time.time() - start)
+            stats.db.add(take_db_time())
+
+    def _run(self, result):
+        """Runs the result of an action if it is a coroutine: on the event
+        loop if the bot has one, or right here otherwise.
+        """
+        if self.loop is not None:
+            self.loop.spawn(result)
+        else:
+            run_sync(result)
+
+    def _candidates(self, message):
+        """Returns the actions that could be triggered by the message, as
+        (position, action) pairs in the order they were added.
+        """
+        found = self._fallback + self._by_command.get(message.command, [])
+        if message.command == 'PRIVMSG':
+            found += self._by_keyword.get(message.keyword, [])
+            if self._triggers:
+                found += self._triggers.match(message.trailing, self.nick)
+        if len(found) > 1:
+            found.sort()
+        return found
+
+    def stats(self):
+        """Returns everything the bot counts about itself in a dict."""
+        actions = {}
+        for action in self._actions:
+            actions[action.__class__.__name__] = action.stats.as_dict()
+        stats = {
+            'nick': self.nick,
+            'host': self.host,
+            'alive': self.alive,
+            'lines_in': self.lines_in.as_dict(),
+            'lines_out': self.lines_out.as_dict(),
+            'ping_latency': self.ping_latency.as_dict(),
+            'connect_time': self.connect_time.as_dict(),
+            'send_queue': self.send_queue.stats(),
+            'executor': self.executor.stats(),
+            'state': self.state.stats(),
+            'shed': self.shed,
+            'ignoring': len(self.ignores),
+            'ignored_lines': self.ignored_lines,
+            'actions': actions,
+        }
+        if self.traffic_log is not None:
+            stats['traffic_log'] = self.traffic_log.stats()
+        return stats
 
     def add_action(self, action):
         """Adds an action to the action list. Action should extend IrcAction.
+
+        The action is also put in the dispatch index: fast lane actions,
+        actions with TRIGGERS and keyword actions separately, others under
+        each of their COMMANDS, and actions that didn't declare any commands
+        in the list checked for every line.
         """
         if not isinstance(action, IrcAction):
             raise IrcBotException('Expected IrcAction, but got ' +
                                   action.__class__.__name__)
+        entry = (len(self._actions), action)
         self._actions.append(action)
+        if action.FAST_LANE:
+            for command in action.COMMANDS:
+                self._fast_lane.setdefault(command, []).append(action)
+        elif action.TRIGGERS:
+            self._triggers.add(entry, action.TRIGGERS)
+        elif isinstance(action, KeywordAction) and action.KEYWORD is not None:
+            self._by_keyword.setdefault(action.KEYWORD, []).append(entry)
+        elif action.COMMANDS is None:
+            self._fallback.append(entry)
+        else:
+            for command in action.COMMANDS:
+                self._by_command.setdefault(command, []).append(entry)
 
     def get_help(self):
         """Returns basic information about the bot."""
@@ -140,7 +655,9 @@ def main():
                      nick='zecbot_beta' + str(int(random.random()*100)),
                      identity='zecbot',
                      real_name='Zec',
-                     owner='brahle')
+                     owner='brahle',
+                     owner_mask='brahle!*@*.hsin.hr',
+                     traffic_log=TrafficLog(stream=sys.stdout))
 
 
 if __name__ == '__main__':
@@ -15,38 +15,259 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from irc.ircbot import IrcBot
-from spoilbot.models import SpoilerBot
-from django.core.exceptions import MiddlewareNotUsed
+"""Starts and looks after all the bots defined in the settings.
 
-import random
+Every bot is described by a dict in ``settings.IRC_BOTS``:
 
-class IrcMiddleware(object):
-    """This sucks big time! If you want to start the bot, after you start the
-    server, you need to visit the website.
+    IRC_BOTS = [
+        {
+            'class': 'spoilbot.models.SpoilerBot',
+            'host': 'vilma.hsin.hr',
+            'port': 6667,
+            'channels': ['#zadaci'],
+            'nick': 'SpoilerBot',
+            'identity': 'SpoilerBot',
+            'real_name': 'I like to spoil things!',
+            'owner': 'brahle',
+            'owner_mask': 'brahle!*@*.hsin.hr',
+            'shards': 1,
+            'traffic_level': 'all',
+        },
+    ]
+
+Everything except 'class' and 'shards' is given to the bot class. With
+'shards' greater than one, the channels are split among that many
+connections, named nick, nick2, nick3... They share a ShardGroup, so a
+bot can still announce something in all the channels of the definition.
+
+The raw traffic of all the bots goes to one log, configured with the
+arguments of irc.trafficlog.TrafficLog in ``settings.IRC_TRAFFIC_LOG``.
+
+Run it with ``python manage.py runbots``, or without the web project with
+``python -m irc`` (see irc.run).
+"""
+
+from irc.engine import EventLoop
+from irc.trafficlog import TrafficLog
+
+import logging
+import threading
+
+log = logging.getLogger('irc')
+
+
+def load_class(path):
+    """Imports a class given its dotted path, like 'irc.ircbot.IrcBot'."""
+    module, _, name = path.rpartition('.')
+    return getattr(__import__(module, {}, {}, [name]), name)
+
+
+class ShardGroup(object):
+    """The connections of one sharded bot definition. Each of them only
+    joins its own channels, so messages for all the channels go out through
+    the connection that joined each one.
     """
     def __init__(self):
-        """Creates the IrcBot and reports that the bot is not used.
+        self._bots = {}
+        self._lock = threading.Lock()
+
+    def add(self, index, bot):
+        """Makes bot the connection of shard index, replacing the bot it
+        had before (after a restart).
         """
-        try:
-            self.bots
-        except AttributeError:
-            self.bots = [
-                SpoilerBot(
-                    host='vilma.hsin.hr',
-                    port=6667,
-                    channels=['#zadaci'],
-                    nick='SpoilerBot',
-                    identity='SpoilerBot',
-                    real_name='I like to spoil things!',
-                    owner='brahle'),
-                ]
-        raise MiddlewareNotUsed()
+        with self._lock:
+            self._bots[index] = bot
+
+    def bots(self):
+        """Returns the bots of the shards, in their order."""
+        with self._lock:
+            return [bot for _, bot in sorted(self._bots.items())]
+
+
+def shard_definitions(definition):
+    """Splits a bot definition into one definition per connection.
+
+    Returns:
+        A list of (bot class, kwargs) pairs.
+    """
+    kwargs = dict(definition)
+    bot_class = load_class(kwargs.pop('class', 'irc.ircbot.IrcBot'))
+    shards = kwargs.pop('shards', 1)
+    channels = list(kwargs.get('channels', []))
+    if shards <= 1:
+        return [(bot_class, kwargs)]
+    connections = []
+    group = ShardGroup()
+    for i in xrange(shards):
+        shard = dict(kwargs)
+        shard['channels'] = channels[i::shards]
+        shard['shard_group'] = group
+        shard['shard_index'] = i
+        if i:
+            shard['nick'] = '{0}{1}'.format(kwargs['nick'], i + 1)
+        connections.append((bot_class, shard))
+    return connections
+
+
+class _Slot(object):
+    """One connection looked after by the Supervisor."""
+    def __init__(self, bot_class, kwargs):
+        self.bot_class = bot_class
+        self.kwargs = kwargs
+        self.bot = None
+        self.restarts = 0
+
+
+class Supervisor(object):
+    """Starts the bots and restarts the ones that stopped. Bots reconnect
+    on their own when their connection breaks, so this is for the bots that
+    gave up (reconnect=False) or crashed.
+
+    With engine='threads' every bot gets its own reading and writing thread,
+    and with engine='loop' all of them are served by one EventLoop.
+    """
+    CHECK_INTERVAL = 10.0   # seconds between checks of the connections
+
+    def __init__(self, definitions, engine='threads', publish=None,
+                 traffic_log=None):
+        """Prepares the connections, without starting them.
+
+        Args:
+            * definitions: a list of bot definitions, like settings.IRC_BOTS
+            * engine: 'threads' or 'loop'
+            * publish: called with ``stats()`` after every check, to show
+              the counters of the bots outside of this process
+            * traffic_log: the TrafficLog shared by the bots, closed on stop
+        """
+        self.engine = engine
+        self.publish = publish
+        self.traffic_log = traffic_log
+        self.slots = []
+        for definition in definitions:
+            for bot_class, kwargs in shard_definitions(definition):
+                self.slots.append(_Slot(bot_class, kwargs))
+        self.loop = None
+        if engine == 'loop':
+            self.loop = EventLoop()
+        self._stopped = threading.Event()
+
+    def bots(self):
+        """Returns the bots that are running right now."""
+        return [slot.bot for slot in self.slots if slot.bot is not None]
+
+    def stats(self):
+        """Returns the stats of all the bots in a list."""
+        stats = []
+        for slot in self.slots:
+            if slot.bot is not None:
+                bot_stats = slot.bot.stats()
+                bot_stats['restarts'] = slot.restarts
+                stats.append(bot_stats)
+        return stats
+
+    def _start(self, slot):
+        """Creates a fresh bot for the slot and connects it."""
+        kwargs = dict(slot.kwargs)
+        kwargs['autostart'] = False
+        kwargs.setdefault('traffic_log', self.traffic_log)
+        bot = slot.bot = slot.bot_class(**kwargs)
+        if self.loop is not None:
+            self.loop.add_bot(bot)
+            return
+        bot.start()
+        if self._stopped.isSet():
+            # stop() was called while the bot was connecting
+            bot.stop()
+
+    def start(self):
+        """Starts all the connections at once."""
+        if self.loop is not None:
+            for slot in self.slots:
+                self._start(slot)
+            return
+        threads = [threading.Thread(target=self._start, args=(slot,))
+                   for slot in self.slots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def check(self):
+        """Restarts the connections that died and publishes the stats."""
+        for slot in self.slots:
+            if self._stopped.isSet():
+                return
+            if slot.bot is not None and slot.bot.alive:
+                continue
+            log.warning('Restarting %s on %s.', slot.kwargs.get('nick'),
+                        slot.kwargs.get('host'))
+            if slot.bot is not None:
+                slot.bot.stop()
+            slot.restarts += 1
+            self._start(slot)
+        if self.publish is not None:
+            try:
+                self.publish(self.stats())
+            except Exception:
+                log.exception('Publishing the stats failed.')
+
+    def _check_in_loop(self):
+        self.check()
+        self.loop.call_later(self.CHECK_INTERVAL, self._check_in_loop)
+
+    def create(self):
+        """Creates the bots without connecting them, like to measure how
+        long that takes.
+        """
+        for slot in self.slots:
+            kwargs = dict(slot.kwargs)
+            kwargs['autostart'] = False
+            kwargs.setdefault('traffic_log', self.traffic_log)
+            slot.bot = slot.bot_class(**kwargs)
+
+    def run(self):
+        """Starts the bots and looks after them until stop() is called."""
+        self.start()
+        self.watch()
+
+    def watch(self):
+        """Looks after the started bots until stop() is called."""
+        if self.loop is not None:
+            self.loop.call_later(self.CHECK_INTERVAL, self._check_in_loop)
+            self.loop.run()
+            return
+        while not self._stopped.isSet():
+            self._stopped.wait(self.CHECK_INTERVAL)
+            if not self._stopped.isSet():
+                self.check()
+
+    def stop(self):
+        """Stops all the bots."""
+        self._stopped.set()
+        for bot in self.bots():
+            bot.stop()
+        if self.loop is not None:
+            self.loop.stop()
+        if self.traffic_log is not None:
+            self.traffic_log.close()
+
+
+def make_traffic_log(config):
+    """Returns a TrafficLog made from a dict of its arguments, or None if
+    there is no config.
+    """
+    if not config:
+        return None
+    return TrafficLog(**config)
+
 
 def main():
-    StartMiddleware()
+    from django.conf import settings
+    from spoilbot.stats import publish
+    engine = getattr(settings, 'IRC_ENGINE', 'threads')
+    traffic_log = make_traffic_log(getattr(settings, 'IRC_TRAFFIC_LOG', None))
+    Supervisor(settings.IRC_BOTS, engine, publish, traffic_log).run()
 
 
 if __name__ == '__main__':
     main()
-
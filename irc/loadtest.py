@@ -0,0 +1,408 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""End-to-end load test: a local fake IRC server feeds traffic to a real
+bot over a real socket and times the replies.
+
+    server = FakeServer()
+    bot = SpoilerBot(host='127.0.0.1', port=server.port, send_rate=None)
+    results = run_scenarios(server, SCENARIOS)
+
+Replies are matched to the lines that caused them by a key: the token of a
+PING, and the nick of the user who asked for everything else, because the
+bot answers commands sent in private to that nick. Every scenario ends with
+a PING, so it lasts until the bot has read all of its lines. The latency of
+that PING is not counted, so scenarios without replies report only their
+throughput.
+"""
+
+from irc.message import IrcMessage
+from irc.mysocket import LineBuffer
+
+import re
+import resource
+import socket
+import threading
+import time
+
+SERVER_NAME = 'irc.example.org'
+
+_SPOILER_ID = re.compile(r'created spoiler (\d+)')
+_SENTINEL = 'end-'  # PING token that marks the end of a round
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of values falls."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+class FakeServer(object):
+    """Stands in for an IRC server that a single bot connects to.
+
+    It answers the registration with 001 and 005, echoes JOINs, and keeps
+    track of the replies that are expected from the bot.
+
+    Attributes:
+        * port: the port the server listens on
+        * joined: Event set once the bot joins a channel
+        * received: number of lines received from the bot
+        * spoiler_ids: ids of the spoilers the bot announced
+    """
+    ISUPPORT = 'TARGMAX=PRIVMSG:4,NOTICE:4,JOIN:'
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """Starts listening. The bot can connect right after this."""
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(1)
+        self.host, self.port = self._listener.getsockname()
+        self.joined = threading.Event()
+        self.nick = None
+        self.received = 0
+        self.spoiler_ids = []
+        self._socket = None
+        self._connected = threading.Event()
+        self._cond = threading.Condition()
+        self._expected = {}
+        self._latencies = []
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _serve(self):
+        self._socket, _ = self._listener.accept()
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connected.set()
+        lines = LineBuffer()
+        while True:
+            try:
+                data = self._socket.recv(16384)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            now = time.time()
+            for line in lines.feed(data):
+                self._handle(IrcMessage(line), now)
+        with self._cond:
+            self._cond.notifyAll()
+
+    def _handle(self, message, now):
+        """Answers a line from the bot, or matches it to a request."""
+        self.received += 1
+        command = message.command
+        if command == 'NICK':
+            self.nick = message.params[0]
+        elif command == 'USER':
+            self.send([
+                ':{0} 001 {1} :Welcome'.format(SERVER_NAME, self.nick),
+                ':{0} 005 {1} {2} :are supported'.format(
+                    SERVER_NAME, self.nick, self.ISUPPORT),
+            ])
+        elif command == 'JOIN':
+            for channel in message.params[0].split(','):
+                self.send([':{0}!bot@host JOIN {1}'.format(self.nick,
+                                                            channel)])
+            self.joined.set()
+        elif command == 'PONG':
+            self._replied(message.params[-1], now)
+        elif command in ('PRIVMSG', 'NOTICE'):
+            found = _SPOILER_ID.search(message.trailing)
+            for target in message.target.split(','):
+                if target.startswith('#'):
+                    continue
+                if found is not None and target in self._expected:
+                    self.spoiler_ids.append(int(found.group(1)))
+                self._replied(target, now)
+
+    def _replied(self, key, now):
+        with self._cond:
+            sent = self._expected.pop(key, None)
+            if sent is None:
+                return
+            self._latencies.append((key, now - sent))
+            if not self._expected:
+                self._cond.notifyAll()
+
+    def wait_connected(self, timeout=10):
+        """Waits until the bot connects and joins its channels."""
+        self._connected.wait(timeout)
+        self.joined.wait(timeout)
+        return self.joined.isSet()
+
+    def send(self, lines, keys=()):
+        """Sends the lines to the bot in a single write.
+
+        Args:
+            * lines: the lines to send, without line endings
+            * keys: the replies that the lines should cause
+        """
+        data = '\r\n'.join(lines) + '\r\n'
+        with self._cond:
+            now = time.time()
+            for key in keys:
+                self._expected[key] = now
+        self._socket.sendall(data)
+
+    def wait_replies(self, timeout):
+        """Waits until every expected reply arrives.
+
+        Returns:
+            The number of replies that didn't arrive in time.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._expected:
+                left = deadline - time.time()
+                if left <= 0 or not self._thread.isAlive():
+                    break
+                self._cond.wait(left)
+            missing = len(self._expected)
+            self._expected.clear()
+            return missing
+
+    def take_latencies(self):
+        """Returns the (key, seconds) pairs measured so far and starts
+        over.
+        """
+        with self._cond:
+            latencies, self._latencies = self._latencies, []
+            return latencies
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+        self._listener.close()
+
+
+class Scenario(object):
+    """A piece of traffic sent to the bot.
+
+    ``rounds()`` yields (lines, keys) pairs: the lines of a round are sent
+    at once, after the replies of the previous round arrived, and keys are
+    the replies they should cause. The base class sends the given lines in
+    one round; subclasses override ``rounds()`` to make their traffic.
+    """
+    name = None
+
+    def __init__(self, name=None, lines=(), keys=()):
+        if name is not None:
+            self.name = name
+        self.lines = list(lines)
+        self.keys = list(keys)
+
+    def rounds(self, server, channel):
+        yield self.lines, self.keys
+
+
+class PingScenario(Scenario):
+    """Keepalives, one at a time."""
+    name = 'ping'
+
+    def __init__(self, count=200):
+        self.count = count
+
+    def rounds(self, server, channel):
+        for i in xrange(self.count):
+            yield ['PING :t{0}'.format(i)], ['t{0}'.format(i)]
+
+
+class ChatterScenario(Scenario):
+    """A burst of channel messages that the bot doesn't answer."""
+    name = 'chatter'
+
+    def __init__(self, count=20000):
+        self.count = count
+
+    def rounds(self, server, channel):
+        lines = [':user{0}!u@host PRIVMSG {1} :just chatting, line {0}'.format(
+            i, channel) for i in xrange(self.count)]
+        yield lines, []
+
+
+class NamesScenario(Scenario):
+    """Large NAMES replies, as when joining a big channel."""
+    name = 'names'
+
+    def __init__(self, count=500, nicks=40):
+        self.count = count
+        self.nicks = nicks
+
+    def rounds(self, server, channel):
+        names = ' '.join('user{0}'.format(i) for i in xrange(self.nicks))
+        line = ':{0} 353 {1} = {2} :{3}'.format(SERVER_NAME, server.nick,
+                                                channel, names)
+        end = ':{0} 366 {1} {2} :End of /NAMES list.'.format(
+            SERVER_NAME, server.nick, channel)
+        yield [line] * self.count + [end], []
+
+
+class SpoilScenario(Scenario):
+    """Bursts of !spoil commands, then bursts of !unspoil for the spoilers
+    that were created.
+    """
+    name = 'spoil'
+
+    def __init__(self, count=500, burst=50):
+        self.count = count
+        self.burst = burst
+
+    def rounds(self, server, channel):
+        del server.spoiler_ids[:]
+        for start in xrange(0, self.count, self.burst):
+            nicks = ['s{0}'.format(i) for i in xrange(
+                start, min(self.count, start + self.burst))]
+            yield ([':{0}!u@host PRIVMSG {1} :!spoil secret of {0}'.format(
+                nick, server.nick) for nick in nicks], nicks)
+        ids = server.spoiler_ids
+        for start in xrange(0, len(ids), self.burst):
+            nicks = ['r{0}'.format(i) for i in xrange(
+                start, min(len(ids), start + self.burst))]
+            yield ([':{0}!u@host PRIVMSG {1} :!unspoil {2}'.format(
+                nick, server.nick, spoiler_id)
+                for nick, spoiler_id in zip(nicks, ids[start:])], nicks)
+
+
+class ReplayScenario(Scenario):
+    """Replays a file of recorded raw traffic at full speed."""
+    name = 'replay'
+
+    def __init__(self, path):
+        self.path = path
+
+    def rounds(self, server, channel):
+        with open(self.path) as traffic:
+            lines = [line.rstrip('\r\n') for line in traffic]
+        yield [line for line in lines if line], []
+
+
+SCENARIOS = [PingScenario(), ChatterScenario(), NamesScenario(),
+             SpoilScenario()]
+
+
+def run_scenario(server, scenario, channel, timeout=60):
+    """Sends the traffic of the scenario and waits for the bot to handle it.
+
+    Returns:
+        A dict with the number of lines sent, the seconds it took, the
+        lines per second, the median and 99th percentile reply latency in
+        milliseconds and the number of replies that never came.
+    """
+    server.take_latencies()
+    sent = 0
+    missing = 0
+    start = time.time()
+    for number, (lines, keys) in enumerate(scenario.rounds(server, channel)):
+        sentinel = '{0}{1}-{2}'.format(_SENTINEL, scenario.name, number)
+        server.send(list(lines) + ['PING :' + sentinel],
+                    list(keys) + [sentinel])
+        sent += len(lines) + 1
+        missing += server.wait_replies(timeout)
+    seconds = time.time() - start
+    latencies = [latency * 1e3 for key, latency in server.take_latencies()
+                 if not key.startswith(_SENTINEL)]
+    return {
+        'lines': sent,
+        'seconds': seconds,
+        'lines_per_sec': sent / seconds if seconds else None,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'missing': missing,
+    }
+
+
+def run_scenarios(server, scenarios, channel='#zadaci', timeout=60):
+    """Runs the scenarios one after another on a bot that is connected to
+    the server.
+
+    Returns:
+        A dict of scenario name to its results, and 'max_rss_kb' with the
+        peak memory of the process (the bot and the server together).
+    """
+    if not server.wait_connected(timeout):
+        raise RuntimeError('The bot did not connect to the fake server.')
+    results = {}
+    for scenario in scenarios:
+        results[scenario.name] = run_scenario(server, scenario, channel,
+                                              timeout)
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def compare(results, baseline, tolerance, memory_tolerance=0.1):
+    """Finds the results that are worse than the baseline.
+
+    Args:
+        * results: the results of run_scenarios()
+        * baseline: earlier results in the same format
+        * tolerance: how much worse is still fine, 0.2 for 20%
+        * memory_tolerance: how much more peak memory is still fine
+
+    Returns:
+        A list of messages, one for each regression.
+    """
+    regressions = []
+    old_rss = baseline.get('max_rss_kb')
+    new_rss = results.get('max_rss_kb')
+    if old_rss and new_rss and new_rss > old_rss * (1 + memory_tolerance):
+        regressions.append('peak memory: {0} kB, was {1} kB'.format(
+            new_rss, old_rss))
+    for name, old in sorted(baseline.items()):
+        new = results.get(name)
+        if not isinstance(old, dict) or new is None:
+            continue
+        if new['missing'] > old['missing']:
+            regressions.append('{0}: {1} replies missing'.format(
+                name, new['missing']))
+        if old['lines_per_sec'] and new['lines_per_sec'] < \
+                old['lines_per_sec'] * (1 - tolerance):
+            regressions.append('{0}: {1:.0f} lines/s, was {2:.0f}'.format(
+                name, new['lines_per_sec'], old['lines_per_sec']))
+        for key in ('p50_ms', 'p99_ms'):
+            if old[key] is not None and new[key] is not None and \
+                    new[key] > old[key] * (1 + tolerance):
+                regressions.append('{0}: {1} {2:.2f} ms, was {3:.2f}'.format(
+                    name, key, new[key], old[key]))
+    return regressions
+
+
+def format_results(results):
+    """Returns the results as a table."""
+    rows = ['{0:<10} {1:>8} {2:>12} {3:>9} {4:>9} {5:>8}'.format(
+        'scenario', 'lines', 'lines/s', 'p50 ms', 'p99 ms', 'missing')]
+    for name, result in sorted(results.items()):
+        if not isinstance(result, dict):
+            continue
+        rows.append('{0:<10} {1:>8} {2:>12.0f} {3:>9} {4:>9} {5:>8}'.format(
+            name, result['lines'], result['lines_per_sec'] or 0,
+            _ms(result['p50_ms']), _ms(result['p99_ms']), result['missing']))
+    rows.append('peak memory: {0} kB'.format(results['max_rss_kb']))
+    return '\n'.join(rows)
+
+
+def _ms(value):
+    if value is None:
+        return '-'
+    return '{0:.2f}'.format(value)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class IrcMessage(object):
+    """A single line received from the IRC server.
+
+    The line is split only once, the first time any of its parts is needed,
+    and the result is shared by every action that looks at it. The general
+    form of a line is::
+
+        [:prefix] COMMAND param1 param2 ... [:trailing text]
+
+    Attributes:
+        * line: the raw line, without the surrounding whitespace
+        * prefix: the origin of the message (``nick!user@host`` or a server)
+        * command: the upper-cased IRC command or numeric reply
+        * params: list of all the parameters, including the trailing one
+        * trailing: the text after `` :``, or an empty string
+        * sender: the nick part of the prefix
+        * target: the first parameter (the channel or nick for PRIVMSG)
+        * keyword: the first word of the trailing text, like '!spoil'
+        * received: time.time() when the line was read, or None
+    """
+    __slots__ = ('line', 'received', '_parsed', '_prefix', '_command',
+                 '_params', '_trailing', '_sender', '_keyword')
+
+    def __init__(self, line, received=None):
+        """Stores the line. Nothing is parsed until it is needed.
+
+        Args:
+            * line: the line of text received from IRC.
+            * received: the time when the line was read from the socket.
+        """
+        self.line = line.strip()
+        self.received = received
+        self._parsed = False
+        self._sender = None
+        self._keyword = None
+
+    def _parse(self):
+        """Splits the line into prefix, command and parameters."""
+        rest = self.line
+        prefix = ''
+        if rest.startswith(':'):
+            prefix, _, rest = rest[1:].partition(' ')
+        trailing = ''
+        has_trailing = False
+        pos = rest.find(' :')
+        if pos != -1:
+            rest, trailing = rest[:pos], rest[pos+2:]
+            has_trailing = True
+        params = rest.split()
+        if params:
+            command = params.pop(0).upper()
+        else:
+            command = ''
+        if has_trailing:
+            params.append(trailing)
+        self._prefix = prefix
+        self._command = command
+        self._params = params
+        self._trailing = trailing
+        self._parsed = True
+
+    @property
+    def prefix(self):
+        if not self._parsed:
+            self._parse()
+        return self._prefix
+
+    @property
+    def command(self):
+        if not self._parsed:
+            self._parse()
+        return self._command
+
+    @property
+    def params(self):
+        if not self._parsed:
+            self._parse()
+        return self._params
+
+    @property
+    def trailing(self):
+        if not self._parsed:
+            self._parse()
+        return self._trailing
+
+    @property
+    def target(self):
+        params = self.params
+        if params:
+            return params[0]
+        return ''
+
+    @property
+    def sender(self):
+        if self._sender is None:
+            self._sender = self.prefix.partition('!')[0]
+        return self._sender
+
+    @property
+    def keyword(self):
+        if self._keyword is None:
+            words = self.trailing.split(None, 1)
+            if words:
+                self._keyword = words[0]
+            else:
+                self._keyword = ''
+        return self._keyword
+
+    def is_privmsg(self):
+        """Checks if the message is a PRIVMSG."""
+        return self.command == 'PRIVMSG'
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return '<IrcMessage {0!r}>'.format(self.line)
+
+
+def as_message(line):
+    """Returns line as an IrcMessage, parsing it only if it is a string."""
+    if isinstance(line, IrcMessage):
+        return line
+    return IrcMessage(line)
@@ -15,40 +15,134 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import deque
+
 import socket
 
+
+class LineBuffer(object):
+    """Splits the data received from the server into lines.
+
+    Every call to ``feed()`` returns all the lines completed by the new data
+    at once, so a burst of lines costs one call instead of one per line.
+    Incomplete lines are kept in a bytearray, which grows in amortized
+    linear time no matter how fragmented the line is. Lines may end with
+    either ``\\n`` or ``\\r\\n``. Lines longer than max_line_length are
+    dropped and counted in ``dropped``.
+    """
+    MAX_LINE_LENGTH = 8192  # IRC allows 512 bytes, and 8191 with tags
+
+    def __init__(self, max_line_length=None):
+        """Creates an empty buffer.
+
+        Args:
+            * max_line_length: the longest line that is accepted.
+        """
+        self.max_line_length = max_line_length or self.MAX_LINE_LENGTH
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._discarding = False
+
+    def feed(self, data):
+        """Adds the data to the buffer.
+
+        Args:
+            * data: a string received from the socket.
+
+        Returns:
+            The list of all the lines completed by data, without the line
+            endings. It is empty if no line was completed.
+        """
+        if self._discarding:
+            start = data.find('\n')
+            if start == -1:
+                return []
+            data = data[start+1:]
+            self._discarding = False
+        end = data.rfind('\n')
+        if end == -1:
+            self._buffer.extend(data)
+            self._check_overflow()
+            return []
+        if self._buffer:
+            self._buffer.extend(data[:end])
+            chunk = str(self._buffer)
+            del self._buffer[:]
+        else:
+            chunk = data[:end]
+        self._buffer.extend(data[end+1:])
+        self._check_overflow()
+        # splitlines takes care of both '\r\n' and '\n' in a single pass
+        lines = chunk.splitlines()
+        if len(chunk) > self.max_line_length:
+            lines = self._drop_long(lines)
+        return lines
+
+    def _check_overflow(self):
+        """Starts discarding the incomplete line if it got too long."""
+        if len(self._buffer) > self.max_line_length:
+            del self._buffer[:]
+            self._discarding = True
+            self.dropped += 1
+
+    def _drop_long(self, lines):
+        """Returns only the lines that are not too long."""
+        kept = [line for line in lines if len(line) <= self.max_line_length]
+        self.dropped += len(lines) - len(kept)
+        return kept
+
+
 class MySocket(socket.socket):
     """Extends socket.socket class and adds the functionality to reads the data
     from socket line by line.
     """
-    BUFFER_SIZE = 4096      # size of the buffer to read
+    BUFFER_SIZE = 16384     # size of the buffer to read
 
     def __init__(self, host, port):
         """Creates the socket.
         """
         super(MySocket, self).__init__()
+        # every write is a whole line that should go out right away
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.connect((host, port))
-        self._buffer = ''
-        self._pos = 0
+        self._lines = LineBuffer()
+        self._pending = deque()
 
-    def readline(self):
-        """Reads the next line from the socket.
-        NOTE: Ignores the timeout and blocking status. It just waits for the
-        complete line to be sent to the socket and returns it.
+    def readlines(self):
+        """Reads all the complete lines that are available from the socket.
+        It waits until at least one line is complete.
+        NOTE: Ignores the timeout and blocking status.
 
-        TODO: account for timeout and blocking status.
+        Returns:
+            A list of lines, or an empty list once the server closed the
+            connection.
         """
-        line = ''
-        i = 0
+        if self._pending:
+            lines = list(self._pending)
+            self._pending.clear()
+            return lines
+        while True:
+            data = self.recv(self.BUFFER_SIZE)
+            if not data:
+                return []
+            lines = self._lines.feed(data)
+            if lines:
+                return lines
+
+    def __iter__(self):
+        """Yields batches of lines until the connection is closed."""
         while True:
-            while (self._pos == len(self._buffer)):
-                self._buffer = self.recv(self.BUFFER_SIZE)
-                self._pos = 0
-            end = self._buffer.find('\n', self._pos)
-            line = line + self._buffer[self._pos:end]
-            if end == -1:
-                self._pos = len(self._buffer)
-            else:
-                self._pos = end + 1
-                return line
+            lines = self.readlines()
+            if not lines:
+                return
+            yield lines
 
+    def readline(self):
+        """Reads the next line from the socket. Returns an empty string once
+        the server closed the connection.
+        """
+        if not self._pending:
+            self._pending.extend(self.readlines())
+            if not self._pending:
+                return ''
+        return self._pending.popleft()
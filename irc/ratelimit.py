@@ -0,0 +1,161 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Limits on how often users can make the bot do something.
+
+An action says how often it may be done in RATE_LIMITS, for each scope:
+
+    class SpoilAction(KeywordAction):
+        RATE_LIMITS = {SENDER: (5, 60), CHANNEL: (10, 60)}
+
+is at most 5 spoilers a minute from every user and 10 a minute in every
+channel. The bot drops the requests over a limit before the action is
+done, and can ignore users who keep hitting the limits for a while.
+"""
+
+from collections import deque
+
+SENDER = 'sender'       # limit per user
+CHANNEL = 'channel'     # limit per channel, private messages have none
+ACTION = 'action'       # limit for everyone together
+SCOPES = (SENDER, CHANNEL, ACTION)
+
+
+class SlidingWindow(object):
+    """Allows at most limit events in any period seconds for every key. It
+    remembers the times of the last events of each key, at most limit of
+    them, and forgets keys that were quiet for a whole period.
+    """
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._events = {}
+        self._pruned = 0
+
+    def count(self, key, now):
+        """Returns the number of events of the key in the last period."""
+        events = self._events.get(key)
+        if not events:
+            return 0
+        cutoff = now - self.period
+        while events and events[0] <= cutoff:
+            events.popleft()
+        return len(events)
+
+    def add(self, key, now):
+        """Records an event of the key."""
+        events = self._events.get(key)
+        if events is None:
+            events = self._events[key] = deque()
+        events.append(now)
+        if now - self._pruned > self.period:
+            self._prune(now)
+
+    def allow(self, key, now):
+        """Records an event of the key if it is under the limit.
+
+        Returns:
+            True if the event was allowed.
+        """
+        if self.count(key, now) >= self.limit:
+            return False
+        self.add(key, now)
+        return True
+
+    def _prune(self, now):
+        self._pruned = now
+        cutoff = now - self.period
+        for key in [key for key, events in self._events.iteritems()
+                    if not events or events[-1] <= cutoff]:
+            del self._events[key]
+
+    def __len__(self):
+        return len(self._events)
+
+
+class RateLimiter(object):
+    """The limits of one action, a SlidingWindow for each scope."""
+    def __init__(self, limits):
+        """Creates the windows.
+
+        Args:
+            * limits: a dict with a (count, seconds) pair for some of
+              SCOPES
+        """
+        for scope in limits:
+            if scope not in SCOPES:
+                raise ValueError('Unknown rate limit scope ' + repr(scope))
+        self._windows = [(scope, SlidingWindow(limit, period))
+                         for scope, (limit, period) in sorted(limits.items())]
+
+    def admit(self, keys, now):
+        """Counts a request if it is under all the limits. A rejected
+        request doesn't count against any of them.
+
+        Args:
+            * keys: a dict with the key of the request for each scope, None
+              for a scope the request is not in
+            * now: when the request was received
+
+        Returns:
+            None if the request is admitted, otherwise the scope whose limit
+            it is over.
+        """
+        for scope, window in self._windows:
+            key = keys.get(scope)
+            if key is not None and window.count(key, now) >= window.limit:
+                return scope
+        for scope, window in self._windows:
+            key = keys.get(scope)
+            if key is not None:
+                window.add(key, now)
+        return None
+
+
+class IgnoreList(object):
+    """Nicks the bot doesn't listen to, each until some time."""
+    def __init__(self):
+        self._until = {}
+
+    def add(self, nick, seconds, now):
+        """Ignores the nick for the given number of seconds."""
+        self._until[nick.lower()] = now + seconds
+
+    def remove(self, nick):
+        """Stops ignoring the nick.
+
+        Returns:
+            True if it was ignored.
+        """
+        return self._until.pop(nick.lower(), None) is not None
+
+    def ignored(self, nick, now):
+        """Checks if the nick is ignored right now."""
+        until = self._until.get(nick.lower())
+        if until is None:
+            return False
+        if until <= now:
+            del self._until[nick.lower()]
+            return False
+        return True
+
+    def items(self, now):
+        """Returns (nick, seconds left) pairs for the ignored nicks."""
+        return sorted((nick, until - now)
+                      for nick, until in self._until.items() if until > now)
+
+    def __len__(self):
+        return len(self._until)
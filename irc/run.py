@@ -0,0 +1,145 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Runs the bots without the web project:
+
+    python -m irc --config bots.py
+    python -m irc.run --config bots.py      (on Python 2.6)
+
+The config is a Python file with the same IRC_BOTS, IRC_ENGINE and
+IRC_TRAFFIC_LOG as the settings (the settings file itself works too). Only
+irc.* is imported to start the bots. If the config has DATABASES, Django is
+configured from its upper case names, without loading the apps, URLs or
+middleware of the project, for the actions that use the ORM. Keyword
+actions given as (keyword, path) pairs are imported when first used:
+
+    IRC_BOTS = [{
+        'class': 'irc.ircbot.IrcBot',
+        'nick': 'SpoilerBot',
+        ...
+        'actions': [('!spoil', 'spoilbot.models.SpoilAction'),
+                    ('!unspoil', 'spoilbot.models.UnspoilAction')],
+    }]
+
+The time each step of the startup takes is logged, and --check does the
+startup without connecting, to measure it.
+"""
+
+import time
+
+_started = time.time()
+
+from irc.ircstart import Supervisor, make_traffic_log
+
+from optparse import OptionParser
+import logging
+import sys
+
+log = logging.getLogger('irc')
+
+
+def load_config(path):
+    """Returns the names defined by the config file in a dict."""
+    config = {'__file__': path}
+    execfile(path, config)
+    return config
+
+
+def setup_django(config):
+    """Configures Django from the upper case names of the config, if it
+    has DATABASES and Django is not configured yet.
+
+    Returns:
+        True if Django can be used.
+    """
+    if 'DATABASES' not in config:
+        return False
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(**dict((name, value)
+                                  for name, value in config.iteritems()
+                                  if name.isupper()))
+    return True
+
+
+def _publish(stats):
+    """Publishes the stats for the web interface, importing the Django
+    side only when the first stats are ready.
+    """
+    from spoilbot.stats import publish
+    publish(stats)
+
+
+class Timer(object):
+    """Remembers how long the steps of the startup took."""
+    def __init__(self, start):
+        self.steps = []
+        self._last = start
+
+    def step(self, name):
+        now = time.time()
+        self.steps.append((name, now - self._last))
+        self._last = now
+
+    def __str__(self):
+        return ', '.join('{0} {1:.1f} ms'.format(name, seconds * 1e3)
+                         for name, seconds in self.steps)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m irc --config FILE [options]')
+    parser.add_option('--config', dest='config', default='settings.py',
+                      help='The file with IRC_BOTS, settings.py by default.')
+    parser.add_option('--engine', dest='engine', default=None,
+                      help="'threads' or 'loop', IRC_ENGINE by default.")
+    parser.add_option('--check', dest='check', action='store_true',
+                      default=False,
+                      help='Create the bots without connecting them, and '
+                           'print how long the startup took.')
+    options, _ = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    timer = Timer(_started)
+    timer.step('imports')
+    config = load_config(options.config)
+    timer.step('config')
+    use_django = setup_django(config)
+    timer.step('django')
+    engine = options.engine or config.get('IRC_ENGINE', 'threads')
+    traffic_log = None
+    if not options.check:
+        traffic_log = make_traffic_log(config.get('IRC_TRAFFIC_LOG'))
+    supervisor = Supervisor(config['IRC_BOTS'], engine,
+                            _publish if use_django else None, traffic_log)
+    timer.step('classes')
+    if options.check:
+        supervisor.create()
+        timer.step('bots')
+        print 'Startup: {0}, total {1:.1f} ms'.format(
+            timer, (time.time() - _started) * 1e3)
+        supervisor.stop()
+        return
+    supervisor.start()
+    timer.step('connect')
+    log.info('Started in %.1f ms: %s', (time.time() - _started) * 1e3, timer)
+    try:
+        supervisor.watch()
+    except KeyboardInterrupt:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,239 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import threading
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+MAX_LINE_LENGTH = 510   # 512 bytes allowed by the RFC, minus the '\r\n'
+
+
+class TokenBucket(object):
+    """Flood control: allows bursts of burst lines, and rate lines per second
+    after that. If rate is None, there is no limit.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.time()
+
+    def delay(self, now):
+        """Returns how many seconds to wait before the next line can go."""
+        if self.rate is None:
+            return 0
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self):
+        """Takes a token for the line that is being sent."""
+        if self.rate is not None:
+            self._tokens -= 1
+
+
+class _Entry(object):
+    """A line waiting in the queue. PRIVMSG and NOTICE entries keep their
+    targets in a list, so more targets can be added while they wait.
+    """
+    __slots__ = ('command', 'targets', 'text', 'queued', 'sequence')
+
+    def __init__(self, command, targets, text, queued):
+        self.command = command
+        self.targets = targets
+        self.text = text
+        self.queued = queued
+        self.sequence = 0
+
+    def line(self):
+        if self.targets is None:
+            return self.text
+        return '{0} {1} :{2}\n'.format(self.command, ','.join(self.targets),
+                                       self.text)
+
+
+class SendQueue(object):
+    """Priority queue of lines waiting to be sent to the server.
+
+    Lines with a lower priority number go first, and lines with the same
+    priority keep their order. The same message to several targets is sent
+    as a single ``PRIVMSG #a,#b :text`` when the server allows it (see
+    ``set_targmax()``), as long as that doesn't reorder the messages to any
+    of the targets. It is safe to use from many threads.
+
+    Attributes:
+        * sent: number of lines taken from the queue
+        * coalesced: number of messages merged into an earlier line
+        * total_wait: seconds all the sent lines spent in the queue
+        * max_wait: the longest time a line spent in the queue
+    """
+
+    def __init__(self, rate=None, burst=1):
+        """Creates an empty queue.
+
+        Args:
+            * rate: lines per second allowed after the burst, or None
+            * burst: number of lines that can be sent at once
+        """
+        self._bucket = TokenBucket(rate, burst)
+        self._heap = []
+        self._pending = {}
+        self._latest = {}
+        self._sequence = 0
+        self._targmax = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self.sent = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.listener = None
+
+    def set_targmax(self, targmax):
+        """Sets how many targets each command accepts.
+
+        Args:
+            * targmax: dict of command to number of targets, None if there is
+              no limit. Commands that are not in it get a single target.
+        """
+        with self._cond:
+            self._targmax = dict(targmax)
+
+    def put(self, line, priority=PRIORITY_NORMAL):
+        """Adds a raw line to the queue."""
+        self._push(_Entry(None, None, line, time.time()), priority)
+
+    def put_message(self, command, target, text, priority=PRIORITY_NORMAL):
+        """Adds a PRIVMSG or NOTICE to the queue. If the same text is already
+        waiting for another target, the target is added to it.
+        """
+        key = (priority, command, text)
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is not None and self._fits(entry, target):
+                entry.targets.append(target)
+                self._latest[target] = entry.sequence
+                self.coalesced += 1
+                return
+        entry = _Entry(command, [target], text, time.time())
+        self._push(entry, priority, key)
+
+    def _fits(self, entry, target):
+        """Checks if one more target can be added to the entry. A target is
+        never added twice, as servers drop repeated recipients.
+        """
+        if target in entry.targets:
+            return False
+        if self._latest.get(target, 0) > entry.sequence:
+            return False
+        limit = self._targmax.get(entry.command, 1)
+        if limit is not None and len(entry.targets) >= limit:
+            return False
+        return len(entry.line()) + len(target) + 1 <= MAX_LINE_LENGTH
+
+    def _push(self, entry, priority, key=None):
+        with self._cond:
+            self._sequence += 1
+            entry.sequence = self._sequence
+            heapq.heappush(self._heap, (priority, self._sequence, entry, key))
+            if key is not None:
+                self._pending[key] = entry
+                self._latest[entry.targets[0]] = entry.sequence
+            self._cond.notify()
+        if self.listener is not None:
+            self.listener()
+
+    def _pop(self, now):
+        """Takes the first line from the queue. Must hold the lock."""
+        _, _, entry, key = heapq.heappop(self._heap)
+        if key is not None:
+            if self._pending.get(key) is entry:
+                del self._pending[key]
+            for target in entry.targets:
+                if self._latest.get(target) == entry.sequence:
+                    del self._latest[target]
+        self._bucket.consume()
+        wait = now - entry.queued
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return entry.line()
+
+    def pop_ready(self):
+        """Takes the next line if flood control allows it, without blocking.
+
+        Returns:
+            A (line, None) pair if a line can be sent, (None, seconds) if the
+            next line has to wait, and (None, None) if the queue is empty.
+        """
+        with self._cond:
+            if not self._heap:
+                return None, None
+            now = time.time()
+            wait = self._bucket.delay(now)
+            if wait > 0:
+                return None, wait
+            return self._pop(now), None
+
+    def get(self):
+        """Waits until a line can be sent and takes it from the queue.
+
+        Returns:
+            The line, or None once the queue is closed.
+        """
+        with self._cond:
+            while not self._closed:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                wait = self._bucket.delay(now)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                return self._pop(now)
+            return None
+
+    def close(self):
+        """Wakes up everyone waiting in ``get()`` and makes it return None."""
+        with self._cond:
+            self._closed = True
+            self._cond.notifyAll()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def stats(self):
+        """Returns the queue counters in a dict."""
+        with self._cond:
+            average = 0.0
+            if self.sent:
+                average = self.total_wait / self.sent
+            return {
+                'depth': len(self._heap),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'average_wait': average,
+                'max_wait': self.max_wait,
+            }
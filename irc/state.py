@@ -0,0 +1,276 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Who is in the channels of the bot.
+
+The tracker follows JOIN, PART, KICK, QUIT, NICK and MODE, and the NAMES
+replies (353 and 366) the server sends when the bot joins a channel, so
+actions can ask who is where without sending WHO or NAMES:
+
+    bot.state.is_on('brahle', '#zadaci')
+    bot.state.shared_channels('brahle')
+    bot.state.is_op('brahle', '#zadaci')
+
+Nicks and channels are kept in lower case and interned, so a nick that is
+on many channels is stored once. Every channel has a set of its members
+and a small dict for the few that have modes like op or voice.
+"""
+
+DEFAULT_PREFIX = '(ov)@+'
+DEFAULT_CHANMODES = 'beI,k,l,imnpst'
+
+
+def _key(name):
+    return intern(name.lower())
+
+
+class Channel(object):
+    """The members of one channel.
+
+    Attributes:
+        * name: the name of the channel, as the server wrote it
+        * members: keys of the nicks on the channel
+        * modes: modes (like 'o' or 'ov') of the members that have any
+    """
+    __slots__ = ('name', 'members', 'modes')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.modes = {}
+
+
+class ChannelState(object):
+    """Tracks the channels the bot is on and the users on them. It is fed
+    by the reading thread, so queries from actions see a consistent state
+    after every line. All queries take O(1), except the ones that return a
+    copy of a set.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._channels = {}     # channel key -> Channel
+        self._users = {}        # nick key -> set of channel keys
+        self._nicks = {}        # nick key -> the nick as the server wrote it
+        self._names = {}        # channel key -> members while NAMES arrive
+
+    def clear(self):
+        """Forgets everything, like when the bot is disconnected."""
+        self._channels = {}
+        self._users = {}
+        self._nicks = {}
+        self._names = {}
+
+    # queries
+
+    def channels(self):
+        """Returns the names of the channels the bot is on."""
+        return [channel.name for channel in self._channels.values()]
+
+    def is_on(self, nick, channel):
+        """Checks if the nick is on the channel."""
+        state = self._channels.get(channel.lower())
+        return state is not None and nick.lower() in state.members
+
+    def shared_channels(self, nick):
+        """Returns the names of the channels the nick shares with the bot."""
+        channels = self._users.get(nick.lower(), ())
+        return set(self._channels[key].name for key in list(channels)
+                   if key in self._channels)
+
+    def members(self, channel):
+        """Returns the nicks on the channel."""
+        state = self._channels.get(channel.lower())
+        if state is None:
+            return set()
+        return set(self._nicks.get(key, key) for key in list(state.members))
+
+    def modes(self, nick, channel):
+        """Returns the modes of the nick on the channel, like 'o' or ''."""
+        state = self._channels.get(channel.lower())
+        if state is None:
+            return ''
+        return state.modes.get(nick.lower(), '')
+
+    def is_op(self, nick, channel):
+        return 'o' in self.modes(nick, channel)
+
+    def is_voiced(self, nick, channel):
+        return 'v' in self.modes(nick, channel)
+
+    def stats(self):
+        """Returns the sizes of the state in a dict."""
+        return {
+            'channels': len(self._channels),
+            'users': len(self._users),
+            'memberships': sum(len(channel.members)
+                               for channel in self._channels.values()),
+        }
+
+    # updates
+
+    def _is_me(self, key):
+        return key == self.bot.nick.lower()
+
+    def _add(self, channel_key, nick):
+        """Puts the nick on the channel and returns its key."""
+        key = _key(nick)
+        self._nicks.setdefault(key, nick)
+        self._channels[channel_key].members.add(key)
+        self._users.setdefault(key, set()).add(channel_key)
+        return key
+
+    def _remove(self, channel_key, key):
+        """Takes the nick off the channel."""
+        channel = self._channels.get(channel_key)
+        if channel is not None:
+            channel.members.discard(key)
+            channel.modes.pop(key, None)
+        channels = self._users.get(key)
+        if channels is not None:
+            channels.discard(channel_key)
+            if not channels:
+                del self._users[key]
+                self._nicks.pop(key, None)
+
+    def _part(self, channel_key):
+        """Forgets a channel the bot left."""
+        channel = self._channels.get(channel_key)
+        if channel is None:
+            return
+        for key in list(channel.members):
+            self._remove(channel_key, key)
+        del self._channels[channel_key]
+
+    def update(self, message):
+        """Updates the state with a line from the server."""
+        handler = getattr(self, '_on_' + message.command, None)
+        if handler is not None:
+            handler(message)
+
+    def _on_JOIN(self, message):
+        channel_key = _key(message.params[0])
+        key = _key(message.sender)
+        if self._is_me(key):
+            self._part(channel_key)
+            self._channels[channel_key] = Channel(message.params[0])
+        if channel_key in self._channels:
+            self._add(channel_key, message.sender)
+
+    def _on_PART(self, message):
+        channel_key = message.params[0].lower()
+        key = message.sender.lower()
+        if self._is_me(key):
+            self._part(channel_key)
+        else:
+            self._remove(channel_key, key)
+
+    def _on_KICK(self, message):
+        channel_key = message.params[0].lower()
+        key = message.params[1].lower()
+        if self._is_me(key):
+            self._part(channel_key)
+        else:
+            self._remove(channel_key, key)
+
+    def _on_QUIT(self, message):
+        key = message.sender.lower()
+        for channel_key in list(self._users.get(key, ())):
+            self._remove(channel_key, key)
+
+    def _on_NICK(self, message):
+        old = message.sender.lower()
+        channels = self._users.pop(old, None)
+        self._nicks.pop(old, None)
+        if channels is None:
+            return
+        new = _key(message.params[0])
+        self._nicks[new] = message.params[0]
+        self._users[new] = channels
+        for channel_key in channels:
+            channel = self._channels[channel_key]
+            channel.members.discard(old)
+            channel.members.add(new)
+            modes = channel.modes.pop(old, None)
+            if modes:
+                channel.modes[new] = modes
+
+    def _prefixes(self):
+        """Returns the (modes, symbols) of the member prefixes, like
+        ('ov', '@+').
+        """
+        prefix = self.bot.isupport.get('PREFIX')
+        if prefix in (None, True) or not prefix.startswith('('):
+            prefix = DEFAULT_PREFIX
+        modes, _, symbols = prefix[1:].partition(')')
+        return modes, symbols
+
+    def _on_MODE(self, message):
+        channel = self._channels.get(message.params[0].lower())
+        if channel is None or len(message.params) < 2:
+            return
+        prefix_modes, _ = self._prefixes()
+        chanmodes = self.bot.isupport.get('CHANMODES')
+        if chanmodes in (None, True):
+            chanmodes = DEFAULT_CHANMODES
+        groups = (chanmodes.split(',') + ['', '', ''])[:3]
+        always, on_set = groups[0] + groups[1], groups[2]
+        args = iter(message.params[2:])
+        adding = True
+        for mode in message.params[1]:
+            if mode in '+-':
+                adding = mode == '+'
+            elif mode in prefix_modes:
+                key = next(args, '').lower()
+                if key not in channel.members:
+                    continue
+                modes = channel.modes.get(key, '').replace(mode, '')
+                if adding:
+                    modes += mode
+                if modes:
+                    channel.modes[key] = intern(modes)
+                else:
+                    channel.modes.pop(key, None)
+            elif mode in always or (adding and mode in on_set):
+                next(args, None)
+
+    def _on_353(self, message):
+        # :server 353 me = #channel :@op +voice nick
+        channel_key = _key(message.params[2])
+        if channel_key not in self._channels:
+            return
+        modes, symbols = self._prefixes()
+        names = self._names.setdefault(channel_key, {})
+        for name in message.trailing.split():
+            mode = ''
+            while name and name[0] in symbols:
+                mode += modes[symbols.index(name[0])]
+                name = name[1:]
+            if name:
+                names[name] = mode
+
+    def _on_366(self, message):
+        # :server 366 me #channel :End of /NAMES list.
+        channel_key = message.params[1].lower()
+        names = self._names.pop(channel_key, None)
+        channel = self._channels.get(channel_key)
+        if names is None or channel is None:
+            return
+        for key in list(channel.members):
+            self._remove(channel_key, key)
+        for name, mode in names.iteritems():
+            key = self._add(channel_key, name)
+            if mode:
+                channel.modes[key] = intern(mode)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Counters the bot keeps about itself.
+
+They are updated without locks from every thread that does the work, so
+they are cheap enough to leave on all the time. Now and then an update can
+be lost when two threads race, which is fine for statistics.
+"""
+
+import bisect
+import threading
+import time
+
+
+class LatencyStat(object):
+    """Keeps track of how long something takes.
+
+    Attributes:
+        * count: number of measurements
+        * total: sum of all the measurements, in seconds
+        * max: the longest measurement
+        * last: the latest measurement
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def add(self, seconds):
+        """Records a measurement."""
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        """Returns the average measurement, or None if there are none."""
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def as_dict(self):
+        """Returns the measurements in a dict."""
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+class Histogram(LatencyStat):
+    """A LatencyStat that also counts the measurements in buckets, to tell
+    the typical time from the rare slow one.
+    """
+    # upper bounds of the buckets in seconds, the last bucket has no bound
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        super(Histogram, self).add(seconds)
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket that holds the given
+        fraction of the measurements, or the max for the last bucket.
+        """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        stats = super(Histogram, self).as_dict()
+        stats['p50'] = self.percentile(0.5)
+        stats['p99'] = self.percentile(0.99)
+        return stats
+
+
+class RateStat(object):
+    """Counts events and how many of them happened per second lately.
+
+    Attributes:
+        * total: number of events since the start
+    """
+    def __init__(self, window=60):
+        """Args:
+            * window: the number of seconds the rate is averaged over
+        """
+        self.window = window
+        self.total = 0
+        self._seconds = [0] * window
+        self._counts = [0] * window
+
+    def add(self, count=1, now=None):
+        """Records count events."""
+        second = int(now or time.time())
+        slot = second % self.window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += count
+        self.total += count
+
+    def rate(self, now=None):
+        """Returns the average number of events per second in the window."""
+        second = int(now or time.time())
+        recent = [count for stamp, count in zip(self._seconds, self._counts)
+                  if second - self.window < stamp <= second]
+        return float(sum(recent)) / self.window
+
+    def as_dict(self):
+        return {'total': self.total, 'rate': self.rate()}
+
+
+class ActionStats(object):
+    """What an action costs.
+
+    Attributes:
+        * invocations: number of times the action was done
+        * errors: number of times it raised an exception
+        * shed: number of requests dropped for being over the RATE_LIMITS
+        * check: time spent in ``check()``, only for sampled calls
+        * do: time spent in ``do()``
+        * db: time spent in the database while doing the action
+    """
+    def __init__(self):
+        self.invocations = 0
+        self.errors = 0
+        self.shed = 0
+        self.check = Histogram()
+        self.do = Histogram()
+        self.db = Histogram()
+
+    def as_dict(self):
+        return {
+            'invocations': self.invocations,
+            'errors': self.errors,
+            'shed': self.shed,
+            'check': self.check.as_dict(),
+            'do': self.do.as_dict(),
+            'db': self.db.as_dict(),
+        }
+
+
+_db_time = threading.local()
+
+
+def add_db_time(seconds):
+    """Adds to the database time of the current thread. Database layers
+    call this for every query, see ``take_db_time()``.
+    """
+    _db_time.seconds = getattr(_db_time, 'seconds', 0.0) + seconds
+
+
+def take_db_time():
+    """Returns the database time of the current thread and resets it."""
+    seconds = getattr(_db_time, 'seconds', 0.0)
+    _db_time.seconds = 0.0
+    return seconds
@@ -0,0 +1,192 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Log of the raw IRC traffic of the bots.
+
+The reading and writing threads only put lines into a bounded buffer; a
+background thread formats them and writes them to a file that is rotated
+once it grows too big. When the buffer is full, new lines are dropped and
+counted instead of slowing the bot down. Lines look like:
+
+    2011-09-04 18:03:11.204 SpoilerBot < :brahle!b@host PRIVMSG #zadaci :hi
+    2011-09-04 18:03:11.207 SpoilerBot > PRIVMSG brahle :the answer is 42
+
+Every bot decides what it logs with its traffic_level: 'off', 'sent' for
+only the lines it sends, or 'all'.
+"""
+
+from collections import deque
+
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('irc')
+
+LEVEL_OFF = 'off'
+LEVEL_SENT = 'sent'
+LEVEL_ALL = 'all'
+LEVELS = (LEVEL_OFF, LEVEL_SENT, LEVEL_ALL)
+
+RECEIVED = '<'
+SENT = '>'
+
+
+class TrafficLog(object):
+    """Writes the lines given to it in a background thread, every
+    FLUSH_INTERVAL seconds or as soon as the buffer is half full. One log
+    can be shared by many bots.
+
+    Attributes:
+        * written: number of lines written
+        * dropped: number of lines dropped because the buffer was full
+    """
+    BUFFER_SIZE = 10000     # lines waiting to be written
+    FLUSH_INTERVAL = 0.5    # seconds between writes
+
+    def __init__(self, path=None, max_bytes=10 * 1024 * 1024, backups=5,
+                 stream=None, buffer_size=None):
+        """Starts the writer.
+
+        Args:
+            * path: the file to write to. It is renamed to path.1 (and
+              path.1 to path.2, ...) when it grows over max_bytes.
+            * max_bytes: size at which the file is rotated, 0 to never
+              rotate
+            * backups: number of rotated files to keep
+            * stream: a file object to write to instead of path, like
+              sys.stdout; it is never rotated
+            * buffer_size: overrides BUFFER_SIZE
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.written = 0
+        self.dropped = 0
+        self._buffer = deque()
+        self._stream = stream
+        self._size = 0
+        if stream is None:
+            self._open()
+        self._stamp_second = None
+        self._stamp = None
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def add(self, nick, direction, line, now=None):
+        """Queues a line to be written. Never blocks.
+
+        Args:
+            * nick: the bot that received or sent the line
+            * direction: RECEIVED or SENT
+            * line: the line, with or without its line ending
+            * now: when it happened, time.time() by default
+        """
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append((now or time.time(), nick, direction, line))
+        if len(self._buffer) == self.buffer_size // 2:
+            self._wake.set()
+
+    def add_lines(self, nick, direction, lines, now=None):
+        """Queues a batch of lines that happened at the same time."""
+        now = now or time.time()
+        room = self.buffer_size - len(self._buffer)
+        if room < len(lines):
+            self.dropped += len(lines) - max(room, 0)
+            lines = lines[:max(room, 0)]
+        append = self._buffer.append
+        for line in lines:
+            append((now, nick, direction, line))
+        if len(self._buffer) >= self.buffer_size // 2:
+            self._wake.set()
+
+    def _format_time(self, now):
+        """Formats the time, reusing the part that changes once a second."""
+        second = int(now)
+        if second != self._stamp_second:
+            self._stamp_second = second
+            self._stamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(second))
+        return '{0}.{1:03d}'.format(self._stamp, int((now - second) * 1000))
+
+    def _drain(self):
+        """Writes everything that is in the buffer."""
+        buffer = self._buffer
+        chunk = []
+        while buffer:
+            now, nick, direction, line = buffer.popleft()
+            chunk.append('{0} {1} {2} {3}\n'.format(
+                self._format_time(now), nick, direction, line.rstrip('\r\n')))
+        if not chunk:
+            return
+        data = ''.join(chunk)
+        self._stream.write(data)
+        self._stream.flush()
+        self.written += len(chunk)
+        self._size += len(data)
+        if self.path is not None and self.max_bytes and \
+                self._size >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        self._stream = open(self.path, 'a')
+        self._size = os.path.getsize(self.path)
+
+    def _rotate(self):
+        """Renames the files to make room for a new one."""
+        self._stream.close()
+        for i in xrange(self.backups - 1, 0, -1):
+            older = '{0}.{1}'.format(self.path, i)
+            if os.path.exists(older):
+                os.rename(older, '{0}.{1}'.format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self._drain()
+            except EnvironmentError:
+                log.exception('Writing the traffic log failed.')
+
+    def close(self):
+        """Writes what is left and stops the writer."""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+        self._drain()
+        if self.path is not None:
+            self._stream.close()
+
+    def stats(self):
+        """Returns the log counters in a dict."""
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
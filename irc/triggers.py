@@ -0,0 +1,224 @@
+#!/usr/bin/env python2.6
+# Zeckviz IRC bot
+# Copyright (C) 2011 Bruno Rahle
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Declarative triggers for actions that react to the text of a PRIVMSG.
+
+An action lists its triggers instead of writing ``check()``:
+
+    class GreetAction(IrcAction):
+        TRIGGERS = [Keyword('!hi'), Contains('good morning'), Mention()]
+
+and the bot does it as soon as any of them matches. The bot compiles the
+triggers of all its actions into one TriggerMatcher, which finds every
+matching action with a few lookups and regex searches per line, however
+many triggers there are.
+"""
+
+import re
+
+
+class Trigger(object):
+    """Base class of the triggers. ``matches()`` checks a single trigger
+    and is used when an action checks itself; the bot uses a
+    TriggerMatcher instead.
+
+    The base class calls the function it is given, for triggers that the
+    subclasses can't express, like ``Trigger(lambda text, nick: len(text) >
+    400)``. The TriggerMatcher checks such triggers one by one.
+    """
+    def __init__(self, function=None):
+        self.function = function
+
+    def matches(self, text, nick):
+        """Checks if the trigger matches the text of a message. Subclasses
+        override it; the base class asks the function, and matches nothing
+        without one.
+
+        Args:
+            * text: the trailing text of the PRIVMSG
+            * nick: the current nick of the bot
+        """
+        return self.function is not None and bool(self.function(text, nick))
+
+
+class Keyword(Trigger):
+    """The first word of the text is the keyword, like KeywordAction."""
+    def __init__(self, keyword):
+        self.keyword = keyword
+
+    def matches(self, text, nick):
+        words = text.split(None, 1)
+        return bool(words) and words[0] == self.keyword
+
+
+class Prefix(Trigger):
+    """The text starts with the prefix."""
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def matches(self, text, nick):
+        return text.startswith(self.prefix)
+
+
+class Contains(Trigger):
+    """The text contains the string, ignoring case."""
+    def __init__(self, string):
+        self.string = string.lower()
+
+    def matches(self, text, nick):
+        return self.string in text.lower()
+
+
+class Mention(Trigger):
+    """The text mentions the nick of the bot, ignoring case."""
+    def matches(self, text, nick):
+        return nick.lower() in text.lower()
+
+
+class Regex(Trigger):
+    """The regular expression matches somewhere in the text."""
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = re.compile(pattern, flags)
+
+    def matches(self, text, nick):
+        return self.regex.search(text) is not None
+
+
+class TriggerMatcher(object):
+    """Finds all the actions whose triggers match a text.
+
+    Keywords are looked up in a dict, prefixes in one dict per prefix
+    length. All the Contains strings are found in one pass by a single
+    regex: an alternation inside a lookahead, longest first, finds the
+    longest string that starts at each position, and the shorter strings
+    that are prefixes of it are added from a table. The regexes are joined
+    into alternations too, of up to GROUPS regexes each because of the limit
+    re has on groups. As most lines match nothing, one search per
+    alternation is usually all the work; when one matches, the other
+    regexes in it are tried one by one. Regexes with flags (given or inline,
+    like ``(?i)``, which would apply to the whole alternation) or groups of
+    their own can't be joined and are always tried one by one.
+    """
+    GROUPS = 99     # regexes joined into one alternation
+
+    def __init__(self):
+        self._entries = []
+        self._compiled = False
+
+    def add(self, entry, triggers):
+        """Adds an action.
+
+        Args:
+            * entry: what ``match()`` returns for the action, like a
+              (position, action) pair
+            * triggers: the Trigger instances of the action
+        """
+        self._entries.append((entry, triggers))
+        self._compiled = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _compile(self):
+        self._keywords = {}
+        self._prefixes = {}
+        self._contains = {}
+        self._mentions = []
+        self._regexes = []
+        self._separate = []
+        for entry, triggers in self._entries:
+            for trigger in triggers:
+                if isinstance(trigger, Keyword):
+                    self._keywords.setdefault(trigger.keyword, []).append(entry)
+                elif isinstance(trigger, Prefix):
+                    by_length = self._prefixes.setdefault(
+                        len(trigger.prefix), {})
+                    by_length.setdefault(trigger.prefix, []).append(entry)
+                elif isinstance(trigger, Contains):
+                    self._contains.setdefault(trigger.string, []).append(entry)
+                elif isinstance(trigger, Mention):
+                    self._mentions.append(entry)
+                elif isinstance(trigger, Regex) and \
+                        not trigger.regex.flags and not trigger.regex.groups:
+                    self._regexes.append((trigger.regex, entry))
+                else:
+                    self._separate.append((trigger, entry))
+        self._prefix_lengths = sorted(self._prefixes)
+        self._contains_regex = None
+        self._covered = {}
+        if self._contains:
+            strings = sorted(self._contains, key=len, reverse=True)
+            self._contains_regex = re.compile('(?=({0}))'.format(
+                '|'.join(re.escape(string) for string in strings)))
+            for string in strings:
+                self._covered[string] = [other for other in strings
+                                         if string.startswith(other)]
+        self._joined = []
+        for start in xrange(0, len(self._regexes), self.GROUPS):
+            regexes = self._regexes[start:start + self.GROUPS]
+            joined = re.compile('|'.join('({0})'.format(regex.pattern)
+                                         for regex, _ in regexes))
+            self._joined.append((joined, regexes))
+        self._compiled = True
+
+    def match(self, text, nick):
+        """Returns the entries of the actions that have a trigger matching
+        the text, each once, in the order they were added.
+
+        Args:
+            * text: the trailing text of the PRIVMSG
+            * nick: the current nick of the bot, for Mention
+        """
+        if not self._compiled:
+            self._compile()
+        found = []
+        if self._keywords:
+            words = text.split(None, 1)
+            if words:
+                found.extend(self._keywords.get(words[0], ()))
+        for length in self._prefix_lengths:
+            if length > len(text):
+                break
+            found.extend(self._prefixes[length].get(text[:length], ()))
+        if self._contains_regex is not None or self._mentions:
+            lower = text.lower()
+            if self._mentions and nick and nick.lower() in lower:
+                found.extend(self._mentions)
+            if self._contains_regex is not None:
+                seen = set()
+                for longest in self._contains_regex.findall(lower):
+                    if longest in seen:
+                        continue
+                    seen.add(longest)
+                    for string in self._covered[longest]:
+                        found.extend(self._contains[string])
+        for joined, regexes in self._joined:
+            first = joined.search(text)
+            if first is None:
+                continue
+            # the leftmost match, the others may match further on
+            hit = first.lastindex - 1
+            for i, (regex, entry) in enumerate(regexes):
+                if i == hit or regex.search(text) is not None:
+                    found.append(entry)
+        for trigger, entry in self._separate:
+            if trigger.matches(text, nick):
+                found.append(entry)
+        if len(found) > 1:
+            found = sorted(set(found))
+        return found
@@ -0,0 +1,13 @@
+from django.contrib import admin
+from quiz.models import Answer, Question
+
+class AnswerInline(admin.TabularInline):
+    model = Answer
+
+class QuestionAdmin(admin.ModelAdmin):
+    inlines = [AnswerInline]
+    list_display = ('text', 'author', 'active')
+    list_filter = ('active',)
+    search_fields = ('text',)
+
+admin.site.register(Question, QuestionAdmin)
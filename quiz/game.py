@@ -0,0 +1,217 @@
+from quiz.matching import AnswerMatcher, normalize_answer
+
+from collections import deque
+import threading
+
+
+class QuizGame(object):
+    """The state of the quiz in one channel.
+
+    Attributes:
+        * channel: where the quiz is played
+        * rounds: number of questions in the game
+        * round: number of the current question, from 1
+        * question: the current Question, or None between questions
+        * matcher: the AnswerMatcher of the current question, which gives
+          the answers as they were written
+        * recent: ids of the questions asked lately, not to ask them again
+    """
+    RECENT = 50     # questions that aren't repeated
+
+    def __init__(self, channel, rounds):
+        self.channel = channel
+        self.rounds = rounds
+        self.round = 0
+        self.question = None
+        self.matcher = None
+        self.recent = deque(maxlen=self.RECENT)
+        self.timer = None
+
+    def ask(self, question, answers):
+        """Makes question the current one.
+
+        Args:
+            * question: the Question
+            * answers: a dict of its normalized answers to the answers as
+              they were written
+        """
+        self.round += 1
+        self.question = question
+        self.matcher = AnswerMatcher(answers)
+        self.recent.append(question.id)
+
+    def match(self, guess):
+        """Returns the written answer the normalized guess matches, or None.
+        """
+        # the reading thread checks guesses while the question can change
+        matcher = self.matcher
+        if matcher is None:
+            return None
+        return matcher.match(guess)
+
+    def any_answer(self):
+        """Returns one of the answers of the current question."""
+        return min(self.matcher.answers.values())
+
+
+class Quiz(object):
+    """Runs the quiz games of a bot, any number of them at once, one per
+    channel.
+
+    Guesses are checked on the reading thread (``is_answer()``), so that has
+    to be cheap: a dict lookup for the channel and the AnswerMatcher of its
+    question. Questions end when somebody answers (``answered()``) or when
+    their time is up, and the next one is asked after a pause. Timers run
+    the games, so no thread waits for a question to end.
+    """
+    QUESTION_TIME = 60.0    # seconds to answer a question
+    PAUSE = 5.0             # seconds between questions
+    ROUNDS = 10             # questions in a game, if not told otherwise
+    MAX_ROUNDS = 100
+
+    def __init__(self, bot, pick, question_time=None, pause=None):
+        """Creates a quiz without games.
+
+        Args:
+            * bot: the bot that plays the games
+            * pick: pick(exclude) returns a random question whose id is not in
+              exclude and a dict of its normalized answers to the answers as
+              they were written, or (None, None) if there are no questions
+            * question_time: overrides QUESTION_TIME
+            * pause: overrides PAUSE, 0 asks the next question right away
+        """
+        self.bot = bot
+        self._pick = pick
+        self.question_time = question_time or self.QUESTION_TIME
+        self.pause = self.PAUSE if pause is None else pause
+        self.games = {}
+        self._lock = threading.RLock()
+
+    def start(self, channel, rounds=None):
+        """Starts a game in the channel.
+
+        Returns:
+            False if a game is already running there.
+        """
+        key = channel.lower()
+        with self._lock:
+            if key in self.games:
+                return False
+            game = QuizGame(channel, rounds or self.ROUNDS)
+            self.games[key] = game
+        self._next(game)
+        return True
+
+    def stop(self, channel):
+        """Stops the game in the channel.
+
+        Returns:
+            False if there was none.
+        """
+        with self._lock:
+            game = self.games.pop(channel.lower(), None)
+            if game is None:
+                return False
+            game.question = game.matcher = None
+            self._cancel(game)
+        return True
+
+    def stop_all(self):
+        for game in self.games.values():
+            self.stop(game.channel)
+
+    def is_answer(self, channel, text):
+        """Checks if the text answers the question asked in the channel."""
+        game = self.games.get(channel.lower())
+        return game is not None and \
+            game.match(normalize_answer(text)) is not None
+
+    def answered(self, channel, nick, text):
+        """Ends the question if the text answers it. Only the first right
+        answer counts.
+
+        Returns:
+            The answer, or None if the text was not (or no longer) right.
+        """
+        with self._lock:
+            game = self.games.get(channel.lower())
+            if game is None:
+                return None
+            answer = game.match(normalize_answer(text))
+            if answer is None:
+                return None
+            question = game.question
+            game.question = game.matcher = None
+            self._cancel(game)
+        self.bot.send_message(game.channel, '{0} got it, the answer is {1}!'
+                              .format(nick, answer))
+        self.on_correct(game, question, nick)
+        self._later(game, self.pause, self._next)
+        return answer
+
+    def on_correct(self, game, question, nick):
+        """Called when nick answers the question first."""
+        pass
+
+    def _next(self, game):
+        """Asks the next question of the game, or ends it. The question is
+        picked outside the lock, so the games of other channels don't wait
+        for the database.
+        """
+        key = game.channel.lower()
+        with self._lock:
+            if self.games.get(key) is not game:
+                return
+            if game.round >= game.rounds:
+                del self.games[key]
+                finished = True
+            else:
+                finished = False
+                recent = list(game.recent)
+        if finished:
+            self.bot.send_message(game.channel, 'The quiz is over.')
+            return
+        question, answers = self._pick(recent)
+        with self._lock:
+            # the game could have been stopped, or asked by another timer
+            if self.games.get(key) is not game or game.question is not None:
+                return
+            if question is None:
+                del self.games[key]
+            else:
+                game.ask(question, answers)
+                self._later(game, self.question_time, self._time_up,
+                            question)
+        if question is None:
+            self.bot.send_message(game.channel, 'I have no questions!')
+        else:
+            self.bot.send_message(game.channel, 'Question {0}/{1}: {2}'.format(
+                game.round, game.rounds, question.text))
+
+    def _time_up(self, game, question):
+        with self._lock:
+            if game.question is not question:
+                return
+            answer = game.any_answer()
+            game.question = game.matcher = None
+        self.bot.send_message(game.channel, "Time's up, the answer is {0}."
+                              .format(answer))
+        self._later(game, self.pause, self._next)
+
+    def _later(self, game, seconds, function, *args):
+        """Calls function(game, *args) after some seconds, or right away if
+        seconds is 0. A game has one timer at a time.
+        """
+        if not seconds:
+            function(game, *args)
+            return
+        with self._lock:
+            self._cancel(game)
+            game.timer = threading.Timer(seconds, function, (game,) + args)
+            game.timer.setDaemon(True)
+            game.timer.start()
+
+    def _cancel(self, game):
+        if game.timer is not None:
+            game.timer.cancel()
+            game.timer = None
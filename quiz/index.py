@@ -0,0 +1,66 @@
+import random
+import threading
+
+
+class RandomIndex(object):
+    """A set of ids that can give a random one in O(1), instead of asking
+    the database to ``ORDER BY RAND()``. The ids are kept in a list, and a
+    removed id is replaced by the last one, so the list has no holes.
+
+    The ids are loaded on first use by load(), a function that returns all
+    of them; after that, add() and remove() keep the index up to date.
+    """
+    def __init__(self, load):
+        self._load = load
+        self._ids = None
+        self._positions = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._ids is None:
+            ids = list(self._load())
+            self._positions = dict((id, i) for i, id in enumerate(ids))
+            self._ids = ids
+
+    def add(self, id):
+        with self._lock:
+            if self._ids is None or id in self._positions:
+                return
+            self._positions[id] = len(self._ids)
+            self._ids.append(id)
+
+    def remove(self, id):
+        with self._lock:
+            if self._ids is None or id not in self._positions:
+                return
+            position = self._positions.pop(id)
+            last = self._ids.pop()
+            if last != id:
+                self._ids[position] = last
+                self._positions[last] = position
+
+    def choice(self, exclude=()):
+        """Returns a random id, avoiding the ones in exclude if it can, or
+        None if the index is empty.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if not self._ids:
+                return None
+            if len(exclude) >= len(self._ids):
+                return random.choice(self._ids)
+            while True:
+                id = random.choice(self._ids)
+                if id not in exclude:
+                    return id
+
+    def reload(self):
+        """Forgets the ids, so they are loaded again on next use."""
+        with self._lock:
+            self._ids = None
+            self._positions = None
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ids)
@@ -0,0 +1,177 @@
+import threading
+import time
+
+
+class Leaderboard(object):
+    """The points of the players of one channel in one season, ranked.
+
+    Next to the points of every player, it keeps a Fenwick tree that counts
+    the players by their points. Both giving points and finding the rank of
+    a player (or the player at a rank) take O(log n) in the highest score,
+    however many players there are. Players with the same points share a
+    rank.
+    """
+    def __init__(self):
+        self.points = {}
+        self._nicks = {}        # points -> nicks with that many points
+        self._tree = [0] * 65   # counts of players at points index - 1
+        self._size = 64
+
+    def __len__(self):
+        return len(self.points)
+
+    def _update(self, index, delta):
+        tree = self._tree
+        while index <= self._size:
+            tree[index] += delta
+            index += index & -index
+
+    def _prefix(self, index):
+        """Returns the number of players with fewer than index points."""
+        tree = self._tree
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def _grow(self, points):
+        """Makes room in the tree for the given points."""
+        size = self._size
+        while size <= points:
+            size *= 2
+        tree = [0] * (size + 1)
+        for score, nicks in self._nicks.iteritems():
+            tree[score + 1] = len(nicks)
+        for index in xrange(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self._tree = tree
+        self._size = size
+
+    def add(self, nick, points):
+        """Gives points to a player.
+
+        Returns:
+            The new points of the player.
+        """
+        old = self.points.get(nick)
+        new = (old or 0) + points
+        if new < 0:
+            new = 0
+        if old is not None:
+            self._nicks[old].discard(nick)
+            if not self._nicks[old]:
+                del self._nicks[old]
+            self._update(old + 1, -1)
+        if new >= self._size:
+            self._grow(new)
+        self.points[nick] = new
+        self._nicks.setdefault(new, set()).add(nick)
+        self._update(new + 1, 1)
+        return new
+
+    def rank(self, nick):
+        """Returns the (rank, points) of the player, or None if the player
+        has no points.
+        """
+        points = self.points.get(nick)
+        if points is None:
+            return None
+        return len(self.points) - self._prefix(points + 1) + 1, points
+
+    def _kth_smallest(self, k):
+        """Returns the points of the k-th player from the bottom."""
+        index = 0
+        step = self._size
+        while step:
+            if index + step <= self._size and self._tree[index + step] < k:
+                index += step
+                k -= self._tree[index]
+            step //= 2
+        return index
+
+    def top(self, count):
+        """Returns the best players as (rank, nick, points), at most count
+        of them, but all the ones that share the last rank.
+        """
+        found = []
+        while len(found) < count and len(found) < len(self.points):
+            rank = len(found) + 1
+            points = self._kth_smallest(len(self.points) - rank + 1)
+            for nick in sorted(self._nicks[points]):
+                found.append((rank, nick, points))
+        return found
+
+
+def current_season(format='%Y-%m'):
+    """Returns the name of the season that is on now, by default the
+    month.
+    """
+    return time.strftime(format)
+
+
+class Leaderboards(object):
+    """The leaderboards of all the channels in the current season, kept in
+    memory. Points are given here and saved by the caller; ``rank()`` and
+    ``top()`` never touch the database.
+
+    When it is first used, and when a new season starts, it is filled with
+    load(season), which returns (channel, nick, points) rows; the points
+    of a player in a channel are added up.
+    """
+    def __init__(self, load, season=current_season):
+        self._load = load
+        self._season = season
+        self.season = None
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def _board(self, channel):
+        season = self._season()
+        if season != self.season:
+            boards = {}
+            for row_channel, nick, points in self._load(season):
+                board = boards.get(row_channel.lower())
+                if board is None:
+                    board = boards[row_channel.lower()] = Leaderboard()
+                board.add(nick, points)
+            self._boards = boards
+            self.season = season
+        board = self._boards.get(channel.lower())
+        if board is None:
+            board = self._boards[channel.lower()] = Leaderboard()
+        return board
+
+    def award(self, channel, nick, points):
+        """Gives points to a player in a channel.
+
+        Returns:
+            The season the points count in.
+        """
+        with self._lock:
+            self._board(channel).add(nick, points)
+            return self.season
+
+    def rank(self, channel, nick):
+        """Returns (rank, points, players) of the player in the channel, or
+        None if the player has no points there.
+        """
+        with self._lock:
+            board = self._board(channel)
+            found = board.rank(nick)
+            if found is None:
+                return None
+            return found + (len(board),)
+
+    def top(self, channel, count):
+        """Returns the best players in the channel, see Leaderboard.top()."""
+        with self._lock:
+            return self._board(channel).top(count)
+
+    def reload(self):
+        """Forgets the points, so they are loaded again on next use."""
+        with self._lock:
+            self.season = None
+            self._boards = {}
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import re
+import unicodedata
+
+# letters that don't decompose into a base letter and an accent
+_FOLD = {
+    ord(u'đ'): u'd',   # d with stroke
+    ord(u'ł'): u'l',   # l with stroke
+    ord(u'ø'): u'o',   # o with stroke
+    ord(u'æ'): u'ae',
+    ord(u'œ'): u'oe',
+    ord(u'ß'): u'ss',
+}
+_PUNCTUATION = re.compile(r'[\W_]+', re.UNICODE)
+_DIGITS = re.compile(r'\d', re.UNICODE)
+
+
+def normalize_answer(text):
+    """Returns the text as answers are compared: unicode, lower case, without
+    diacritics and punctuation, with words separated by single spaces.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = text.lower()
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        text = unicodedata.normalize('NFKD', text.translate(_FOLD))
+        text = u''.join([char for char in text
+                         if not unicodedata.combining(char)])
+    return _PUNCTUATION.sub(u' ', text).strip()
+
+
+def allowed_errors(answer):
+    """Returns how many typos a guess of the normalized answer may have.
+    Short answers and answers with numbers have to be exact.
+    """
+    if len(answer) < 4 or _DIGITS.search(answer):
+        return 0
+    if len(answer) < 9:
+        return 1
+    return 2
+
+
+def _deletions(word, count):
+    """Returns the word and everything made from it by deleting up to count
+    characters.
+    """
+    found = set([word])
+    frontier = found
+    for _ in xrange(count):
+        frontier = set([variant[:i] + variant[i + 1:]
+                        for variant in frontier
+                        for i in xrange(len(variant))])
+        found |= frontier
+    return found
+
+
+def distance(first, second):
+    """Returns the edit distance of two strings, counting a swap of two
+    neighbouring characters as one edit.
+    """
+    before = None
+    row = range(len(second) + 1)
+    for i in xrange(1, len(first) + 1):
+        previous, row = row, [i] + [0] * len(second)
+        for j in xrange(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            row[j] = min(previous[j] + 1, row[j - 1] + 1,
+                         previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and \
+                    first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        before = previous
+    return row[-1]
+
+
+class AnswerMatcher(object):
+    """Checks guesses against the answers of one question.
+
+    Guesses that are exactly an answer are found in a set. For typos, the
+    matcher keeps the deletion neighbourhood of every answer: all the strings
+    made by deleting up to allowed_errors() characters. A guess within that
+    many edits of an answer shares one of these strings with it, so a guess
+    is only compared with the answers it shares a string with, and guesses
+    of a length no answer could match are rejected right away.
+    """
+    def __init__(self, answers):
+        """Builds the matcher.
+
+        Args:
+            * answers: a dict of the normalized answers to what ``match()``
+              returns for them, like the answers as they were written
+        """
+        self.answers = dict(answers)
+        self._neighbours = {}
+        self._errors = 0
+        self._shortest = None
+        self._longest = None
+        for answer in self.answers:
+            errors = allowed_errors(answer)
+            if not errors:
+                continue
+            self._errors = max(self._errors, errors)
+            self._shortest = min(self._shortest or len(answer),
+                                 len(answer) - errors)
+            self._longest = max(self._longest, len(answer) + errors)
+            for variant in _deletions(answer, errors):
+                self._neighbours.setdefault(variant, []).append(answer)
+
+    def match(self, guess):
+        """Returns what was given for the answer the normalized guess
+        matches, or None.
+        """
+        if guess in self.answers:
+            return self.answers[guess]
+        if not self._neighbours or \
+                not self._shortest <= len(guess) <= self._longest:
+            return None
+        for variant in _deletions(guess, self._errors):
+            for answer in self._neighbours.get(variant, ()):
+                if distance(guess, answer) <= allowed_errors(answer):
+                    return self.answers[answer]
+        return None
@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.db import models
+from django.db.models import Sum
+from django.db.models.signals import post_save, post_delete
+
+from irc.ircbot import IrcBot
+from irc.actions import IrcAction, KeywordAction
+from irc.ratelimit import CHANNEL
+from quiz.game import Quiz
+from quiz.index import RandomIndex
+from quiz.leaderboard import Leaderboards
+from quiz.matching import normalize_answer
+from spoilbot.db import uses_db
+from spoilbot.models import ReservedIdModel, db_stats, reserve_ids
+from spoilbot.writer import WriteBehind
+
+
+class Question(models.Model):
+    text = models.CharField(max_length=1023)
+    author = models.CharField(max_length=255, blank=True)
+    active = models.BooleanField(default=True)
+
+    def __unicode__(self):
+        return self.text
+
+
+class Answer(models.Model):
+    question = models.ForeignKey(Question, related_name='answers')
+    text = models.CharField(max_length=255)
+    normalized = models.CharField(max_length=255, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.normalized = normalize_answer(self.text)
+        super(Answer, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return self.text
+
+
+class Award(ReservedIdModel):
+    """Points a player got in a channel. The leaderboards add them up."""
+    channel = models.CharField(max_length=255)
+    season = models.CharField(max_length=20, db_index=True)
+    nick = models.CharField(max_length=255)
+    points = models.IntegerField()
+    question = models.ForeignKey(Question, null=True, blank=True,
+                                 on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+# Ids of the active questions that have answers, to pick one at random
+# without asking the database to sort the whole table. The signals below
+# keep it fresh.
+question_index = RandomIndex(
+    lambda: Question.objects.filter(active=True, answers__isnull=False)
+            .distinct().values_list('id', flat=True))
+
+
+@uses_db(close=True)
+def pick_question(exclude=()):
+    """Returns a random active question whose id is not in exclude (unless
+    there are no others) and a dict of its normalized answers to the
+    answers as they were written, or (None, None) if there are no questions.
+    The timers of the games call it too, so it closes the connection it
+    opens unless it is called from an action.
+    """
+    while True:
+        question_id = question_index.choice(exclude)
+        if question_id is None:
+            return None, None
+        try:
+            question = Question.objects.get(id=question_id)
+        except Question.DoesNotExist:
+            # deleted by another process
+            question_index.remove(question_id)
+            continue
+        answers = {}
+        for normalized, text in question.answers.values_list('normalized',
+                                                             'text'):
+            answers[normalized or normalize_answer(text)] = text
+        if answers:
+            return question, answers
+        question_index.remove(question_id)
+
+
+def _question_saved(sender, instance, **kwargs):
+    if instance.active and instance.answers.exists():
+        question_index.add(instance.id)
+    else:
+        question_index.remove(instance.id)
+
+def _question_deleted(sender, instance, **kwargs):
+    question_index.remove(instance.id)
+
+def _answer_saved(sender, instance, **kwargs):
+    if instance.question.active:
+        question_index.add(instance.question_id)
+
+
+post_save.connect(_question_saved, sender=Question)
+post_delete.connect(_question_deleted, sender=Question)
+post_save.connect(_answer_saved, sender=Answer)
+
+
+@uses_db(close=True)
+def load_scores(season):
+    """Returns (channel, nick, points) for every player of the season,
+    added up by the database in one query.
+    """
+    return list(Award.objects.filter(season=season)
+                .values_list('channel', 'nick')
+                .annotate(total=Sum('points')).order_by())
+
+
+# The points of the current season, ranked in memory. New awards are
+# written in batches.
+leaderboards = Leaderboards(load_scores)
+award_writer = WriteBehind(Award, reserve_ids,
+                           getattr(settings, 'QUIZ_AWARD_BATCH_SIZE', None),
+                           getattr(settings, 'QUIZ_AWARD_FLUSH_INTERVAL', None))
+
+
+class ScoredQuiz(Quiz):
+    """A quiz that gives POINTS for every right answer."""
+    POINTS = 1
+    def on_correct(self, game, question, nick):
+        season = leaderboards.award(game.channel, nick, self.POINTS)
+        award_writer.add(channel=game.channel, season=season, nick=nick,
+                         points=self.POINTS, question=question)
+
+
+class QuizAction(KeywordAction):
+    AUTHOR = 'brahle'
+    KEYWORD = '!quiz'
+    DESCRIPTION = """Starts a quiz in the channel. Usage: !quiz [questions]"""
+    RATE_LIMITS = {CHANNEL: (3, 60)}
+    @uses_db
+    def _do(self):
+        if self.channel == self.sender:
+            self.bot.send_message(self.sender, 'Quizzes are for channels!')
+            return
+        try:
+            rounds = int(self.message) if self.message else None
+        except ValueError:
+            rounds = None
+        if rounds is not None:
+            rounds = max(1, min(rounds, self.bot.quiz.MAX_ROUNDS))
+        if not self.bot.quiz.start(self.channel, rounds):
+            self.bot.send_message(self.channel, 'A quiz is already running!')
+
+
+class StopQuizAction(KeywordAction):
+    AUTHOR = 'brahle'
+    KEYWORD = '!stopquiz'
+    DESCRIPTION = """Stops the quiz in the channel."""
+    def _do(self):
+        if self.bot.quiz.stop(self.channel):
+            self.bot.send_message(self.channel, 'The quiz is stopped.')
+
+
+class GuessAction(IrcAction):
+    """Checks every message in a channel with a quiz against the answers of
+    its question.
+    """
+    AUTHOR = 'brahle'
+    COMMANDS = ('PRIVMSG',)
+    def check(self, message):
+        target = message.target
+        return bool(target) and target[0] in '#&+!' and \
+            self.bot.quiz.is_answer(target, message.trailing)
+
+    def do(self, message):
+        self.bot.quiz.answered(message.target, message.sender,
+                               message.trailing)
+
+
+class TopAction(KeywordAction):
+    AUTHOR = 'brahle'
+    KEYWORD = '!top'
+    DESCRIPTION = """Shows the best players of the channel this season. \
+Usage: !top [count]"""
+    RATE_LIMITS = {CHANNEL: (5, 60)}
+    MAX_COUNT = 20
+    def _do(self):
+        try:
+            count = int(self.message) if self.message else 10
+        except ValueError:
+            count = 10
+        count = max(1, min(count, self.MAX_COUNT))
+        top = leaderboards.top(self.channel, count)
+        if not top:
+            self.bot.send_message(self.channel, 'Nobody has any points yet.')
+            return
+        self.bot.send_message(self.channel, ', '.join(
+            '{0}. {1} ({2})'.format(rank, nick, points)
+            for rank, nick, points in top))
+
+
+class RankAction(KeywordAction):
+    AUTHOR = 'brahle'
+    KEYWORD = '!rank'
+    DESCRIPTION = """Shows your rank in the channel this season, or the \
+rank of someone else. Usage: !rank [nick]"""
+    def _do(self):
+        nick = self.message.split()[0] if self.message else self.sender
+        found = leaderboards.rank(self.channel, nick)
+        if found is None:
+            text = '{0} has no points yet.'.format(nick)
+        else:
+            text = '{0} is number {1} of {3} with {2} points.'.format(
+                nick, *found)
+        self.bot.send_message(self.channel, text)
+
+
+class QuizBot(IrcBot):
+    DEFAULT_ACTIONS = [QuizAction, StopQuizAction, GuessAction, TopAction,
+                       RankAction]
+
+    def __init__(self, *args, **kwargs):
+        question_time = kwargs.pop('question_time',
+                                   getattr(settings, 'QUIZ_QUESTION_TIME', None))
+        pause = kwargs.pop('pause', getattr(settings, 'QUIZ_PAUSE', None))
+        self.quiz = ScoredQuiz(self, pick_question, question_time, pause)
+        super(QuizBot, self).__init__(*args, **kwargs)
+
+    def start(self):
+        award_writer.start()
+        super(QuizBot, self).start()
+
+    def stop(self):
+        self.quiz.stop_all()
+        super(QuizBot, self).stop()
+        award_writer.flush()
+
+    def stats(self):
+        stats = super(QuizBot, self).stats()
+        stats['db'] = db_stats()
+        return stats
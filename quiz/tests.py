@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+
+import random
+import threading
+
+from quiz.game import Quiz
+from quiz.index import RandomIndex
+from quiz.leaderboard import Leaderboard
+from quiz.matching import AnswerMatcher, normalize_answer
+from quiz.models import Answer, Question, QuizBot, question_index
+from quiz.models import Award, award_writer, leaderboards
+from spoilbot.tests import RecordingBot
+
+
+class MatchingTest(TestCase):
+    def test_normalize(self):
+        """
+        Tests that case, diacritics, punctuation and whitespace don't count.
+        """
+        self.assertEqual(normalize_answer('  Đakovo,  ŽUPANIJA! '),
+                         u'dakovo zupanija')
+        self.assertEqual(normalize_answer(u'Hello, World'), u'hello world')
+
+    def test_typos(self):
+        """
+        Tests that longer answers forgive typos and short or numeric ones
+        don't.
+        """
+        answers = ['Ivan Gundulic', 'Osijek', '1984', 'Rab']
+        matcher = AnswerMatcher(dict((normalize_answer(answer), answer)
+                                     for answer in answers))
+        def match(guess):
+            return matcher.match(normalize_answer(guess))
+        self.assertEqual(match('ivan gundulić'), 'Ivan Gundulic')
+        self.assertEqual(match('ivna gundulci'), 'Ivan Gundulic')
+        self.assertEqual(match('ivan gxndxxic'), None)
+        self.assertEqual(match('osjek'), 'Osijek')
+        self.assertEqual(match('osjk'), None)
+        self.assertEqual(match('1985'), None)
+        self.assertEqual(match('rap'), None)
+        self.assertEqual(match('just chatting'), None)
+
+    def test_random_index(self):
+        """
+        Tests that removed ids are never picked and excluded ones are
+        avoided.
+        """
+        index = RandomIndex(lambda: [1, 2, 3])
+        index.choice()
+        index.remove(2)
+        index.add(4)
+        self.assertEqual(len(index), 3)
+        picked = set(index.choice() for _ in xrange(100))
+        self.assertEqual(picked, set([1, 3, 4]))
+        self.assertEqual(index.choice(exclude=[1, 3]), 4)
+
+
+class RecordingQuizBot(RecordingBot, QuizBot):
+    pass
+
+
+class LeaderboardTest(TestCase):
+    def test_ranks(self):
+        """
+        Tests the ranks and the top players against sorting, also after the
+        tree grows.
+        """
+        board = Leaderboard()
+        points = {}
+        for _ in xrange(500):
+            nick = 'p{0}'.format(random.randint(0, 40))
+            gained = random.randint(0, 20)
+            points[nick] = points.get(nick, 0) + gained
+            self.assertEqual(board.add(nick, gained), points[nick])
+        ordered = sorted(points.values(), reverse=True)
+        for nick, score in points.items():
+            self.assertEqual(board.rank(nick),
+                             (ordered.index(score) + 1, score))
+        top = board.top(5)
+        self.assertTrue(len(top) >= 5)
+        self.assertEqual([score for _, _, score in top],
+                         ordered[:len(top)])
+        self.assertEqual(board.rank('nobody'), None)
+
+    def test_ties(self):
+        """
+        Tests that players with the same points share a rank.
+        """
+        board = Leaderboard()
+        board.add('a', 3)
+        board.add('b', 3)
+        board.add('c', 1)
+        self.assertEqual(board.top(1), [(1, 'a', 3), (1, 'b', 3)])
+        self.assertEqual(board.rank('c'), (3, 1))
+
+
+class QuizTest(TestCase):
+    def setUp(self):
+        question = Question.objects.create(text='Where is Tvrdja?')
+        Answer.objects.create(question=question, text='Osijek')
+        question_index.reload()
+        leaderboards.reload()
+
+    def tearDown(self):
+        award_writer.flush()
+
+    def test_games(self):
+        """
+        Tests that games in different channels run at the same time and
+        that only the first right answer counts.
+        """
+        bot = RecordingQuizBot(pause=0)
+        bot.parse(':a!b@c PRIVMSG #one :!quiz 1')
+        bot.parse(':a!b@c PRIVMSG #two :!quiz 1')
+        bot.parse(':a!b@c PRIVMSG #one :!quiz')
+        bot.parse(':x!b@c PRIVMSG #one :osjek')
+        bot.parse(':y!b@c PRIVMSG #one :Osijek')
+        bot.parse(':y!b@c PRIVMSG #two :OSIJEK!')
+        self.assertEqual(bot.sent, [
+            'PRIVMSG #one :Question 1/1: Where is Tvrdja?\n',
+            'PRIVMSG #two :Question 1/1: Where is Tvrdja?\n',
+            'PRIVMSG #one :A quiz is already running!\n',
+            'PRIVMSG #one :x got it, the answer is Osijek!\n',
+            'PRIVMSG #one :The quiz is over.\n',
+            'PRIVMSG #two :y got it, the answer is Osijek!\n',
+            'PRIVMSG #two :The quiz is over.\n',
+        ])
+        self.assertEqual(bot.quiz.games, {})
+
+    def test_pick_unlocked(self):
+        """
+        Tests that the games don't hold the lock while a question is picked,
+        and that a game stopped meanwhile doesn't get it.
+        """
+        locked = []
+        def try_lock():
+            if quiz._lock.acquire(False):
+                quiz._lock.release()
+                locked.append(False)
+            else:
+                locked.append(True)
+        def pick(exclude):
+            other = threading.Thread(target=try_lock)
+            other.start()
+            other.join()
+            quiz.stop('#one')
+            return Question.objects.get(), {'osijek': 'Osijek'}
+        bot = RecordingBot()
+        quiz = Quiz(bot, pick)
+        quiz.start('#one')
+        self.assertEqual(locked, [False])
+        self.assertEqual(quiz.games, {})
+        self.assertEqual(bot.sent, [])
+
+    def test_scores(self):
+        """
+        Tests that points are ranked right away, written in a batch, and
+        loaded back with the same ranks.
+        """
+        bot = RecordingQuizBot(pause=0)
+        for nick in ['x', 'y', 'x']:
+            bot.parse(':a!b@c PRIVMSG #one :!quiz 1')
+            bot.parse(':{0}!b@c PRIVMSG #one :osijek'.format(nick))
+        bot.parse(':y!b@c PRIVMSG #one :!rank')
+        bot.parse(':y!b@c PRIVMSG #one :!top')
+        self.assertEqual(bot.sent[-2:], [
+            'PRIVMSG #one :y is number 2 of 2 with 1 points.\n',
+            'PRIVMSG #one :1. x (2), 2. y (1)\n',
+        ])
+        self.assertEqual(Award.objects.count(), 0)
+        award_writer.flush()
+        self.assertEqual(Award.objects.count(), 3)
+        leaderboards.reload()
+        self.assertEqual(leaderboards.rank('#ONE', 'x'), (1, 2, 2))
@@ -45,6 +45,15 @@ DATABASES = {
     }
 }
 
+# The bots publish their counters to the cache for the /stats/ page, so it
+# has to be shared between the bots and the web server.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/zeckviz-cache',
+    }
+}
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -123,7 +132,6 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'irc.ircstart.IrcMiddleware'
 )
 
 ROOT_URLCONF = 'zeckviz.urls'
@@ -147,8 +155,89 @@ INSTALLED_APPS = (
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'spoilbot',
+    'quiz',
 )
 
+# The IRC bots started by "python manage.py runbots". See irc/ircstart.py.
+IRC_BOTS = [
+    {
+        'class': 'spoilbot.models.SpoilerBot',
+        'host': 'vilma.hsin.hr',
+        'port': 6667,
+        'channels': ['#zadaci'],
+        'nick': 'SpoilerBot',
+        'identity': 'SpoilerBot',
+        'real_name': 'I like to spoil things!',
+        'owner': 'brahle',
+        'owner_mask': 'brahle!*@*.hsin.hr',
+        # connections the channels are split among; spoilers are still
+        # announced in all of them
+        'shards': 1,
+        # 'off', 'sent' or 'all' lines go to IRC_TRAFFIC_LOG
+        'traffic_level': 'all',
+        # users whose requests go over the rate limits this many times in a
+        # minute are ignored for ignore_time seconds
+        'ignore_after': 10,
+        'ignore_time': 600,
+    },
+]
+
+# Raw IRC traffic of the bots, rotated at max_bytes. Set to None to turn
+# it off.
+IRC_TRAFFIC_LOG = {
+    'path': 'traffic.log',
+    'max_bytes': 10 * 1024 * 1024,
+    'backups': 5,
+}
+
+# 'threads' runs every bot in its own threads, 'loop' runs all of them in a
+# single event loop.
+IRC_ENGINE = 'threads'
+
+# How many spoilers the bots keep in memory, and for how many seconds.
+SPOILER_CACHE_SIZE = 1000
+SPOILER_CACHE_TTL = 300
+
+# New spoilers are written in batches of this size, or after this many
+# seconds, whichever comes first.
+SPOILER_BATCH_SIZE = 100
+SPOILER_FLUSH_INTERVAL = 1.0
+
+# Seconds after which spoilers expire and are deleted, None to keep them
+# forever. Spoilers can also be given their own time, like !spoil 2h: text,
+# of at most SPOILER_MAX_TTL seconds.
+SPOILER_RETENTION = None
+SPOILER_MAX_TTL = 365 * 86400
+
+# Expired spoilers are deleted every SPOILER_PURGE_INTERVAL seconds, in
+# batches of SPOILER_PURGE_BATCH_SIZE with SPOILER_PURGE_PAUSE seconds
+# between them, so the table is never locked for long.
+SPOILER_PURGE_INTERVAL = 300
+SPOILER_PURGE_BATCH_SIZE = 500
+SPOILER_PURGE_PAUSE = 0.5
+
+# !search keeps only this many of the newest spoilers in its index, to
+# bound its memory; None indexes all of them.
+SEARCH_MAX_SPOILERS = None
+
+# Database connections of the bot threads: how many can be used and kept
+# open between uses at once, after how many idle seconds a connection is
+# checked before use (keep it below MySQL's wait_timeout) and after how many
+# seconds it is replaced.
+DB_MAX_CONNECTIONS = 8
+DB_MAX_IDLE = 60
+DB_MAX_AGE = 3600
+
+# Seconds the players of a quiz have for a question, and seconds between
+# two questions.
+QUIZ_QUESTION_TIME = 60
+QUIZ_PAUSE = 5
+
+# Points are written in batches of this size, or after this many seconds,
+# whichever comes first.
+QUIZ_AWARD_BATCH_SIZE = 100
+QUIZ_AWARD_FLUSH_INTERVAL = 10.0
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error.
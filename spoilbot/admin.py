@@ -1,7 +1,44 @@
 from django.contrib import admin
+from django.db.models import Max
+from django.db.models.query import QuerySet
 from spoilbot.models import Spoiler
 
+
+class EstimatedCountQuerySet(QuerySet):
+    """A query set whose count() never counts the whole table, for the
+    admin of big tables. Without filters, the count is estimated from the
+    largest id, which the primary key index has at hand. With filters, at
+    most COUNT_LIMIT rows are counted, so the admin shows that many pages at
+    most; the rest can be found with a narrower search.
+    """
+    COUNT_LIMIT = 10000
+
+    def count(self):
+        if self._result_cache is not None and not self._iter:
+            return len(self._result_cache)
+        if not self.query.where and self.query.high_mark is None:
+            return self.aggregate(Max('id'))['id__max'] or 0
+        limit = self.COUNT_LIMIT
+        if self.query.high_mark is not None:
+            limit = min(limit, self.query.high_mark - self.query.low_mark)
+        return len(self.values_list('id', flat=True)[:limit])
+
+
+def _short_text(spoiler):
+    if len(spoiler.text) > 80:
+        return spoiler.text[:77] + '...'
+    return spoiler.text
+_short_text.short_description = 'text'
+
+
 class SpoilerAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('id', 'author', 'created', 'expires', _short_text)
+    # an exact match uses the index on author, a LIKE would read the table
+    search_fields = ('=author',)
+    ordering = ('-id',)
+
+    def queryset(self, request):
+        spoilers = super(SpoilerAdmin, self).queryset(request)
+        return spoilers._clone(klass=EstimatedCountQuerySet)
 
 admin.site.register(Spoiler, SpoilerAdmin)
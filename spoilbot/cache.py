@@ -0,0 +1,107 @@
+import threading
+import time
+
+MISSING = object()
+
+# fields of the linked list nodes
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """A bounded, thread-safe cache that forgets the least recently used
+    entries first, and every entry after ttl seconds.
+
+    The entries are kept in a dict and in a circular doubly linked list
+    ordered by use, so both lookups and updates take constant time.
+
+    Attributes:
+        * hits: number of lookups that found a fresh entry
+        * misses: number of lookups that didn't
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        """Creates an empty cache.
+
+        Args:
+            * size: the maximal number of entries
+            * ttl: seconds an entry is valid for, or None to keep it until
+              it is pushed out
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def _append(self, node):
+        last = self._root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = self._root
+        last[_NEXT] = self._root[_PREV] = node
+
+    def get(self, key, default=MISSING):
+        """Returns the value for the key, or default if it is not cached."""
+        with self._lock:
+            node = self._map.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            if node[_EXPIRES] is not None and node[_EXPIRES] < time.time():
+                self._unlink(node)
+                del self._map[key]
+                self.misses += 1
+                return default
+            self._unlink(node)
+            self._append(node)
+            self.hits += 1
+            return node[_VALUE]
+
+    def set(self, key, value):
+        """Caches the value for the key, pushing out the oldest entry if the
+        cache is full.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+            elif len(self._map) >= self.size:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[_KEY]]
+            node = [None, None, key, value, expires]
+            self._append(node)
+            self._map[key] = node
+
+    def delete(self, key):
+        """Forgets the key, if it is cached."""
+        with self._lock:
+            node = self._map.pop(key, None)
+            if node is not None:
+                self._unlink(node)
+
+    def clear(self):
+        """Forgets everything."""
+        with self._lock:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def stats(self):
+        """Returns the cache counters in a dict."""
+        return {
+            'size': len(self._map),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
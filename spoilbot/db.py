@@ -0,0 +1,260 @@
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+
+from irc.stats import Histogram
+
+import functools
+import logging
+import threading
+import time
+
+log = logging.getLogger('irc')
+
+
+class ConnectionManager(object):
+    """Looks after the database connections of the bot threads, which live
+    outside the request cycle that would close them.
+
+    Every thread has its own Django connection. Database work is done in
+    a ``session()``, which first waits for one of max_connections slots,
+    so no more than that many threads use the database at once. A thread
+    keeps its connection open between sessions only while fewer than
+    max_connections threads do; otherwise it is closed at the end of the
+    session, so the open connections don't grow with the number of
+    threads. Threads that end should call ``release()``.
+
+    Before the work, a connection that has been idle for max_idle seconds
+    is checked with a cheap query (the server may have dropped it, like
+    MySQL does after wait_timeout), and one older than max_age is closed.
+    Django opens a new one when it is needed. After the work, a transaction
+    that a read left open is ended, so the next session sees fresh data,
+    and a connection that failed is closed.
+
+    Attributes:
+        * wait: time spent waiting for a slot
+        * checks: number of idle connections that were checked
+        * dropped: number of checked connections that were dead
+        * recycled: number of connections closed for their age
+        * errors: number of sessions that ended with a database error
+        * open: number of threads that keep a connection open
+        * closed: number of connections closed because max_connections
+          were kept open already
+    """
+    MAX_CONNECTIONS = 8     # threads using the database at once
+    MAX_IDLE = 60.0         # seconds before an idle connection is checked
+    MAX_AGE = 3600.0        # seconds before a connection is replaced
+
+    def __init__(self, max_connections=None, max_idle=None, max_age=None):
+        self.max_connections = max_connections or self.MAX_CONNECTIONS
+        self.max_idle = max_idle or self.MAX_IDLE
+        self.max_age = max_age or self.MAX_AGE
+        self.wait = Histogram()
+        self.checks = 0
+        self.dropped = 0
+        self.recycled = 0
+        self.errors = 0
+        self.active = 0
+        self.open = 0
+        self.closed = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._local = threading.local()
+
+    def session(self, close=False):
+        """Returns a context manager for database work in this thread.
+
+        Args:
+            * close: close the connection at the end, for threads that
+              don't live long, like timers
+        """
+        return _Session(self, close)
+
+    def _enter(self):
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+        if depth:
+            return
+        start = time.time()
+        self._slots.acquire()
+        now = time.time()
+        with self._lock:
+            self.wait.add(now - start)
+            self.active += 1
+        raw = connection.connection
+        if raw is None:
+            return
+        if raw is not getattr(local, 'raw', None):
+            local.raw = raw
+            local.opened = local.used = now
+        if now - local.opened > self.max_age:
+            with self._lock:
+                self.recycled += 1
+            connection.close()
+        elif now - local.used > self.max_idle:
+            alive = self._alive(raw)
+            with self._lock:
+                self.checks += 1
+                if not alive:
+                    self.dropped += 1
+            if not alive:
+                log.info('Dropped a dead database connection.')
+                connection.close()
+
+    def _alive(self, raw):
+        """Checks the DB-API connection with a query that touches no table.
+        """
+        try:
+            cursor = raw.cursor()
+            try:
+                cursor.execute('SELECT 1')
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def _exit(self, failed, close):
+        local = self._local
+        local.depth -= 1
+        if local.depth:
+            return
+        try:
+            if failed:
+                with self._lock:
+                    self.errors += 1
+            if failed or close:
+                connection.close()
+            else:
+                transaction.rollback_unless_managed()
+        except DatabaseError:
+            connection.close()
+        finally:
+            try:
+                if connection.connection is not None and \
+                        not self._keep(local):
+                    connection.close()
+            finally:
+                self._count_open(local)
+                raw = connection.connection
+                if raw is not None and raw is not getattr(local, 'raw', None):
+                    local.raw = raw
+                    local.opened = time.time()
+                local.used = time.time()
+                with self._lock:
+                    self.active -= 1
+                self._slots.release()
+
+    def _keep(self, local):
+        """Tells if the thread can keep its connection open, which it can
+        if it kept it before or fewer than max_connections threads do.
+        """
+        with self._lock:
+            if getattr(local, 'counted', False) or \
+                    self.open < self.max_connections:
+                return True
+            self.closed += 1
+            return False
+
+    def _count_open(self, local):
+        """Updates the number of threads that keep a connection open."""
+        is_open = connection.connection is not None
+        with self._lock:
+            if is_open and not getattr(local, 'counted', False):
+                self.open += 1
+            elif not is_open and getattr(local, 'counted', False):
+                self.open -= 1
+        local.counted = is_open
+
+    def release(self):
+        """Closes the connection of this thread, for threads that end."""
+        connection.close()
+        self._count_open(self._local)
+
+    def stats(self):
+        """Returns the counters in a dict."""
+        return {
+            'active': self.active,
+            'open': self.open,
+            'closed': self.closed,
+            'wait': self.wait.as_dict(),
+            'checks': self.checks,
+            'dropped': self.dropped,
+            'recycled': self.recycled,
+            'errors': self.errors,
+        }
+
+
+class _Session(object):
+    def __init__(self, manager, close):
+        self.manager = manager
+        self.close = close
+
+    def __enter__(self):
+        self.manager._enter()
+
+    def __exit__(self, kind, value, traceback):
+        self.manager._exit(kind is not None and issubclass(kind, DatabaseError),
+                           self.close)
+        return False
+
+
+connections = ConnectionManager(
+    getattr(settings, 'DB_MAX_CONNECTIONS', None),
+    getattr(settings, 'DB_MAX_IDLE', None),
+    getattr(settings, 'DB_MAX_AGE', None))
+
+
+def uses_db(function=None, close=False):
+    """Decorator for functions and action methods that use the database
+    from a bot thread, see ConnectionManager. Use ``@uses_db(close=True)``
+    for functions that run in threads that don't live long.
+    """
+    if function is None:
+        return functools.partial(uses_db, close=close)
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with connections.session(close):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class RawLookup(object):
+    """A query for the instances of a model with a given value in one
+    column. The SQL is made once, instead of by the ORM on every call, and
+    as the text never changes, drivers that cache statements (like sqlite3)
+    only prepare it once.
+    """
+    def __init__(self, model, column, order_by=None, limit=None):
+        self.model = model
+        self.column = column
+        self.order_by = order_by
+        self.limit = limit
+        self._sql = None
+
+    def _make_sql(self):
+        quote = connection.ops.quote_name
+        fields = self.model._meta.fields
+        sql = 'SELECT {0} FROM {1} WHERE {2} = %s'.format(
+            ', '.join([quote(field.column) for field in fields]),
+            quote(self.model._meta.db_table), quote(self.column))
+        if self.order_by:
+            sql += ' ORDER BY ' + quote(self.order_by)
+        if self.limit:
+            sql += ' LIMIT {0:d}'.format(self.limit)
+        return sql
+
+    def __call__(self, value):
+        """Returns a list of the instances."""
+        if self._sql is None:
+            self._sql = self._make_sql()
+        cursor = connection.cursor()
+        cursor.execute(self._sql, (value,))
+        found = []
+        for row in cursor.fetchall():
+            instance = self.model(*row)
+            instance._state.adding = False
+            instance._state.db = connection.alias
+            found.append(instance)
+        return found
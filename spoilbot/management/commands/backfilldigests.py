@@ -0,0 +1,101 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import DatabaseError, connection, transaction
+
+from spoilbot.models import Spoiler, text_digest
+
+from optparse import make_option
+import datetime
+import time
+
+
+class Command(NoArgsCommand):
+    help = ('Fills in the digests of the old spoilers in batches. Use '
+            '--add-column on databases made before spoilers had digests, '
+            'creation or expiry times.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--add-column', dest='add_column', action='store_true',
+                    default=False,
+                    help='First add the digest, created and expires columns '
+                         'and the indexes, if the table does not have them.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=1000,
+                    help='Spoilers updated in one transaction.'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+                    help='Seconds to wait between batches, to go easy on '
+                         'the database.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['add_column']:
+            self._add_columns()
+        table = connection.ops.quote_name(Spoiler._meta.db_table)
+        sql = 'UPDATE {0} SET {1} = %s WHERE {2} = %s'.format(
+            table, connection.ops.quote_name('digest'),
+            connection.ops.quote_name('id'))
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(Spoiler.objects.filter(digest='', id__gt=last_id)
+                         .order_by('id')
+                         .values_list('id', 'text')[:options['batch_size']])
+            if not batch:
+                break
+            rows = [(text_digest(text), spoiler_id)
+                    for spoiler_id, text in batch]
+            with transaction.commit_on_success():
+                connection.cursor().executemany(sql, rows)
+                transaction.set_dirty()
+            last_id = batch[-1][0]
+            updated += len(batch)
+            self.stdout.write('{0} spoilers done, up to id {1}.\n'.format(
+                updated, last_id))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write('Filled in {0} digests.\n'.format(updated))
+
+    @transaction.commit_on_success
+    def _add_columns(self):
+        """Adds the digest, created and expires columns and the indexes of
+        the spoilers, the way syncdb would have made them, unless the table
+        already has them. Old spoilers get the current time as their
+        creation time.
+        """
+        cursor = connection.cursor()
+        table = Spoiler._meta.db_table
+        columns = [column[0] for column in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table)]
+        nulls = {
+            'digest': "NOT NULL DEFAULT ''",
+            'created': "NOT NULL DEFAULT '{0}'".format(
+                datetime.datetime.now().replace(microsecond=0)),
+            'expires': 'NULL',
+        }
+        for name in ('digest', 'created', 'expires'):
+            if name in columns:
+                continue
+            field = Spoiler._meta.get_field(name)
+            cursor.execute('ALTER TABLE {0} ADD COLUMN {1} {2} {3}'.format(
+                connection.ops.quote_name(table),
+                connection.ops.quote_name(field.column),
+                field.db_type(connection=connection), nulls[name]))
+            transaction.set_dirty()
+            self.stdout.write('Added the {0} column to {1}.\n'.format(
+                name, table))
+        # the introspection can't tell which columns have an index on every
+        # database, so the ones that are there already just fail to be made
+        for name in ('author', 'digest', 'created', 'expires'):
+            field = Spoiler._meta.get_field(name)
+            for statement in connection.creation.sql_indexes_for_field(
+                    Spoiler, field, no_style()):
+                savepoint = transaction.savepoint()
+                try:
+                    cursor.execute(statement)
+                except DatabaseError:
+                    transaction.savepoint_rollback(savepoint)
+                    continue
+                transaction.savepoint_commit(savepoint)
+                transaction.set_dirty()
+                self.stdout.write('Added an index on {0} to {1}.\n'.format(
+                    name, table))
@@ -0,0 +1,119 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from spoilbot.admin import EstimatedCountQuerySet
+from spoilbot.models import Spoiler, text_digest
+from spoilbot.views import spoiler_page
+
+from optparse import make_option
+import datetime
+import random
+import time
+
+
+class Command(NoArgsCommand):
+    help = ('Fills a throwaway database with spoilers and measures how long '
+            'the pages of the spoiler listing take, next to OFFSET paging '
+            'and full counts.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=1000000,
+                    help='Number of spoilers to make.'),
+        make_option('--authors', dest='authors', type='int', default=1000,
+                    help='Number of different authors.'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='Times every query is run; the median is shown.'),
+        make_option('--save', dest='save', default=None,
+                    help='Write the results as JSON to this file.'),
+    )
+
+    def handle_noargs(self, **options):
+        database = settings.DATABASES['default']
+        if database['ENGINE'].endswith('sqlite3') and \
+                database.get('TEST_NAME') in (None, ':memory:'):
+            database['TEST_NAME'] = 'benchspoilers.sqlite3'
+        old_name = database['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            start = time.time()
+            self._fill(options['rows'], options['authors'])
+            self.stdout.write('Made {0} spoilers in {1:.1f} s.\n'.format(
+                options['rows'], time.time() - start))
+            results = self._measure(options['rows'], options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        for name, seconds in results:
+            self.stdout.write('{0:<32} {1:10.2f} ms\n'.format(
+                name, seconds * 1e3))
+        if options['save']:
+            with open(options['save'], 'w') as output:
+                json.dump({'rows': options['rows'],
+                           'ms': dict((name, seconds * 1e3)
+                                      for name, seconds in results)},
+                          output, indent=2, sort_keys=True)
+
+    def _fill(self, rows, authors, batch_size=10000):
+        """Inserts rows spoilers, one a minute, by authors with a few
+        prolific ones.
+        """
+        quote = connection.ops.quote_name
+        fields = Spoiler._meta.local_fields
+        sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            quote(Spoiler._meta.db_table),
+            ', '.join([quote(field.column) for field in fields]),
+            ', '.join(['%s'] * len(fields)))
+        first = datetime.datetime(2011, 1, 1)
+        random.seed(0)
+        for start in xrange(1, rows + 1, batch_size):
+            batch = []
+            for spoiler_id in xrange(start, min(start + batch_size, rows + 1)):
+                text = 'spoiler number {0}'.format(spoiler_id)
+                created = first + datetime.timedelta(minutes=spoiler_id)
+                author = 'nick{0}'.format(
+                    int(random.paretovariate(1.2)) % authors)
+                batch.append((spoiler_id, author, text, text_digest(text),
+                              connection.ops.value_to_db_datetime(created),
+                              None))
+            with transaction.commit_on_success():
+                connection.cursor().executemany(sql, batch)
+                transaction.set_dirty()
+
+    def _measure(self, rows, repeat):
+        """Returns (name, median seconds) of the queries."""
+        middle = datetime.datetime(2011, 1, 1) + \
+            datetime.timedelta(minutes=rows // 2)
+        page = lambda **filters: json.dumps(spoiler_page(**filters),
+                                            default=str)
+        spoilers = Spoiler.objects.order_by('-id')
+        estimated = spoilers._clone(klass=EstimatedCountQuerySet)
+        queries = [
+            ('first page', lambda: page()),
+            ('middle page, keyset', lambda: page(before=rows // 2)),
+            ('last page, keyset', lambda: page(before=51)),
+            ('middle page, OFFSET', lambda: json.dumps(list(
+                spoilers.values_list('id', 'author', 'text')
+                [rows // 2:rows // 2 + 50]))),
+            ('author, first page', lambda: page(author='nick1')),
+            ('rare author, first page', lambda: page(author='nick500')),
+            ('author, deep page', lambda: page(author='nick1',
+                                               before=rows // 10)),
+            ('a day, first page', lambda: page(
+                since=middle, until=middle + datetime.timedelta(days=1))),
+            ('exact text', lambda: page(text='spoiler number 12345')),
+            ('admin count, estimated', lambda: estimated.count()),
+            ('admin count, author', lambda: estimated.filter(
+                author='nick1').count()),
+            ('full COUNT(*)', lambda: spoilers.count()),
+        ]
+        results = []
+        for name, query in queries:
+            times = []
+            for _ in xrange(repeat):
+                start = time.time()
+                query()
+                times.append(time.time() - start)
+            times.sort()
+            results.append((name, times[len(times) // 2]))
+        return results
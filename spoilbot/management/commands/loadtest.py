@@ -0,0 +1,108 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+
+from irc.loadtest import FakeServer, ReplayScenario, SCENARIOS
+from irc.loadtest import compare, format_results, run_scenarios
+from irc.engine import EventLoop
+from irc.trafficlog import TrafficLog
+from spoilbot.models import SpoilerBot, spoiler_writer
+
+from optparse import make_option
+import threading
+
+
+class Command(NoArgsCommand):
+    help = ('Runs a SpoilerBot against a local fake IRC server and reports '
+            'throughput, reply latency and memory. Fails if the results '
+            'are worse than a saved baseline.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--engine', dest='engine', default='threads',
+                    help="'threads' or 'loop', as for runbots."),
+        make_option('--replay', dest='replay', default=None,
+                    help='Also replay a file of recorded raw IRC traffic.'),
+        make_option('--traffic-log', dest='traffic_log', default=None,
+                    help='Write the traffic of the bot to this file.'),
+        make_option('--save', dest='save', default=None,
+                    help='Write the results as JSON to this file.'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='Compare the results with this JSON file.'),
+        make_option('--tolerance', dest='tolerance', type='float',
+                    default=0.25,
+                    help='How much worse than the baseline is still fine '
+                         '(0.25 is 25%).'),
+        make_option('--memory-tolerance', dest='memory_tolerance',
+                    type='float', default=0.1,
+                    help='How much more peak memory than the baseline is '
+                         'still fine (0.1 is 10%).'),
+    )
+
+    def handle_noargs(self, **options):
+        scenarios = list(SCENARIOS)
+        if options['replay']:
+            scenarios.append(ReplayScenario(options['replay']))
+        # spoilers go to a throwaway database, which has to be a file for
+        # the bot's threads to share it
+        database = settings.DATABASES['default']
+        if database['ENGINE'].endswith('sqlite3') and \
+                database.get('TEST_NAME') in (None, ':memory:'):
+            database['TEST_NAME'] = 'loadtest.sqlite3'
+        old_name = database['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = self._run(scenarios, options['engine'],
+                                options['traffic_log'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(format_results(results) + '\n')
+        if options['save']:
+            with open(options['save'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = compare(results, json.load(baseline),
+                                      options['tolerance'],
+                                      options['memory_tolerance'])
+            if regressions:
+                raise CommandError('Slower than the baseline:\n' +
+                                   '\n'.join(regressions))
+
+    def _run(self, scenarios, engine, traffic_log_path):
+        server = FakeServer()
+        traffic_log = None
+        if traffic_log_path:
+            traffic_log = TrafficLog(traffic_log_path)
+        kwargs = {
+            'host': server.host,
+            'port': server.port,
+            'nick': 'loadbot',
+            'channels': ['#zadaci'],
+            'send_rate': None,
+            'reconnect': False,
+            'rate_limits': False,    # the scenarios flood on purpose
+            'traffic_log': traffic_log,
+        }
+        loop = None
+        if engine == 'loop':
+            loop = EventLoop()
+            bot = SpoilerBot(autostart=False, **kwargs)
+            loop.add_bot(bot)
+            thread = threading.Thread(target=loop.run)
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            bot = SpoilerBot(**kwargs)
+        try:
+            return run_scenarios(server, scenarios)
+        finally:
+            bot.stop()
+            if loop is not None:
+                loop.stop()
+            server.close()
+            bot.executor.shutdown(wait=True)
+            spoiler_writer.close()
+            if traffic_log is not None:
+                traffic_log.close()
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from irc.ircstart import Supervisor, make_traffic_log
+from spoilbot.stats import publish
+
+from optparse import make_option
+
+
+class Command(NoArgsCommand):
+    help = 'Starts the IRC bots from settings.IRC_BOTS and keeps them running.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--engine', dest='engine',
+                    default=getattr(settings, 'IRC_ENGINE', 'threads'),
+                    help="'threads' for a thread per bot, or 'loop' to run "
+                         "all the bots in one event loop."),
+    )
+
+    def handle_noargs(self, **options):
+        traffic_log = make_traffic_log(getattr(settings, 'IRC_TRAFFIC_LOG',
+                                               None))
+        supervisor = Supervisor(settings.IRC_BOTS, options['engine'], publish,
+                                traffic_log)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            supervisor.stop()
@@ -1,49 +1,459 @@
-from django.db import models
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Max, Q
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
 
 from irc.ircbot import IrcBot
 from irc.actions import KeywordAction
+from irc.ratelimit import ACTION, CHANNEL, SENDER
+from spoilbot.cache import LRUCache, MISSING
+from spoilbot.db import RawLookup, connections, uses_db
+from spoilbot.purge import Purger
+from spoilbot.search import SearchIndex
+from spoilbot.stats import query_time, time_queries
+from spoilbot.writer import WriteBehind
 
-class Spoiler(models.Model):
-    author = models.CharField(max_length=255)
+import datetime
+import hashlib
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger('irc')
+
+
+def normalize_text(text):
+    """Returns the text as it is compared with other spoilers: UTF-8, with
+    runs of whitespace collapsed into single spaces.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return ' '.join(text.split())
+
+
+def text_digest(text):
+    """Returns the hex SHA-1 of the normalized text."""
+    return hashlib.sha1(normalize_text(text)).hexdigest()
+
+
+_TTL = re.compile(r'(\d+)([smhdw]):\s*(?=\S)')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# The longest time to live a spoiler can be given, in seconds.
+MAX_TTL = getattr(settings, 'SPOILER_MAX_TTL', 365 * 86400)
+
+
+def parse_ttl(message):
+    """Splits a time to live like '2h:' or '30m:' off the front of the
+    message. The colon keeps text like '10m rows' from being read as one.
+
+    Returns:
+        (seconds, text), with None seconds if the message has no TTL.
+
+    Raises:
+        ValueError if the TTL is zero or longer than MAX_TTL.
+    """
+    match = _TTL.match(message)
+    if match is None:
+        return None, message
+    seconds = int(match.group(1)) * _UNITS[match.group(2)]
+    if not 0 < seconds <= MAX_TTL:
+        raise ValueError('A spoiler can expire after 1s to {0}d, not '
+                         'after {1}{2}!'.format(MAX_TTL // 86400,
+                                                match.group(1),
+                                                match.group(2)))
+    return seconds, message[match.end():]
+
+
+# Seconds after which every spoiler expires, None to keep them forever.
+RETENTION = getattr(settings, 'SPOILER_RETENTION', None)
+
+
+class IdBlock(models.Model):
+    """The next free id of a table whose ids are handed out in blocks."""
+    name = models.CharField(max_length=255, unique=True)
+    next_id = models.IntegerField()
+
+
+@transaction.commit_on_success
+def reserve_ids(model, count):
+    """Reserves count consecutive ids of the model and returns the first
+    one. The first reservation starts after the largest id in the table.
+    """
+    name = model._meta.db_table
+    blocks = IdBlock.objects.filter(name=name)
+    if not blocks.update(next_id=F('next_id') + count):
+        top = model.objects.aggregate(Max('id'))['id__max'] or 0
+        IdBlock.objects.create(name=name, next_id=top + 1 + count)
+    return blocks.get().next_id - count
+
+
+class ReservedIdModel(models.Model):
+    """A model whose ids are handed out by reserve_ids(), as WriteBehind
+    does. Instances saved one by one (like in the admin) reserve their id
+    too, so they never take one that a WriteBehind holds but has not
+    written yet.
+    """
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            self.pk = reserve_ids(type(self), 1)
+        super(ReservedIdModel, self).save(*args, **kwargs)
+
+
+class Spoiler(ReservedIdModel):
+    author = models.CharField(max_length=255, db_index=True)
     text = models.CharField(max_length=1023)
+    digest = models.CharField(max_length=40, db_index=True, blank=True,
+                              editable=False)
+    created = models.DateTimeField(default=datetime.datetime.now,
+                                   db_index=True, editable=False)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def save(self, *args, **kwargs):
+        self.digest = text_digest(self.text)
+        super(Spoiler, self).save(*args, **kwargs)
+
+    def expired(self, now=None):
+        """Checks if the spoiler is past its own time or the RETENTION."""
+        now = now or datetime.datetime.now()
+        if self.expires is not None and self.expires <= now:
+            return True
+        return RETENTION is not None and \
+            self.created <= now - datetime.timedelta(seconds=RETENTION)
+
+
+# New spoilers wait here until they are written in a batch.
+spoiler_writer = WriteBehind(Spoiler, reserve_ids,
+                             getattr(settings, 'SPOILER_BATCH_SIZE', None),
+                             getattr(settings, 'SPOILER_FLUSH_INTERVAL', None))
+
+
+def expired_spoilers(now):
+    """Returns the spoilers that are expired at now, found by the indexes
+    on expires and created.
+    """
+    expired = Q(expires__lte=now)
+    if RETENTION is not None:
+        expired |= Q(created__lte=now - datetime.timedelta(seconds=RETENTION))
+    return Spoiler.objects.filter(expired)
+
+
+# The largest id that was purged is kept in IdBlock under this name. Ids up
+# to it that have no spoiler are answered as expired, so the purged ones
+# don't need to be remembered one by one. That includes the ids that never
+# had a spoiler, like the rest of a block that a WriteBehind reserved
+# before the bot stopped.
+_PURGED = Spoiler._meta.db_table + '.purged'
+_purged_up_to = None
+
+
+def purged_up_to():
+    """Returns the largest id that was purged, asking the database only
+    the first time.
+    """
+    global _purged_up_to
+    if _purged_up_to is None:
+        found = IdBlock.objects.filter(name=_PURGED).values_list('next_id',
+                                                                 flat=True)
+        _purged_up_to = found[0] if found else 0
+    return _purged_up_to
+
+
+def _spoilers_purged(rows):
+    """Moves the purged id mark up and forgets the purged spoilers."""
+    global _purged_up_to
+    top = max(row[0] for row in rows)
+    if not IdBlock.objects.filter(name=_PURGED).exists():
+        IdBlock.objects.create(name=_PURGED, next_id=top)
+    else:
+        IdBlock.objects.filter(name=_PURGED, next_id__lt=top).update(
+            next_id=top)
+    _purged_up_to = max(purged_up_to(), top)
+    for spoiler_id, author, text, digest in rows:
+        spoiler_cache.delete(spoiler_id)
+        digest_cache.delete(digest)
+        search_index.remove(spoiler_id, author, text)
+
+
+# Expired spoilers are deleted in the background.
+spoiler_purger = Purger(Spoiler, expired_spoilers, _spoilers_purged,
+                        ('id', 'author', 'text', 'digest'),
+                        getattr(settings, 'SPOILER_PURGE_BATCH_SIZE', None),
+                        getattr(settings, 'SPOILER_PURGE_INTERVAL', None),
+                        getattr(settings, 'SPOILER_PURGE_PAUSE', None))
+
+
+# Spoilers by id, with None for the ids that don't exist. The signals below
+# keep it fresh in this process; the TTL bounds how long edits made by other
+# processes (like the admin) take to show up.
+spoiler_cache = LRUCache(getattr(settings, 'SPOILER_CACHE_SIZE', 1000),
+                         getattr(settings, 'SPOILER_CACHE_TTL', 300))
+
+
+# the hot lookups, with SQL made once
+_spoiler_by_id = RawLookup(Spoiler, 'id')
+_spoiler_by_digest = RawLookup(Spoiler, 'digest', order_by='id')
+
+
+def get_spoiler(spoiler_id):
+    """Returns the spoiler with the given id, or None if there is none. The
+    database is only asked if the answer is not in the cache and the spoiler
+    is not waiting to be written.
+    """
+    spoiler = spoiler_cache.get(spoiler_id)
+    if spoiler is MISSING:
+        spoiler = spoiler_writer.get(spoiler_id)
+        if spoiler is None:
+            spoilers = _spoiler_by_id(spoiler_id)
+            spoiler = spoilers[0] if spoilers else None
+        spoiler_cache.set(spoiler_id, spoiler)
+    return spoiler
+
+
+def _spoiler_saved(sender, instance, **kwargs):
+    spoiler_cache.set(instance.id, instance)
+    digest_cache.delete(instance.digest)
+    search_index.add(instance.id, instance.author, instance.text)
+
+def _spoiler_deleted(sender, instance, **kwargs):
+    spoiler_cache.delete(instance.id)
+    digest_cache.delete(instance.digest)
+    search_index.remove(instance.id, instance.author, instance.text)
+
+# Ids of the spoilers without an expiry of their own by the digest of their
+# text, with None for the digests that no such spoiler has.
+digest_cache = LRUCache(getattr(settings, 'SPOILER_CACHE_SIZE', 1000),
+                        getattr(settings, 'SPOILER_CACHE_TTL', 300))
+
+
+# SpoilAction holds the lock of a digest from looking for the text to
+# adding it, so two workers can't both add the same text. The digests share
+# a fixed number of locks.
+_digest_locks = [threading.Lock() for _ in xrange(64)]
+
+
+def digest_lock(digest):
+    """Returns the lock of the hex digest."""
+    return _digest_locks[int(digest[:8], 16) % len(_digest_locks)]
+
+
+def find_spoiler(text):
+    """Returns the oldest spoiler with the same text (up to whitespace)
+    and no expiry of its own, or None if there is none. Spoilers that
+    expire are never reused, so a repeat can't be purged with them.
+    """
+    digest = text_digest(text)
+    spoiler_id = digest_cache.get(digest)
+    if spoiler_id is None:
+        return None
+    if spoiler_id is not MISSING:
+        spoiler = get_spoiler(spoiler_id)
+        # the spoiler could have been edited since
+        if spoiler is not None and spoiler.digest == digest and \
+                spoiler.expires is None:
+            return spoiler
+    spoilers = [spoiler for spoiler in _spoiler_by_digest(digest)
+                if spoiler.expires is None]
+    if spoilers:
+        spoiler = spoilers[0]
+    else:
+        spoiler = spoiler_writer.find(digest=digest, expires=None)
+    if spoiler is None:
+        digest_cache.set(digest, None)
+    else:
+        digest_cache.set(digest, spoiler.id)
+        spoiler_cache.set(spoiler.id, spoiler)
+    return spoiler
+
+
+# The words of the spoilers, for !search. It is filled from the database
+# in the background when the bot starts and kept up to date by SpoilAction
+# and the signals.
+search_index = SearchIndex(getattr(settings, 'SEARCH_MAX_SPOILERS', None))
+SEARCH_RETRY = 60.0     # seconds before a build that failed is tried again
+_search_lock = threading.Lock()
+_search_thread = None
+
+
+@uses_db(close=True)
+def build_search_index(chunk_size=10000):
+    """Indexes all the spoilers in the database, reading them in chunks
+    by id so no query holds the table for long.
+    """
+    start = time.time()
+    last_id = 0
+    while True:
+        chunk = list(Spoiler.objects.filter(id__gt=last_id).order_by('id')
+                     .values_list('id', 'author', 'text')[:chunk_size])
+        if not chunk:
+            break
+        for spoiler_id, author, text in chunk:
+            search_index.add(spoiler_id, author, text)
+        last_id = chunk[-1][0]
+    search_index.ready.set()
+    stats = search_index.stats()
+    log.info('Indexed %d spoilers (%d words, about %d kB) in %.1f s.',
+             stats['spoilers'], stats['words'], stats['bytes'] // 1024,
+             time.time() - start)
+
+
+def start_search_index():
+    """Builds the search index in a background thread, once per process.
+    """
+    global _search_thread
+    with _search_lock:
+        if _search_thread is not None:
+            return
+        _search_thread = threading.Thread(target=_build_search_index)
+        _search_thread.setDaemon(True)
+        _search_thread.start()
+
+
+def _build_search_index():
+    """Builds the search index, and if that fails, tries again after
+    SEARCH_RETRY seconds. What was indexed before the error stays, adding
+    it again changes nothing.
+    """
+    global _search_thread
+    try:
+        build_search_index()
+    except Exception:
+        log.exception('Indexing the spoilers failed, will try again in '
+                      '%d s.', SEARCH_RETRY)
+        with _search_lock:
+            _search_thread = threading.Timer(SEARCH_RETRY,
+                                             _build_search_index)
+            _search_thread.setDaemon(True)
+            _search_thread.start()
+
+
+post_save.connect(_spoiler_saved, sender=Spoiler)
+post_delete.connect(_spoiler_deleted, sender=Spoiler)
+connection_created.connect(time_queries)
 
 
 class SpoilAction(KeywordAction):
     AUTHOR = 'brahle'
     KEYWORD = '!spoil'
-    DESCRIPTION = """Use this to spoil a message. Usage: /msg {name} !spoil \
-text-to-spoil"""
+    RATE_LIMITS = {SENDER: (5, 60), CHANNEL: (10, 60), ACTION: (120, 60)}
+    DESCRIPTION = """Use this to spoil a message, which can expire after a \
+while like 30m:, 2h: or 3d:. Usage: /msg {name} !spoil [2h:] text-to-spoil"""
+    def start(self):
+        spoiler_writer.start()
+        spoiler_purger.start()
+
+    def stop(self):
+        spoiler_purger.stop()
+        spoiler_writer.flush()
+
+    @uses_db
     def _do(self):
-        spoiler = Spoiler(author=self.sender, text=self.message)
-        spoiler.save()
-        msg = 'User {0} created spoiler {1}!'
+        try:
+            ttl, text = parse_ttl(self.message)
+        except ValueError, e:
+            self.bot.send_message(self.channel, str(e))
+            return
+        digest = text_digest(text)
+        with digest_lock(digest):
+            # a spoiler is only repeated if neither expires by itself
+            spoiler = None
+            if ttl is None:
+                spoiler = find_spoiler(text)
+            if spoiler is not None and spoiler.expired():
+                spoiler = None
+            if spoiler is not None:
+                msg = 'User {0} repeated spoiler {1}!'
+            else:
+                expires = None
+                if ttl is not None:
+                    expires = datetime.datetime.now() + \
+                        datetime.timedelta(seconds=ttl)
+                spoiler = spoiler_writer.add(author=self.sender, text=text,
+                                             digest=digest, expires=expires)
+                spoiler_cache.set(spoiler.id, spoiler)
+                if expires is None:
+                    digest_cache.set(spoiler.digest, spoiler.id)
+                search_index.add(spoiler.id, spoiler.author, spoiler.text)
+                msg = 'User {0} created spoiler {1}!'
         notification = msg.format(self.sender, spoiler.id)
         if self.channel not in self.bot.channels:
             self.bot.send_message(self.channel, notification)
-        for channel in self.bot.channels:
-            self.bot.send_message(channel, notification)
+        self.bot.announce(notification)
 
 
 class UnspoilAction(KeywordAction):
     AUTHOR = 'brahle'
     KEYWORD = '!unspoil'
+    RATE_LIMITS = {SENDER: (10, 60), CHANNEL: (20, 60)}
     DESCRIPTION = """Unspoils the message hidden behind the given id. Usage: \
 !unspoil <id>"""
+    @uses_db
     def _do(self):
         try:
             spoiler_id = int(self.message)
-            spoiler = Spoiler.objects.get(id=spoiler_id)
         except ValueError:
             error = 'I don\'t know what to do with "{0}"!'.format(self.message)
             self.bot.send_message(self.channel, error)
             return
-        except ObjectDoesNotExist:
+        spoiler = get_spoiler(spoiler_id)
+        if spoiler is None and 0 < spoiler_id <= purged_up_to() or \
+                spoiler is not None and spoiler.expired():
+            error = 'Spoiler {0} has expired!'.format(spoiler_id)
+            self.bot.send_message(self.channel, error)
+            return
+        if spoiler is None:
             error = 'Unknown spoiler id ({0})!'.format(spoiler_id)
             self.bot.send_message(self.channel, error)
             return
         self.bot.send_message(self.sender, spoiler.text)
 
 
+class SearchAction(KeywordAction):
+    AUTHOR = 'brahle'
+    KEYWORD = '!search'
+    RATE_LIMITS = {SENDER: (10, 60), CHANNEL: (20, 60)}
+    RESULTS = 10
+    DESCRIPTION = """Finds the newest spoilers with all the given words in \
+their text or author. Usage: !search <words>"""
+    def start(self):
+        start_search_index()
+
+    def _do(self):
+        found = search_index.search(self.message, self.RESULTS)
+        if found:
+            reply = 'Spoilers with "{0}": {1}'.format(
+                self.message, ', '.join(str(spoiler_id)
+                                        for spoiler_id in found))
+        else:
+            reply = 'No spoilers with "{0}".'.format(self.message)
+        if not search_index.ready.isSet():
+            reply += ' (still indexing the old spoilers)'
+        elif search_index.oldest is not None and len(found) < self.RESULTS:
+            reply += ' (only spoilers from {0} on are searched)'.format(
+                search_index.oldest)
+        self.bot.send_message(self.channel, reply)
+
+
 class SpoilerBot(IrcBot):
-    DEFAULT_ACTIONS = [SpoilAction, UnspoilAction]
+    DEFAULT_ACTIONS = [SpoilAction, UnspoilAction, SearchAction]
+
+    def stats(self):
+        stats = super(SpoilerBot, self).stats()
+        stats['db'] = db_stats()
+        stats['search'] = search_index.stats()
+        stats['purge'] = spoiler_purger.stats()
+        return stats
+
+
+def db_stats():
+    """Returns the counters of the database connections of the bots and
+    the time their queries take.
+    """
+    stats = connections.stats()
+    stats['queries'] = query_time.as_dict()
+    return stats
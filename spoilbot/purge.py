@@ -0,0 +1,155 @@
+import datetime
+import logging
+import threading
+import time
+
+from django.db import connection, transaction
+
+from spoilbot.db import connections
+
+log = logging.getLogger('irc')
+
+
+class Purger(object):
+    """Deletes the rows of a model that are past their time, in the
+    background and in small batches.
+
+    Every interval seconds, the thread finds up to batch_size expired rows
+    by an indexed query, deletes them by id in a short transaction, and
+    waits pause seconds before the next batch, so other writers never wait
+    for long however much there is to delete. Several bots can share a
+    Purger: every ``start()`` needs its ``stop()``, and the thread runs
+    until the last one.
+
+    Attributes:
+        * purged: number of rows deleted
+        * batches: number of deletes done
+        * errors: number of batches that failed and will be tried again
+    """
+    BATCH_SIZE = 500        # rows deleted in one transaction
+    INTERVAL = 300.0        # seconds between two purges
+    PAUSE = 0.5             # seconds between two batches of a purge
+
+    def __init__(self, model, expired, purged=None, fields=('id',),
+                 batch_size=None, interval=None, pause=None):
+        """Args:
+            * model: the model class of the rows
+            * expired: expired(now) returns a query set of the rows that
+              are past their time at now, which should use an index
+            * purged: purged(rows) is called in the transaction of every
+              batch, with the values of fields of the deleted rows
+            * fields: the names of the values given to purged(), starting
+              with the primary key
+            * batch_size: overrides BATCH_SIZE
+            * interval: overrides INTERVAL
+            * pause: overrides PAUSE
+        """
+        self.model = model
+        self._expired = expired
+        self._purged = purged
+        self.fields = fields
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.interval = interval or self.INTERVAL
+        self.pause = self.PAUSE if pause is None else pause
+        self.purged = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._users = 0
+
+    def start(self):
+        """Starts the thread that purges in the background, unless it
+        runs already.
+        """
+        with self._lock:
+            self._users += 1
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.isSet():
+            self.purge(stop=self._stop)
+            self._stop.wait(self.interval)
+        connections.release()
+
+    def purge(self, now=None, stop=None):
+        """Deletes all the rows that are expired at now, batch by batch.
+
+        Args:
+            * now: the time to compare with, the current time by default
+            * stop: an event that ends the purge after the current batch
+
+        Returns:
+            The number of rows deleted.
+        """
+        deleted = 0
+        while stop is None or not stop.isSet():
+            try:
+                with connections.session():
+                    rows = list(self._expired(now or datetime.datetime.now())
+                                .order_by(self.fields[0])
+                                .values_list(*self.fields)[:self.batch_size])
+                    if rows:
+                        self._delete(rows)
+            except Exception:
+                self.errors += 1
+                log.exception('Purging %s failed, will try again.',
+                              self.model._meta.verbose_name_plural)
+                break
+            if not rows:
+                break
+            deleted += len(rows)
+            self.purged += len(rows)
+            self.batches += 1
+            if len(rows) < self.batch_size:
+                break
+            if self.pause:
+                time.sleep(self.pause)
+        if deleted:
+            log.info('Purged %d %s.', deleted,
+                     self.model._meta.verbose_name_plural)
+        return deleted
+
+    def _delete(self, rows):
+        """Deletes the rows by their ids in one transaction, without
+        loading them like QuerySet.delete() would.
+        """
+        quote = connection.ops.quote_name
+        meta = self.model._meta
+        sql = 'DELETE FROM {0} WHERE {1} IN ({2})'.format(
+            quote(meta.db_table), quote(meta.pk.column),
+            ', '.join(['%s'] * len(rows)))
+        with transaction.commit_on_success():
+            connection.cursor().execute(sql, [row[0] for row in rows])
+            transaction.set_dirty()
+            if self._purged is not None:
+                self._purged(rows)
+
+    def stop(self):
+        """Stops the background thread after the batch it is on, once
+        ``stop()`` was called as many times as ``start()``.
+        """
+        with self._lock:
+            if self._users > 1:
+                self._users -= 1
+                return
+            self._users = 0
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        """Returns the purge counters in a dict."""
+        return {
+            'purged': self.purged,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
+
@@ -0,0 +1,194 @@
+from array import array
+from bisect import bisect_left
+
+import re
+import sys
+import threading
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Returns the set of words of the text, lower case and UTF-8 encoded.
+    Words of one letter are left out.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return set(intern(word.encode('utf-8'))
+               for word in _WORD.findall(text.lower()) if len(word) > 1)
+
+
+# rough sizes of the parts of the index, to report its memory without
+# walking it
+_ARRAY_SIZE = sys.getsizeof(array('l'))
+_ENTRY_SIZE = 3 * sys.getsizeof(0)
+
+
+class SearchIndex(object):
+    """An inverted index of the words of the spoilers and their authors.
+
+    Every word has an array of the ids of the spoilers it is in, in
+    ascending order. A search goes through the ids of the rarest word of
+    the query, newest first, and looks the others up with a binary search,
+    so finding the newest few matches takes milliseconds however many
+    spoilers there are.
+
+    With max_spoilers, only the newest spoilers are kept: when there are
+    more, the oldest tenth of them is dropped and ``oldest`` tells from
+    which id on the search is complete.
+
+    Attributes:
+        * ready: set once the spoilers in the database are all indexed
+        * oldest: the smallest id that is still indexed, if some were dropped
+    """
+    def __init__(self, max_spoilers=None):
+        self.max_spoilers = max_spoilers
+        self.ready = threading.Event()
+        self.oldest = None
+        self._words = {}            # word -> array of ids
+        self._ids = array('l')      # all indexed ids
+        self._postings = 0
+        self._word_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, spoiler_id):
+        ids = self._ids
+        index = bisect_left(ids, spoiler_id)
+        return index < len(ids) and ids[index] == spoiler_id
+
+    def add(self, spoiler_id, author, text):
+        """Indexes a spoiler. A spoiler that is indexed already only gets
+        the words it did not have, so an edit leaves the old words behind
+        until the index is built again.
+        """
+        with self._lock:
+            if self.oldest is not None and spoiler_id < self.oldest:
+                return
+            if spoiler_id not in self:
+                _append(self._ids, spoiler_id)
+            for word in tokenize(text) | tokenize(author):
+                ids = self._words.get(word)
+                if ids is None:
+                    ids = self._words[word] = array('l')
+                    self._word_bytes += sys.getsizeof(word) + _ARRAY_SIZE + \
+                        _ENTRY_SIZE
+                if _append(ids, spoiler_id):
+                    self._postings += 1
+            if self.max_spoilers and len(self._ids) > self.max_spoilers:
+                self._trim(self._ids[len(self._ids) -
+                                     self.max_spoilers * 9 // 10])
+
+    def remove(self, spoiler_id, author, text):
+        """Takes a deleted spoiler out of the index."""
+        with self._lock:
+            if not _discard(self._ids, spoiler_id):
+                return
+            for word in tokenize(text) | tokenize(author):
+                ids = self._words.get(word)
+                if ids is not None and _discard(ids, spoiler_id):
+                    self._postings -= 1
+                    if not ids:
+                        self._drop_word(word)
+
+    def _drop_word(self, word):
+        del self._words[word]
+        self._word_bytes -= sys.getsizeof(word) + _ARRAY_SIZE + _ENTRY_SIZE
+
+    def _trim(self, oldest):
+        """Drops the spoilers with ids below oldest."""
+        for word, ids in self._words.items():
+            count = bisect_left(ids, oldest)
+            if count:
+                del ids[:count]
+                self._postings -= count
+                if not ids:
+                    self._drop_word(word)
+        del self._ids[:bisect_left(self._ids, oldest)]
+        self.oldest = oldest
+
+    def search(self, query, count=10):
+        """Returns the ids of the newest spoilers that have all the words of
+        the query, at most count of them.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._lock:
+            postings = []
+            for word in words:
+                ids = self._words.get(word)
+                if ids is None:
+                    return []
+                postings.append(ids)
+            postings.sort(key=len)
+            rarest, others = postings[0], postings[1:]
+            found = []
+            for index in xrange(len(rarest) - 1, -1, -1):
+                spoiler_id = rarest[index]
+                for ids in others:
+                    position = bisect_left(ids, spoiler_id)
+                    if position == len(ids) or ids[position] != spoiler_id:
+                        break
+                else:
+                    found.append(spoiler_id)
+                    if len(found) == count:
+                        break
+            return found
+
+    def clear(self):
+        """Forgets everything, before the index is built again."""
+        with self._lock:
+            self.ready.clear()
+            self.oldest = None
+            self._words = {}
+            self._ids = array('l')
+            self._postings = 0
+            self._word_bytes = 0
+
+    def stats(self):
+        """Returns the sizes of the index in a dict. The bytes are an
+        estimate, made without walking the index.
+        """
+        itemsize = self._ids.itemsize
+        return {
+            'ready': self.ready.isSet(),
+            'spoilers': len(self._ids),
+            'words': len(self._words),
+            'postings': self._postings,
+            'oldest': self.oldest,
+            'bytes': self._word_bytes + sys.getsizeof(self._words) +
+                     (self._postings + len(self._ids)) * itemsize,
+        }
+
+
+def _append(ids, spoiler_id):
+    """Puts the id in the sorted array, unless it is there. New spoilers
+    have the largest ids, so this is almost always an append.
+
+    Returns:
+        True if the id was added.
+    """
+    if not ids or ids[-1] < spoiler_id:
+        ids.append(spoiler_id)
+        return True
+    index = bisect_left(ids, spoiler_id)
+    if ids[index] == spoiler_id:
+        return False
+    ids.insert(index, spoiler_id)
+    return True
+
+
+def _discard(ids, spoiler_id):
+    """Takes the id out of the sorted array.
+
+    Returns:
+        True if it was there.
+    """
+    index = bisect_left(ids, spoiler_id)
+    if index < len(ids) and ids[index] == spoiler_id:
+        del ids[index]
+        return True
+    return False
@@ -0,0 +1,67 @@
+import time
+
+from django.core.cache import cache
+
+from irc.stats import Histogram, add_db_time
+
+# the bots publish their counters under this key, for the web interface
+STATS_KEY = 'irc-stats'
+STATS_TIMEOUT = 300
+
+# time of every query made by the bots
+query_time = Histogram()
+
+
+class _TimedCursor(object):
+    """Wraps a Django cursor and adds the time of every query to the
+    database time of the thread (see irc.stats.add_db_time).
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            seconds = time.time() - start
+            add_db_time(seconds)
+            query_time.add(seconds)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            seconds = time.time() - start
+            add_db_time(seconds)
+            query_time.add(seconds)
+
+
+def time_queries(sender, connection, **kwargs):
+    """Handler of connection_created that times the queries made through
+    the connection. The query that opens the connection is not timed.
+    """
+    if getattr(connection, '_timed', False):
+        return
+    cursor = connection.cursor
+    connection.cursor = lambda: _TimedCursor(cursor())
+    connection._timed = True
+
+
+def publish(stats):
+    """Saves the stats of the bots where the web interface can see them.
+    The cache has to be shared between processes for this to work.
+    """
+    cache.set(STATS_KEY, {'time': time.time(), 'bots': stats}, STATS_TIMEOUT)
+
+
+def published():
+    """Returns the last stats saved by ``publish()``, or None."""
+    return cache.get(STATS_KEY)
@@ -5,8 +5,45 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError, connection
 from django.test import TestCase
 
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from irc.actions import IrcAction, KeywordAction
+from irc.engine import EventLoop
+from irc.executor import PoolExecutor
+from irc.loadtest import FakeServer, ChatterScenario, PingScenario
+from irc.loadtest import Scenario, compare, run_scenarios
+from irc.ircstart import shard_definitions
+from irc.ircbot import IrcBot
+from irc.message import IrcMessage
+from irc.mysocket import LineBuffer
+from irc.ratelimit import RateLimiter, SlidingWindow, CHANNEL, SENDER
+from irc.sendqueue import SendQueue, PRIORITY_HIGH
+from irc.trafficlog import TrafficLog, RECEIVED, SENT
+from irc.triggers import Contains, Keyword, Mention, Prefix, Regex
+from irc.triggers import Trigger, TriggerMatcher
+from spoilbot.admin import EstimatedCountQuerySet
+from spoilbot.cache import LRUCache, MISSING
+from spoilbot.db import ConnectionManager, RawLookup
+from spoilbot.models import Spoiler, SpoilerBot, reserve_ids
+from spoilbot.models import digest_cache, spoiler_cache, spoiler_writer
+from spoilbot.models import build_search_index, search_index, text_digest
+from spoilbot.models import parse_ttl, spoiler_purger
+from spoilbot import models
+from spoilbot.purge import Purger
+from spoilbot.search import SearchIndex
+from spoilbot.writer import WriteBehind
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +51,1008 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class IrcMessageTest(TestCase):
+    def test_privmsg(self):
+        """
+        Tests that a PRIVMSG is split into its parts.
+        """
+        message = IrcMessage(':brahle!~b@host PRIVMSG #zadaci :!spoil a: b\r\n')
+        self.assertEqual(message.command, 'PRIVMSG')
+        self.assertEqual(message.sender, 'brahle')
+        self.assertEqual(message.target, '#zadaci')
+        self.assertEqual(message.trailing, '!spoil a: b')
+        self.assertEqual(message.params, ['#zadaci', '!spoil a: b'])
+
+    def test_no_prefix(self):
+        """
+        Tests that lines without a prefix or a trailing part are handled.
+        """
+        message = IrcMessage('PING irc.example.org')
+        self.assertEqual(message.prefix, '')
+        self.assertEqual(message.command, 'PING')
+        self.assertEqual(message.params, ['irc.example.org'])
+        self.assertEqual(IrcMessage('').command, '')
+
+
+class RecordingBot(IrcBot):
+    """A bot that doesn't connect anywhere and remembers what it sent."""
+    def __init__(self, **kwargs):
+        kwargs.setdefault('nick', 'testbot')
+        kwargs.setdefault('channels', ['#test'])
+        kwargs.setdefault('owner', 'brahle')
+        kwargs.setdefault('owner_mask', 'brahle!b@c')
+        kwargs.setdefault('send_rate', None)
+        kwargs.setdefault('workers', 0)
+        kwargs['autostart'] = False
+        super(RecordingBot, self).__init__(**kwargs)
+        self._sent = []
+
+    def _write(self, cmd, sock=None):
+        self._sent.append(cmd)
+
+    @property
+    def sent(self):
+        """All the lines the bot sent so far."""
+        while True:
+            line, _ = self.send_queue.pop_ready()
+            if line is None:
+                return self._sent
+            self._write(line)
+
+
+class DispatchTest(TestCase):
+    def test_keyword_and_fallback(self):
+        """
+        Tests that keyword actions, command actions and generic actions are
+        all triggered, in the order they were added.
+        """
+        calls = []
+        class Generic(IrcAction):
+            def check(self, message):
+                return True
+            def do(self, message):
+                calls.append('generic ' + message.command)
+        class Keyword(KeywordAction):
+            KEYWORD = '!kw'
+            def _do(self):
+                calls.append('keyword ' + self.message)
+        bot = RecordingBot()
+        bot.add_action(Generic(bot))
+        bot.add_action(Keyword(bot))
+        bot.parse(':a!b@c PRIVMSG #test :!kw 42')
+        bot.parse(':a!b@c PRIVMSG #test :!other 42')
+        bot.parse('PING :server')
+        self.assertEqual(calls, ['generic PRIVMSG', 'keyword 42',
+                                 'generic PRIVMSG', 'generic PING'])
+        self.assertEqual(bot.sent, ['PONG :server\n'])
+
+    def test_coroutine_action(self):
+        """
+        Tests that a generator action is driven to its end without a loop.
+        """
+        class Twice(KeywordAction):
+            KEYWORD = '!twice'
+            def _do(self):
+                self.bot.send_message(self.channel, 'one')
+                yield 0
+                self.bot.send_message(self.channel, 'two')
+        bot = RecordingBot()
+        bot.add_action(Twice(bot))
+        bot.parse(':a!b@c PRIVMSG testbot :!twice')
+        self.assertEqual(bot.sent, ['PRIVMSG a :one\n', 'PRIVMSG a :two\n'])
+
+    def test_lazy_action(self):
+        """
+        Tests that an action given by its path is only made when it is used.
+        """
+        bot = RecordingBot(actions=[('!echo', 'spoilbot.tests.EchoAction')])
+        lazy = [action for action in bot._actions
+                if getattr(action, 'path', None) == 'spoilbot.tests.EchoAction']
+        self.assertEqual(lazy[0]._action, None)
+        bot.parse(':a!b@c PRIVMSG #test :!echo hello')
+        self.assertTrue(isinstance(lazy[0]._action, EchoAction))
+        self.assertEqual(bot.sent, ['PRIVMSG #test :hello\n'])
+
+
+class EchoAction(KeywordAction):
+    KEYWORD = '!echo'
+    def _do(self):
+        self.bot.send_message(self.channel, self.message)
+
+
+class LineBufferTest(TestCase):
+    def test_fragments(self):
+        """
+        Tests that lines split across chunks and CRLF endings are handled.
+        """
+        lines = LineBuffer()
+        self.assertEqual(lines.feed('PING :a\r'), [])
+        self.assertEqual(lines.feed('\nPING :b\r\nPI'), ['PING :a', 'PING :b'])
+        self.assertEqual(lines.feed('NG :c\n'), ['PING :c'])
+
+    def test_long_lines(self):
+        """
+        Tests that lines over the limit are dropped and counted.
+        """
+        lines = LineBuffer(max_line_length=10)
+        self.assertEqual(lines.feed('x' * 11), [])
+        self.assertEqual(lines.feed('xx\nok\n'), ['ok'])
+        self.assertEqual(lines.feed('y' * 12 + '\nfine\n'), ['fine'])
+        self.assertEqual(lines.dropped, 2)
+
+
+class SendQueueTest(TestCase):
+    def test_coalescing(self):
+        """
+        Tests that the same text is sent to several targets at once, but only
+        as many as the server allows and without reordering messages.
+        """
+        queue = SendQueue()
+        queue.set_targmax({'PRIVMSG': 2})
+        queue.put_message('PRIVMSG', '#a', 'hi')
+        queue.put_message('PRIVMSG', '#b', 'other')
+        queue.put_message('PRIVMSG', '#c', 'hi')
+        queue.put_message('PRIVMSG', '#b', 'hi')
+        queue.put_message('PRIVMSG', '#d', 'hi')
+        queue.put('PONG :x\n', PRIORITY_HIGH)
+        lines = [queue.pop_ready()[0] for _ in xrange(len(queue))]
+        self.assertEqual(lines, ['PONG :x\n', 'PRIVMSG #a,#c :hi\n',
+                                 'PRIVMSG #b :other\n', 'PRIVMSG #b,#d :hi\n'])
+        self.assertEqual(queue.stats()['coalesced'], 2)
+        queue.put_message('PRIVMSG', 'alice', 'same')
+        queue.put_message('PRIVMSG', 'alice', 'same')
+        self.assertEqual([queue.pop_ready()[0] for _ in xrange(len(queue))],
+                         ['PRIVMSG alice :same\n', 'PRIVMSG alice :same\n'])
+
+    def test_flood_control(self):
+        """
+        Tests that only the burst is sent at once.
+        """
+        queue = SendQueue(rate=1, burst=2)
+        for i in xrange(3):
+            queue.put('PRIVMSG #a :{0}\n'.format(i))
+        self.assertNotEqual(queue.pop_ready()[0], None)
+        self.assertNotEqual(queue.pop_ready()[0], None)
+        line, wait = queue.pop_ready()
+        self.assertEqual(line, None)
+        self.assertTrue(0 < wait <= 1)
+
+
+class FastLaneTest(TestCase):
+    def test_pong_first(self):
+        """
+        Tests that PINGs are answered before the other lines of the batch and
+        ahead of the send queue.
+        """
+        bot = RecordingBot()
+        bot.send_message('#test', 'waiting')
+        bot.parse_lines([':a!b@c PRIVMSG #test :?help', 'PING :x'], 0)
+        self.assertEqual(bot._sent, ['PONG :x\n'])
+        self.assertEqual(bot.sent[1], 'PRIVMSG #test :waiting\n')
+        self.assertEqual(bot.ping_latency.count, 1)
+
+    def test_nick_in_use(self):
+        """
+        Tests that the bot picks another nick if its nick is taken.
+        """
+        bot = RecordingBot()
+        bot.parse(':server 433 * testbot :Nickname is already in use.')
+        self.assertEqual(bot.nick, 'testbot_')
+        self.assertEqual(bot.sent, ['NICK testbot_\n'])
+
+
+class FastPoolExecutor(PoolExecutor):
+    WATCHDOG_INTERVAL = 0.05
+
+
+class PoolExecutorTest(TestCase):
+    def test_order_per_key(self):
+        """
+        Tests that tasks with the same key are done in order.
+        """
+        executor = PoolExecutor(workers=3, queue_size=2)
+        done = []
+        finished = threading.Event()
+        for i in xrange(30):
+            executor.submit('#chan{0}'.format(i % 5),
+                            lambda i=i: done.append(i))
+        executor.submit('#chan0', finished.set)
+        finished.wait(5)
+        executor.shutdown(wait=True)
+        for key in xrange(5):
+            ours = [i for i in done if i % 5 == key]
+            self.assertEqual(ours, sorted(ours))
+        self.assertEqual(len(done), 30)
+
+    def test_timeout(self):
+        """
+        Tests that a stuck task is dropped and its lane keeps going.
+        """
+        executor = FastPoolExecutor(workers=1)
+        release = threading.Event()
+        finished = threading.Event()
+        stuck = executor._workers[0]
+        executor.submit('#a', lambda: release.wait(5), timeout=0.1)
+        executor.submit('#a', finished.set)
+        finished.wait(2)
+        self.assertTrue(finished.isSet())
+        self.assertEqual(executor.stats()['timeouts'], 1)
+        release.set()
+        stuck.join()
+        executor.shutdown(wait=True)
+
+    def test_shutdown_full(self):
+        """
+        Tests that shutting down doesn't wait for room in a full lane, and
+        that tasks without a timeout are never dropped.
+        """
+        executor = FastPoolExecutor(workers=1, queue_size=1, timeout=None)
+        release = threading.Event()
+        done = []
+        executor.submit('#a', lambda: release.wait(5))
+        executor.submit('#a', lambda: done.append(1))
+        executor.shutdown()
+        release.set()
+        executor._workers[0].join(5)
+        self.assertFalse(executor._workers[0].isAlive())
+        self.assertEqual(done, [1])
+        self.assertEqual(executor.timeouts, 0)
+
+
+class ShardTest(TestCase):
+    def test_shards(self):
+        """
+        Tests that the channels of a bot are split among its connections.
+        """
+        definition = {'class': 'spoilbot.models.SpoilerBot', 'nick': 'Bot',
+                      'channels': ['#a', '#b', '#c'], 'shards': 2}
+        shards = shard_definitions(definition)
+        self.assertEqual([kwargs['nick'] for _, kwargs in shards],
+                         ['Bot', 'Bot2'])
+        self.assertEqual([kwargs['channels'] for _, kwargs in shards],
+                         [['#a', '#c'], ['#b']])
+        self.assertEqual(shards[0][0].__name__, 'SpoilerBot')
+        self.assertFalse('shards' in shards[0][1])
+        bots = [RecordingBot(**kwargs) for _, kwargs in shards]
+        bots[1].announce('hello')
+        self.assertEqual(bots[0].sent, ['PRIVMSG #a :hello\n',
+                                        'PRIVMSG #c :hello\n'])
+        self.assertEqual(bots[1].sent, ['PRIVMSG #b :hello\n'])
+
+
+class EventLoopTest(TestCase):
+    def test_failing_timer(self):
+        """
+        Tests that a timer that fails doesn't stop the loop.
+        """
+        calls = []
+        def fail():
+            raise EnvironmentError('broken')
+        loop = EventLoop()
+        loop.call_later(0, fail)
+        loop.call_later(0.01, calls.append, 'after')
+        loop.run()
+        self.assertEqual(calls, ['after'])
+
+
+class RegistrationTest(TestCase):
+    def test_join_after_welcome(self):
+        """
+        Tests that channels are joined in batches once the server welcomes
+        the bot.
+        """
+        bot = RecordingBot(channels=['#a', '#b', '#c'])
+        bot.register()
+        self.assertEqual(bot.sent, ['NICK testbot\n',
+                                    'USER None None bla: None\n'])
+        bot.parse(':server 005 testbot TARGMAX=JOIN:2,PRIVMSG:4 :are supported')
+        self.assertEqual(bot.targmax, {'JOIN': 2, 'PRIVMSG': 4})
+        bot.parse(':server 001 testbot_ :Welcome')
+        self.assertEqual(bot.sent[2:], ['JOIN #a,#b\n', 'JOIN #c\n'])
+        self.assertEqual(bot.nick, 'testbot_')
+        self.assertTrue(bot.registered.isSet())
+        self.assertEqual(bot.connect_time.count, 1)
+
+    def test_stale_disconnect(self):
+        """
+        Tests that the threads of an old connection can't close the new one.
+        """
+        class Socket(object):
+            closed = False
+            def shutdown(self, how):
+                pass
+            def close(self):
+                self.closed = True
+        bot = RecordingBot(reconnect=False)
+        old, new = Socket(), Socket()
+        bot.socket, bot._connected = new, True
+        bot.disconnected(old)
+        self.assertTrue(bot._connected)
+        self.assertFalse(new.closed)
+        bot.disconnected(new)
+        self.assertFalse(bot._connected)
+        self.assertTrue(new.closed)
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        """
+        Tests that the least recently used entry is pushed out.
+        """
+        cache = LRUCache(size=2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+        self.assertEqual(cache.get(2), MISSING)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1})
+
+    def test_ttl(self):
+        """
+        Tests that entries expire.
+        """
+        cache = LRUCache(size=2, ttl=-1)
+        cache.set(1, 'a')
+        self.assertEqual(cache.get(1), MISSING)
+        self.assertEqual(len(cache), 0)
+
+
+class RecordingSpoilerBot(RecordingBot):
+    DEFAULT_ACTIONS = SpoilerBot.DEFAULT_ACTIONS
+
+
+class SpoilerTest(TestCase):
+    def setUp(self):
+        spoiler_cache.clear()
+        digest_cache.clear()
+
+    def tearDown(self):
+        # write what is left while the test's transaction can still undo it
+        spoiler_writer.flush()
+
+    def test_spoil_unspoil(self):
+        """
+        Tests that a spoiler can be created and read back from the cache.
+        """
+        bot = RecordingSpoilerBot()
+        bot.parse(':brahle!b@c PRIVMSG testbot :!spoil the answer is 42')
+        self.assertEqual(Spoiler.objects.count(), 0)
+        spoiler_writer.flush()
+        spoiler = Spoiler.objects.get()
+        self.assertEqual(spoiler.author, 'brahle')
+        notification = 'User brahle created spoiler {0}!\n'.format(spoiler.id)
+        self.assertEqual(bot.sent, ['PRIVMSG brahle :' + notification,
+                                    'PRIVMSG #test :' + notification])
+        Spoiler.objects.all().update(text='changed behind our back')
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil {0}'.format(spoiler.id))
+        self.assertEqual(bot.sent[-1], 'PRIVMSG x :the answer is 42\n')
+
+    def test_unknown(self):
+        """
+        Tests that unknown ids are cached too, until a spoiler is saved.
+        """
+        bot = RecordingSpoilerBot()
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil 1')
+        self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Unknown spoiler id (1)!\n')
+        self.assertEqual(spoiler_cache.get(1), None)
+        Spoiler.objects.create(id=1, author='a', text='b')
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil 1')
+        self.assertEqual(bot.sent[-1], 'PRIVMSG x :b\n')
+
+    def test_write_behind(self):
+        """
+        Tests that spoilers are readable before they are written, and are
+        written in batches.
+        """
+        Spoiler.objects.create(author='a', text='old')
+        writer = WriteBehind(Spoiler, reserve_ids, batch_size=2, id_block=2)
+        first = writer.add(author='a', text='first')
+        self.assertEqual(first.id, 2)
+        self.assertEqual(writer.get(2), first)
+        writer.add(author='b', text='second')
+        self.assertEqual(len(writer), 0)
+        third = writer.add(author='c', text='third')
+        self.assertEqual(third.id, 4)
+        self.assertEqual(Spoiler.objects.count(), 3)
+        writer.close()
+        self.assertEqual(Spoiler.objects.get(id=4).text, 'third')
+        self.assertEqual(writer.stats(), {'pending': 0, 'flushed': 3,
+                                          'batches': 2, 'errors': 0,
+                                          'dropped': 0})
+
+    def test_refused_rows(self):
+        """
+        Tests that saved spoilers don't take reserved ids, and that a row
+        the database refuses doesn't hold up the others.
+        """
+        writer = WriteBehind(Spoiler, reserve_ids, batch_size=10)
+        taken = writer.add(author='a', text='taken')
+        good = writer.add(author='a', text='good')
+        saved = Spoiler.objects.create(author='b', text='saved')
+        self.assertTrue(saved.id > good.id)
+        # like an insert that does not go through reserve_ids
+        Spoiler(id=taken.id, author='c', text='other').save_base(raw=True)
+        writer.flush()
+        self.assertEqual(Spoiler.objects.get(id=good.id).text, 'good')
+        self.assertEqual(len(writer), 1)
+        writer.flush()
+        writer.flush()
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(list(writer.dead), [taken])
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_dedup(self):
+        """
+        Tests that the same text gets the same spoiler id.
+        """
+        bot = RecordingSpoilerBot()
+        bot.parse(':a!b@c PRIVMSG testbot :!spoil  the  answer')
+        spoiler_id = bot.sent[0].split()[-1][:-1]
+        bot.parse(':d!b@c PRIVMSG testbot :!spoil the answer ')
+        self.assertEqual(bot.sent[-2], 'PRIVMSG d :User d repeated spoiler '
+                                       '{0}!\n'.format(spoiler_id))
+        spoiler_writer.flush()
+        digest_cache.clear()
+        bot.parse(':e!b@c PRIVMSG testbot :!spoil the answer')
+        self.assertEqual(bot.sent[-2], 'PRIVMSG e :User e repeated spoiler '
+                                       '{0}!\n'.format(spoiler_id))
+        self.assertEqual(Spoiler.objects.count(), 1)
+
+    def test_dedup_expiring(self):
+        """
+        Tests that a spoiler that expires is not reused for one that
+        doesn't, and the other way around.
+        """
+        bot = RecordingSpoilerBot()
+        bot.parse(':a!b@c PRIVMSG testbot :!spoil 1m: the answer')
+        bot.parse(':d!b@c PRIVMSG testbot :!spoil the answer')
+        self.assertTrue(bot.sent[-2].startswith('PRIVMSG d :User d created'))
+        bot.parse(':e!b@c PRIVMSG testbot :!spoil 2h: the answer')
+        self.assertTrue(bot.sent[-2].startswith('PRIVMSG e :User e created'))
+        spoiler_writer.flush()
+        digest_cache.clear()
+        bot.parse(':f!b@c PRIVMSG testbot :!spoil the answer')
+        permanent = Spoiler.objects.get(expires=None)
+        self.assertEqual(bot.sent[-2], 'PRIVMSG f :User f repeated spoiler '
+                                       '{0}!\n'.format(permanent.id))
+        self.assertEqual(Spoiler.objects.count(), 3)
+
+    def test_backfill(self):
+        """
+        Tests that the digests of old spoilers are filled in.
+        """
+        for i in xrange(5):
+            Spoiler.objects.create(author='a', text='text {0}'.format(i))
+        Spoiler.objects.update(digest='')
+        call_command('backfilldigests', batch_size=2)
+        self.assertEqual(Spoiler.objects.get(text='text 3').digest,
+                         text_digest('text  3'))
+
+
+class LoadTest(TestCase):
+    def test_fake_server(self):
+        """
+        Tests that a bot can be driven through the fake server.
+        """
+        server = FakeServer()
+        bot = IrcBot(host=server.host, port=server.port, nick='loadbot',
+                     channels=['#zadaci'], send_rate=None, reconnect=False,
+                     workers=0)
+        try:
+            results = run_scenarios(server, [PingScenario(5),
+                                             ChatterScenario(100),
+                                             Scenario('one', ['PING :one'],
+                                                      ['one'])],
+                                    timeout=5)
+        finally:
+            bot.stop()
+            server.close()
+        self.assertEqual(results['ping']['lines'], 10)
+        self.assertEqual(results['ping']['missing'], 0)
+        self.assertEqual(results['chatter']['p99_ms'], None)
+        self.assertEqual(results['one']['missing'], 0)
+        self.assertEqual(compare(results, results, 0.1), [])
+        slower = dict(results['ping'], lines_per_sec=1e12)
+        self.assertEqual(len(compare(results, {'ping': slower}, 0.1)), 1)
+        smaller = {'max_rss_kb': results['max_rss_kb'] // 2}
+        self.assertEqual(len(compare(results, smaller, 0.1)), 1)
+        self.assertEqual(compare(results, smaller, 0.1, 1.5), [])
+
+
+class StatsTest(TestCase):
+    def test_action_stats(self):
+        """
+        Tests that actions are counted and the owner can see the counters.
+        """
+        bot = RecordingSpoilerBot()
+        bot.CHECK_SAMPLE = 1
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil 1')
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil 1')
+        stats = bot.stats()
+        unspoil = stats['actions']['UnspoilAction']
+        self.assertEqual(unspoil['invocations'], 2)
+        self.assertEqual(unspoil['check']['count'], 2)
+        self.assertEqual(unspoil['db']['count'], 2)
+        self.assertEqual(stats['lines_in']['total'], 2)
+        del bot.sent[:]
+        bot.parse(':x!b@c PRIVMSG #test :?stats')
+        self.assertEqual(bot.sent, [])
+        bot.parse(':brahle!evil@elsewhere PRIVMSG testbot :?stats')
+        self.assertEqual(bot.sent, [])
+        self.assertFalse(RecordingBot(owner_mask=None).is_owner('brahle!b@c'))
+        self.assertTrue(bot.is_owner('Brahle!b@C'))
+        bot.parse(':brahle!b@c PRIVMSG testbot :?stats')
+        sent = bot.sent
+        self.assertTrue(sent[0].startswith('PRIVMSG brahle :in '))
+        self.assertTrue(sent[-1].startswith(
+            'PRIVMSG brahle :UnspoilAction: 2 calls, 0 errors'))
+
+
+class TrafficLogTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_rotate(self):
+        """
+        Tests that the lines are written and the file is rotated.
+        """
+        traffic_log = TrafficLog(self.path, max_bytes=100, backups=1)
+        traffic_log.add_lines('bot', RECEIVED, ['PING :a'] * 3)
+        traffic_log.close()
+        traffic_log = TrafficLog(self.path, max_bytes=100, backups=1)
+        traffic_log.add('bot', SENT, 'PONG :a\n')
+        traffic_log.close()
+        rotated = open(self.path + '.1').readlines()
+        self.assertEqual(len(rotated), 3)
+        self.assertTrue(rotated[0].endswith(' bot < PING :a\n'))
+        self.assertTrue(open(self.path).read().endswith(' bot > PONG :a\n'))
+
+    def test_drop(self):
+        """
+        Tests that lines are dropped when the buffer is full.
+        """
+        traffic_log = TrafficLog(self.path, buffer_size=2)
+        traffic_log.add_lines('bot', RECEIVED, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(traffic_log.dropped, 3)
+        traffic_log.close()
+        self.assertEqual(traffic_log.written, 2)
+
+
+class TriggerTest(TestCase):
+    def test_matcher(self):
+        """
+        Tests that the combined matcher finds every matching entry once, in
+        order, including overlapping strings and regexes it can't join.
+        """
+        import re
+        matcher = TriggerMatcher()
+        matcher.add(0, [Keyword('!hi')])
+        matcher.add(1, [Prefix('??')])
+        matcher.add(2, [Contains('ABC')])
+        matcher.add(3, [Contains('bc'), Contains('ab')])
+        matcher.add(4, [Mention()])
+        matcher.add(5, [Regex(r'\d+')])
+        matcher.add(6, [Regex(r'x$')])
+        matcher.add(7, [Regex(r'(a)\1', re.I)])
+        matcher.add(8, [Regex(r'(?i)yes'), Trigger(lambda text, nick:
+                                                   text == nick)])
+        self.assertEqual(matcher.match('!hi there', 'bot'), [0])
+        self.assertEqual(matcher.match('?? zabcd', 'bot'), [1, 2, 3])
+        self.assertEqual(matcher.match('hey BoT 12 x', 'bot'), [4, 5, 6])
+        self.assertEqual(matcher.match('x AA', 'bot'), [7])
+        self.assertEqual(matcher.match('say X', 'bot'), [])
+        self.assertEqual(matcher.match('YES', 'bot'), [8])
+        self.assertEqual(matcher.match('bot', 'bot'), [4, 8])
+        self.assertFalse(Trigger().matches('bot', 'bot'))
+        self.assertEqual(matcher.match('nothing here', 'bot'), [])
+
+    def test_dispatch(self):
+        """
+        Tests that the bot does the actions whose triggers match, and that
+        their check() still has the last word.
+        """
+        calls = []
+        class Greet(IrcAction):
+            TRIGGERS = [Contains('good morning'), Mention()]
+            def do(self, message):
+                calls.append('greet')
+        class Picky(IrcAction):
+            TRIGGERS = [Prefix('!')]
+            def check(self, message):
+                return message.trailing == '!picky'
+            def do(self, message):
+                calls.append('picky')
+        bot = RecordingBot()
+        bot.add_action(Greet(bot))
+        bot.add_action(Picky(bot))
+        bot.parse(':a!b@c PRIVMSG #test :Good morning, TESTBOT')
+        bot.parse(':a!b@c PRIVMSG #test :!picky')
+        bot.parse(':a!b@c PRIVMSG #test :!other')
+        bot.parse(':a!b@c NOTICE #test :good morning')
+        self.assertEqual(calls, ['greet', 'picky'])
+
+
+class RateLimitTest(TestCase):
+    def test_window(self):
+        """
+        Tests that the window slides and that a rejected request doesn't
+        count against the other limits.
+        """
+        window = SlidingWindow(2, 10)
+        self.assertTrue(window.allow('a', 0))
+        self.assertTrue(window.allow('a', 5))
+        self.assertFalse(window.allow('a', 9))
+        self.assertTrue(window.allow('b', 9))
+        self.assertTrue(window.allow('a', 10))
+        limiter = RateLimiter({SENDER: (1, 10), CHANNEL: (2, 10)})
+        keys = {SENDER: 'a', CHANNEL: '#test'}
+        self.assertEqual(limiter.admit(keys, 0), None)
+        self.assertEqual(limiter.admit(keys, 1), SENDER)
+        self.assertEqual(limiter.admit({SENDER: 'b', CHANNEL: '#test'}, 2),
+                         None)
+        self.assertEqual(limiter.admit({SENDER: 'c', CHANNEL: '#test'}, 3),
+                         CHANNEL)
+
+    def test_shed_and_ignore(self):
+        """
+        Tests that the bot drops requests over the limits before doing them,
+        ignores users who keep trying, and never limits the owner.
+        """
+        calls = []
+        class Limited(KeywordAction):
+            KEYWORD = '!limited'
+            RATE_LIMITS = {SENDER: (2, 60)}
+            def _do(self):
+                calls.append(self.sender)
+        bot = RecordingBot(ignore_after=2)
+        bot.add_action(Limited(bot))
+        for _ in xrange(5):
+            bot.parse(':a!b@c PRIVMSG #test :!limited')
+        bot.parse(':brahle!b@c PRIVMSG #test :!limited')
+        bot.parse(':brahle!b@c PRIVMSG #test :!limited')
+        bot.parse(':brahle!b@c PRIVMSG #test :!limited')
+        self.assertEqual(calls, ['a', 'a', 'brahle', 'brahle', 'brahle'])
+        self.assertEqual(bot.stats()['actions']['Limited']['shed'], 3)
+        self.assertEqual(bot.ignored_lines, 0)
+        bot.parse(':A!b@c PRIVMSG #test :!limited')
+        self.assertEqual(bot.ignored_lines, 1)
+        bot.parse(':brahle!b@c PRIVMSG testbot :?unignore a')
+        self.assertEqual(bot.sent, ['PRIVMSG brahle :Listening to a again.\n'])
+        del calls[:]
+        for _ in xrange(5):
+            bot.parse(':brahle!x@elsewhere PRIVMSG #test :!limited')
+        self.assertEqual(calls, ['brahle', 'brahle'])
+        bot.parse(':brahle!x@elsewhere PRIVMSG testbot :?ignore a')
+        self.assertEqual(len(bot.sent), 1)
+        bot.parse(':brahle!b@c PRIVMSG #test :!limited')
+        self.assertEqual(calls, ['brahle', 'brahle', 'brahle'])
+
+
+class StateTest(TestCase):
+    def test_membership(self):
+        """
+        Tests that joins, names, modes, nick changes, parts, kicks and quits
+        are tracked.
+        """
+        bot = RecordingBot()
+        bot.isupport['PREFIX'] = '(qov)~@+'
+        bot.isupport['CHANMODES'] = 'beI,k,l,imnpst'
+        bot.parse_lines([
+            ':testbot!b@c JOIN #test',
+            ':testbot!b@c JOIN :#other',
+            ':server 353 testbot = #test :testbot @brahle +ana ~@boss',
+            ':server 366 testbot #test :End of /NAMES list.',
+            ':ivo!b@c JOIN #test',
+            ':ivo!b@c JOIN #other',
+            ':brahle!b@c MODE #test +kv-o key ivo brahle',
+        ])
+        state = bot.state
+        self.assertEqual(state.members('#TEST'),
+                         set(['testbot', 'brahle', 'ana', 'boss', 'ivo']))
+        self.assertEqual(state.modes('boss', '#test'), 'qo')
+        self.assertTrue(state.is_voiced('Ivo', '#test'))
+        self.assertFalse(state.is_op('brahle', '#test'))
+        self.assertEqual(state.shared_channels('ivo'),
+                         set(['#test', '#other']))
+        bot.parse_lines([
+            ':ivo!b@c NICK :ivan',
+            ':brahle!b@c KICK #test ana :bye',
+            ':ivan!b@c PART #other',
+            ':boss!b@c QUIT :gone',
+        ])
+        self.assertFalse(state.is_on('ivo', '#test'))
+        self.assertTrue(state.is_voiced('ivan', '#test'))
+        self.assertEqual(state.shared_channels('ivan'), set(['#test']))
+        self.assertEqual(state.members('#test'),
+                         set(['testbot', 'brahle', 'ivan']))
+        bot.parse(':testbot!b@c PART #test')
+        self.assertEqual(state.channels(), ['#other'])
+        self.assertEqual(state.stats(), {'channels': 1, 'users': 1,
+                                         'memberships': 1})
+
+
+class ConnectionManagerTest(TestCase):
+    def test_checks(self):
+        """
+        Tests that idle connections are checked before use and dead ones
+        are dropped.
+        """
+        manager = ConnectionManager(max_idle=0.001)
+        with manager.session():
+            Spoiler.objects.count()
+        time.sleep(0.01)
+        with manager.session():
+            Spoiler.objects.count()
+        self.assertEqual(manager.checks, 1)
+        self.assertEqual(manager.dropped, 0)
+        class Dead(object):
+            def cursor(self):
+                raise EnvironmentError('gone away')
+        self.assertFalse(manager._alive(Dead()))
+
+    def test_bounded(self):
+        """
+        Tests that threads wait for a free slot.
+        """
+        manager = ConnectionManager(max_connections=1)
+        entered = threading.Event()
+        def hold():
+            with manager.session():
+                entered.set()
+                time.sleep(0.05)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        entered.wait()
+        with manager.session():
+            with manager.session():
+                pass
+        thread.join()
+        self.assertEqual(manager.wait.count, 2)
+        self.assertTrue(manager.wait.max >= 0.02)
+        self.assertEqual(manager.active, 0)
+
+    def test_kept_open(self):
+        """
+        Tests that no more than max_connections stay open between sessions.
+        """
+        manager = ConnectionManager(max_connections=1)
+        with manager.session():
+            Spoiler.objects.count()
+        def other():
+            with manager.session():
+                connection.cursor().execute('SELECT 1')
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        # sqlite keeps in-memory databases open, so only the decision to
+        # close is seen here
+        self.assertEqual(manager.closed, 1)
+
+    def test_raw_lookup(self):
+        """
+        Tests that the lookups find the same spoilers as the ORM.
+        """
+        first = Spoiler.objects.create(author='a', text='same')
+        Spoiler.objects.create(author='b', text='same')
+        lookup = RawLookup(Spoiler, 'digest', order_by='id', limit=1)
+        found = lookup(text_digest('same'))
+        self.assertEqual([(s.id, s.author, s.text) for s in found],
+                         [(first.id, u'a', u'same')])
+        self.assertEqual(RawLookup(Spoiler, 'id')(12345), [])
+
+
+class SpoilerListTest(TestCase):
+    def test_pages(self):
+        """
+        Tests that the pages of the listing follow each other without gaps
+        and that filters carry over to the next page.
+        """
+        for i in xrange(5):
+            Spoiler.objects.create(author='ab'[i % 2],
+                                   text='text {0}'.format(i))
+        User.objects.create_user('staff', 'staff@example.org', 'secret')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.client.login(username='staff', password='secret')
+        url, ids = '/spoilers/?limit=2', []
+        while url:
+            page = json.loads(self.client.get(url).content)
+            ids.extend(spoiler['id'] for spoiler in page['spoilers'])
+            url = page['next']
+        self.assertEqual(ids, sorted(Spoiler.objects.values_list('id',
+                                                                 flat=True),
+                                     reverse=True))
+        page = json.loads(self.client.get('/spoilers/?author=a&limit=2')
+                          .content)
+        self.assertEqual([spoiler['text'] for spoiler in page['spoilers']],
+                         ['text 4', 'text 2'])
+        page = json.loads(self.client.get(page['next']).content)
+        self.assertEqual([spoiler['text'] for spoiler in page['spoilers']],
+                         ['text 0'])
+        self.assertEqual(page['next'], None)
+        response = self.client.get('/spoilers/?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_estimated_count(self):
+        """
+        Tests that the admin counts are estimated or capped.
+        """
+        for i in xrange(5):
+            Spoiler.objects.create(author='a', text='text {0}'.format(i))
+        Spoiler.objects.filter(text='text 2').delete()
+        spoilers = Spoiler.objects.all()._clone(klass=EstimatedCountQuerySet)
+        self.assertEqual(spoilers.count(), Spoiler.objects.latest('id').id)
+        EstimatedCountQuerySet.COUNT_LIMIT = 2
+        try:
+            self.assertEqual(spoilers.filter(author='a').count(), 2)
+        finally:
+            EstimatedCountQuerySet.COUNT_LIMIT = 10000
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        search_index.clear()
+
+    def tearDown(self):
+        spoiler_writer.flush()
+        search_index.clear()
+
+    def test_index(self):
+        """
+        Tests that all the words have to match, the newest spoilers come
+        first, and deleted and old spoilers are dropped.
+        """
+        index = SearchIndex()
+        index.add(1, 'ivan', 'The butler did it')
+        index.add(3, 'marko', 'the BUTLER, again')
+        index.add(2, 'ivan', 'Butler \xc4\x8dovjek')
+        self.assertEqual(index.search('butler'), [3, 2, 1])
+        self.assertEqual(index.search('butler ivan', 1), [2])
+        self.assertEqual(index.search(u'\u010dovjek'), [2])
+        self.assertEqual(index.search('butler nobody'), [])
+        index.remove(3, 'marko', 'the BUTLER, again')
+        self.assertEqual(index.search('butler'), [2, 1])
+        self.assertEqual(index.search('marko'), [])
+        bounded = SearchIndex(max_spoilers=10)
+        for spoiler_id in xrange(1, 21):
+            bounded.add(spoiler_id, 'a', 'word {0}'.format(spoiler_id))
+        self.assertTrue(len(bounded) <= 10)
+        self.assertEqual(bounded.search('word', 20)[-1], bounded.oldest)
+        self.assertEqual(bounded.stats()['postings'], 2 * len(bounded))
+
+    def test_search_action(self):
+        """
+        Tests that new spoilers can be found before they are written, and
+        old ones after the index is built from the database.
+        """
+        Spoiler.objects.create(author='ivan', text='old secret')
+        search_index.clear()
+        build_search_index(chunk_size=1)
+        bot = RecordingSpoilerBot()
+        bot.parse(':brahle!b@c PRIVMSG #test :!spoil new secret')
+        bot.parse(':x!b@c PRIVMSG #test :!search SECRET')
+        spoiler_ids = sorted(Spoiler.objects.values_list('id', flat=True)) + \
+            [spoiler_writer._queue[0].id]
+        self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Spoilers with '
+                         '"SECRET": {0}, {1}\n'.format(*spoiler_ids[::-1]))
+        bot.parse(':x!b@c PRIVMSG #test :!search ivan new')
+        self.assertEqual(bot.sent[-1],
+                         'PRIVMSG #test :No spoilers with "ivan new".\n')
+
+    def test_build_retried(self):
+        """
+        Tests that a build of the index that fails is tried again.
+        """
+        calls = []
+        built = threading.Event()
+        def build():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise DatabaseError('gone away')
+            built.set()
+        original, retry = models.build_search_index, models.SEARCH_RETRY
+        models.build_search_index, models.SEARCH_RETRY = build, 0.01
+        try:
+            models._build_search_index()
+            built.wait(5)
+        finally:
+            models.build_search_index, models.SEARCH_RETRY = original, retry
+            models._search_thread = None
+        self.assertEqual(calls, [0, 1])
+
+
+class ExpiryTest(TestCase):
+    def setUp(self):
+        spoiler_cache.clear()
+        digest_cache.clear()
+        search_index.clear()
+        models._purged_up_to = None
+
+    def tearDown(self):
+        spoiler_writer.flush()
+        search_index.clear()
+        models._purged_up_to = None
+
+    def test_ttl(self):
+        """
+        Tests that a time to live in front of the text sets the expiry.
+        """
+        self.assertEqual(parse_ttl('2h: the butler'), (7200, 'the butler'))
+        self.assertEqual(parse_ttl('30m:  x'), (1800, 'x'))
+        self.assertEqual(parse_ttl('10m rows need an index'),
+                         (None, '10m rows need an index'))
+        self.assertEqual(parse_ttl('2 hours later'), (None, '2 hours later'))
+        self.assertEqual(parse_ttl('1984'), (None, '1984'))
+        self.assertRaises(ValueError, parse_ttl, '0s: x')
+        bot = RecordingSpoilerBot()
+        bot.parse(':brahle!b@c PRIVMSG testbot :!spoil 99999999w: x')
+        self.assertEqual(bot.sent, ['PRIVMSG brahle :A spoiler can expire '
+                                    'after 1s to 365d, not after '
+                                    '99999999w!\n'])
+        bot.parse(':brahle!b@c PRIVMSG testbot :!spoil 1d: the butler')
+        spoiler_writer.flush()
+        spoiler = Spoiler.objects.get()
+        self.assertEqual(spoiler.text, 'the butler')
+        left = spoiler.expires - datetime.datetime.now()
+        self.assertTrue(86000 < left.days * 86400 + left.seconds <= 86400)
+
+    def test_purge(self):
+        """
+        Tests that expired spoilers are deleted in batches and still
+        answered as expired, without asking the database more.
+        """
+        now = datetime.datetime.now()
+        hour = datetime.timedelta(hours=1)
+        old = [Spoiler.objects.create(author='a', text='old {0}'.format(i),
+                                      expires=now - hour)
+               for i in xrange(5)]
+        fresh = Spoiler.objects.create(author='a', text='fresh',
+                                       expires=now + hour)
+        kept = Spoiler.objects.create(author='a', text='kept')
+        bot = RecordingSpoilerBot()
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil {0}'.format(old[0].id))
+        self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Spoiler {0} has '
+                                       'expired!\n'.format(old[0].id))
+        spoiler_purger.batch_size, spoiler_purger.pause = 2, 0
+        try:
+            self.assertEqual(spoiler_purger.purge(), 5)
+        finally:
+            spoiler_purger.batch_size = spoiler_purger.BATCH_SIZE
+            spoiler_purger.pause = spoiler_purger.PAUSE
+        self.assertEqual(spoiler_purger.batches, 3)
+        self.assertEqual(
+            sorted(Spoiler.objects.values_list('id', flat=True)),
+            [fresh.id, kept.id])
+        self.assertEqual(search_index.search('old'), [])
+        with self.assertNumQueries(1):
+            bot.parse(':x!b@c PRIVMSG #test :!unspoil {0}'.format(old[3].id))
+        self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Spoiler {0} has '
+                                       'expired!\n'.format(old[3].id))
+        bot.parse(':x!b@c PRIVMSG #test :!unspoil {0}'.format(kept.id + 1))
+        self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Unknown spoiler id '
+                                       '({0})!\n'.format(kept.id + 1))
+        for spoiler_id in (0, -4):
+            bot.parse(':x!b@c PRIVMSG #test :!unspoil {0}'.format(spoiler_id))
+            self.assertEqual(bot.sent[-1], 'PRIVMSG #test :Unknown spoiler '
+                                           'id ({0})!\n'.format(spoiler_id))
+        self.assertEqual(spoiler_purger.purge(now + 2 * hour), 1)
+
+    def test_shared_purger(self):
+        """
+        Tests that the purger runs until every bot that started it stopped
+        it.
+        """
+        purger = Purger(Spoiler, lambda now: Spoiler.objects.none())
+        purger.start()
+        purger.start()
+        purger.stop()
+        self.assertTrue(purger._thread.isAlive())
+        purger.stop()
+        self.assertEqual(purger._thread, None)
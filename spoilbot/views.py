@@ -1 +1,113 @@
-# Create your views here.
+import datetime
+import json
+import urllib
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from spoilbot.models import Spoiler, text_digest
+from spoilbot.stats import published
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+@staff_member_required
+def bot_stats(request):
+    """Returns the counters last published by the bots as JSON."""
+    stats = published() or {'time': None, 'bots': []}
+    return HttpResponse(json.dumps(stats), mimetype='application/json')
+
+
+def spoiler_page(author=None, text=None, since=None, until=None, before=None,
+                 limit=PAGE_SIZE):
+    """Returns a page of the written spoilers, newest first.
+
+    Pages are found by the id of the last spoiler of the previous one
+    (keyset pagination) instead of skipping rows with OFFSET, so every
+    page is a range of an index, however deep it is. All the filters are
+    on indexed columns.
+
+    Args:
+        * author: only the spoilers of this author
+        * text: only the spoilers with this text, up to whitespace
+        * since: only the spoilers created at this time or later
+        * until: only the spoilers created before this time
+        * before: only the spoilers with smaller ids
+        * limit: the most spoilers on the page
+
+    Returns:
+        (spoilers, next), where spoilers is a list of (id, author, text,
+        created) and next is the before of the next page, or None if this
+        is the last one.
+    """
+    spoilers = Spoiler.objects.order_by('-id')
+    if author is not None:
+        spoilers = spoilers.filter(author=author)
+    if text is not None:
+        spoilers = spoilers.filter(digest=text_digest(text))
+    if since is not None:
+        spoilers = spoilers.filter(created__gte=since)
+    if until is not None:
+        spoilers = spoilers.filter(created__lt=until)
+    if before is not None:
+        spoilers = spoilers.filter(id__lt=before)
+    rows = list(spoilers.values_list('id', 'author', 'text',
+                                     'created')[:limit + 1])
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1][0]
+    return rows, None
+
+
+def _parse_time(value):
+    """Parses '2011-09-30' or '2011-09-30T18:00:00'."""
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('Bad time "{0}".'.format(value))
+
+
+def _bad_request(error):
+    return HttpResponseBadRequest(json.dumps({'error': error}),
+                                  mimetype='application/json')
+
+
+@staff_member_required
+def spoiler_list(request):
+    """Returns a page of spoilers as JSON, see spoiler_page(). The GET
+    parameters are author, text, since, until, before and limit. The
+    response has the spoilers and the URL of the next page, or null.
+    """
+    params = request.GET
+    filters = {}
+    for name in ('author', 'text'):
+        if params.get(name):
+            filters[name] = params[name]
+    try:
+        for name in ('since', 'until'):
+            if params.get(name):
+                filters[name] = _parse_time(params[name])
+        if params.get('before'):
+            filters['before'] = int(params['before'])
+        limit = int(params.get('limit', PAGE_SIZE))
+    except ValueError, error:
+        return _bad_request(str(error))
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return _bad_request('The limit must be between 1 and {0}.'.format(
+            MAX_PAGE_SIZE))
+    rows, before = spoiler_page(limit=limit, **filters)
+    next_url = None
+    if before is not None:
+        query = dict((name, value.encode('utf-8'))
+                     for name, value in params.items())
+        query['before'] = before
+        next_url = '{0}?{1}'.format(reverse('spoiler_list'),
+                                    urllib.urlencode(sorted(query.items())))
+    spoilers = [{'id': spoiler_id, 'author': author, 'text': text,
+                 'created': created.isoformat()}
+                for spoiler_id, author, text, created in rows]
+    return HttpResponse(json.dumps({'spoilers': spoilers, 'next': next_url}),
+                        mimetype='application/json')
@@ -0,0 +1,250 @@
+import collections
+import logging
+import threading
+
+from django.db import IntegrityError, connection, transaction
+
+from spoilbot.db import connections
+
+log = logging.getLogger('irc')
+
+
+class WriteBehind(object):
+    """Buffers new model instances and inserts them in batches.
+
+    Ids are handed out right away from blocks reserved in the database, so
+    an instance can be announced (and looked up with ``get()``) before it is
+    written. A background thread inserts the buffer in one transaction once
+    it holds batch_size instances or every interval seconds, whichever comes
+    first. Without the thread (before ``start()``) a full batch is written
+    by the caller of ``add()``.
+
+    When a batch fails, its instances are written one by one, so a bad one
+    can't hold up the others. An instance the database keeps refusing
+    (with an IntegrityError) MAX_ATTEMPTS times is dropped and kept in
+    ``dead`` for inspection; other errors, like a lost connection, leave
+    the instances queued for the next flush.
+
+    Attributes:
+        * flushed: number of instances written
+        * batches: number of inserts done
+        * errors: number of inserts that failed and will be tried again
+        * dropped: number of instances that were given up on
+        * dead: the last DEAD_LETTERS instances that were given up on
+    """
+    BATCH_SIZE = 100        # instances written in one insert
+    FLUSH_INTERVAL = 1.0    # seconds an instance may wait to be written
+    ID_BLOCK = 100          # ids reserved in the database at once
+    MAX_ATTEMPTS = 3        # times an instance is refused before it's dropped
+    DEAD_LETTERS = 100      # dropped instances that are kept
+
+    def __init__(self, model, reserve, batch_size=None, interval=None,
+                 id_block=None):
+        """Creates an empty buffer.
+
+        Args:
+            * model: the model class of the instances
+            * reserve: reserve(model, count) reserves count consecutive ids
+              and returns the first one
+            * batch_size: overrides BATCH_SIZE
+            * interval: overrides FLUSH_INTERVAL
+            * id_block: overrides ID_BLOCK
+        """
+        self.model = model
+        self._reserve = reserve
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.interval = interval or self.FLUSH_INTERVAL
+        self.id_block = id_block or self.ID_BLOCK
+        self.flushed = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+        self.dead = collections.deque(maxlen=self.DEAD_LETTERS)
+        self._attempts = {}
+        self._queue = []
+        self._pending = {}
+        self._next_id = 0
+        self._last_id = -1
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Starts the thread that writes the buffer in the background."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def add(self, **fields):
+        """Creates an instance with a fresh id and queues it to be written.
+
+        Returns:
+            The new instance.
+        """
+        with self._lock:
+            if self._next_id > self._last_id:
+                with connections.session():
+                    self._next_id = self._reserve(self.model, self.id_block)
+                self._last_id = self._next_id + self.id_block - 1
+            instance = self.model(id=self._next_id, **fields)
+            self._next_id += 1
+            self._queue.append(instance)
+            self._pending[instance.id] = instance
+            full = len(self._queue) >= self.batch_size
+            inline = self._thread is None
+        if full:
+            if inline:
+                self.flush()
+            else:
+                self._wake.set()
+        return instance
+
+    def get(self, pk):
+        """Returns the instance with the given id if it is not written yet,
+        None otherwise.
+        """
+        return self._pending.get(pk)
+
+    def find(self, **fields):
+        """Returns the instance with the smallest id among the ones waiting
+        to be written whose fields have the given values, or None.
+        """
+        with self._lock:
+            found = [instance for instance in self._pending.itervalues()
+                     if all(getattr(instance, name) == value
+                            for name, value in fields.iteritems())]
+        if not found:
+            return None
+        return min(found, key=lambda instance: instance.id)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Writes everything that is in the buffer. The instances stay
+        visible to ``get()`` until they are in the database.
+        """
+        with self._flush_lock:
+            refused = []
+            while True:
+                with self._lock:
+                    batch = self._queue[:self.batch_size]
+                    del self._queue[:self.batch_size]
+                if not batch:
+                    break
+                try:
+                    with connections.session():
+                        self._insert(batch)
+                except Exception:
+                    self.errors += 1
+                    log.exception('Writing %d %s failed, writing them one '
+                                  'by one.', len(batch),
+                                  self.model._meta.verbose_name)
+                    if not self._insert_each(batch, refused):
+                        break
+                    continue
+                self._written(batch)
+                self.batches += 1
+            # the refused ones are tried again on the next flush
+            with self._lock:
+                self._queue[:0] = refused
+
+    def _written(self, instances):
+        with self._lock:
+            for instance in instances:
+                del self._pending[instance.id]
+                self._attempts.pop(instance.id, None)
+        self.flushed += len(instances)
+
+    def _insert_each(self, batch, refused):
+        """Writes the instances of a failed batch one at a time. The ones
+        that are refused are added to refused, or dropped if they were
+        refused too often.
+
+        Returns:
+            False if the database could not be used, in which case the
+            rest of the batch is queued again.
+        """
+        for index, instance in enumerate(batch):
+            try:
+                with connections.session():
+                    self._insert([instance])
+            except IntegrityError:
+                attempts = self._attempts.get(instance.id, 0) + 1
+                if attempts < self.MAX_ATTEMPTS:
+                    self._attempts[instance.id] = attempts
+                    refused.append(instance)
+                    continue
+                log.error('Dropping %s %d, refused %d times.',
+                          self.model._meta.verbose_name, instance.id,
+                          attempts)
+                with self._lock:
+                    del self._pending[instance.id]
+                    self._attempts.pop(instance.id, None)
+                self.dropped += 1
+                self.dead.append(instance)
+            except Exception:
+                log.exception('Writing %s %d failed, will try again.',
+                              self.model._meta.verbose_name, instance.id)
+                with self._lock:
+                    self._queue[:0] = batch[index:]
+                return False
+            else:
+                self._written([instance])
+        return True
+
+    def _insert(self, instances):
+        """Inserts the instances in a single transaction."""
+        manager = self.model._default_manager
+        if hasattr(manager, 'bulk_create'):
+            with transaction.commit_on_success():
+                manager.bulk_create(instances)
+        else:
+            fields = self.model._meta.local_fields
+            quote = connection.ops.quote_name
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                quote(self.model._meta.db_table),
+                ', '.join([quote(field.column) for field in fields]),
+                ', '.join(['%s'] * len(fields)))
+            rows = [[field.get_db_prep_save(field.pre_save(instance, True),
+                                            connection=connection)
+                     for field in fields] for instance in instances]
+            with transaction.commit_on_success():
+                connection.cursor().executemany(sql, rows)
+                transaction.set_dirty()
+        for instance in instances:
+            instance._state.adding = False
+            instance._state.db = connection.alias
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+        connections.release()
+
+    def close(self):
+        """Stops the background thread and writes what is left."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+        if thread is not None:
+            self._wake.set()
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        """Returns the buffer counters in a dict."""
+        return {
+            'pending': len(self._pending),
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'errors': self.errors,
+            'dropped': self.dropped,
+        }
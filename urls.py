@@ -14,4 +14,7 @@ urlpatterns = patterns('',
 
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
+
+    url(r'^stats/$', 'spoilbot.views.bot_stats', name='bot_stats'),
+    url(r'^spoilers/$', 'spoilbot.views.spoiler_list', name='spoiler_list'),
 )